@@ -1,8 +1,16 @@
+import os
 import re
-from genologics.lims import Lims
+import base64
+import hashlib
+import threading
+from time import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from genologics.lims import Lims, TIMEOUT
 from egcg_core.config import cfg
 from egcg_core.app_logging import logging_default as log_cfg
-from egcg_core.exceptions import EGCGError
+from egcg_core.exceptions import EGCGError, LimsCommunicationError
 
 app_logger = log_cfg.get_logger('clarity')
 try:
@@ -14,16 +22,211 @@ except ImportError:
         raise EGCGError('Could not import egcg_core.ncbi.get_species_name - sqlite3 seems to be unavailable.')
 
 
+class LimsStats:
+    """Thread-safe count and cumulative latency of Lims requests, per endpoint type, e.g. 'samples'."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latencies = {}
+
+    def record(self, endpoint, elapsed):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.latencies[endpoint] = self.latencies.get(endpoint, 0) + elapsed
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.latencies = {}
+
+    def report(self):
+        """
+        :return: endpoint type to number of requests, total and mean latency in seconds
+        :rtype: dict[str, dict]
+        """
+        with self.lock:
+            return dict(
+                (e, {'requests': n, 'total_time': self.latencies[e], 'mean_time': self.latencies[e] / n})
+                for e, n in self.requests.items()
+            )
+
+
+lims_stats = LimsStats()
+
+
+class InstrumentedLims(Lims):
+    """
+    Lims whose HTTP session uses a configurable keep-alive connection pool for http and https, and which
+    records every request in lims_stats. The pool sizes default to genologics' own.
+    """
+    def __init__(self, baseuri, username, password, version=Lims.VERSION, pool_connections=100,
+                 pool_maxsize=100, timeout=TIMEOUT):
+        super().__init__(baseuri, username, password, version=version)
+        self.timeout = timeout
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.request_session.mount('http://', self.adapter)
+        self.request_session.mount('https://', self.adapter)
+        self.request_session.headers['Connection'] = 'keep-alive'
+
+    def endpoint_type(self, uri):
+        """'https://a_lims/api/v2/artifacts/batch/retrieve' -> 'artifacts/batch'"""
+        segments = [s for s in urlparse(uri).path.split('/') if s]
+        if 'api' in segments:
+            segments = segments[segments.index('api') + 2:]
+        if not segments:
+            return 'root'
+        if 'batch' in segments:
+            return segments[0] + '/batch'
+        return segments[0]
+
+    def _timed(self, endpoint, func, *args, **kwargs):
+        start = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            lims_stats.record(endpoint, time() - start)
+
+    def get(self, uri, params=dict()):
+        return self._timed(self.endpoint_type(uri), super().get, uri, params=params)
+
+    def put(self, uri, data, params=dict()):
+        return self._timed(self.endpoint_type(uri), super().put, uri, data, params=params)
+
+    def post(self, uri, data, params=dict()):
+        return self._timed(self.endpoint_type(uri), super().post, uri, data, params=params)
+
+    def delete(self, uri, params=dict()):
+        return self._timed(self.endpoint_type(uri), super().delete, uri, params=params)
+
+    def get_file_contents(self, *args, **kwargs):
+        return self._timed('files', super().get_file_contents, *args, **kwargs)
+
+    def route_artifacts(self, *args, **kwargs):
+        return self._timed('route', super().route_artifacts, *args, **kwargs)
+
+    def download(self, uri):
+        """Streamed GET of a file's content through the pooled session, with the connection's timeout."""
+        return self._timed('files', self.request_session.get, uri, auth=(self.username, self.password),
+                           timeout=self.timeout, stream=True)
+
+
 _lims = None
+_lims_lock = threading.Lock()
+_thread_connections = threading.local()
+_snapshot = None
+
+
+connection_args = ('baseuri', 'username', 'password', 'version', 'pool_connections', 'pool_maxsize', 'timeout')
+
+
+def _create_connection():
+    """
+    Build an InstrumentedLims from the 'clarity' config, e.g. baseuri, username, password, pool_maxsize. Other
+    options in the section, e.g. per_thread_connection or route_chunk_size, are not passed on.
+    """
+    config = cfg.get('clarity')
+    return InstrumentedLims(**dict((k, config[k]) for k in connection_args if k in config))
 
 
 def connection():
+    """
+    Return the Lims connection, creating it if needed. By default, one connection is shared by all threads. If
+    per_thread_connection is set in the 'clarity' config, each thread gets its own connection instead.
+    :rtype: Lims
+    """
     global _lims
+    if _snapshot:
+        raise LimsCommunicationError('Cannot connect to the Lims in offline mode, using ' + _snapshot.db_file)
+
+    if cfg.query('clarity', 'per_thread_connection'):
+        lims = getattr(_thread_connections, 'lims', None)
+        if lims is None:
+            lims = _thread_connections.lims = _create_connection()
+        return lims
+
     if not _lims:
-        _lims = Lims(**cfg.get('clarity'))
+        with _lims_lock:
+            if not _lims:
+                _lims = _create_connection()
     return _lims
 
 
+def use_snapshot(snapshot_file):
+    """
+    Switch to offline mode, where the clarity helpers answer from a snapshot written by export_project_snapshot
+    and any other access to the Lims raises a LimsCommunicationError.
+    :param str snapshot_file: Snapshot to use, or None to go back to the Lims
+    """
+    global _snapshot
+    if _snapshot:
+        _snapshot.close()
+    _snapshot = None
+    if snapshot_file:
+        from egcg_core.lims_snapshot import LimsSnapshot  # only needs sqlite3 in offline mode
+        _snapshot = LimsSnapshot(snapshot_file)
+
+
+def export_project_snapshot(project_id, snapshot_file):
+    """
+    Collect a project's samples, UDFs, plates, wells, release dates and run elements from the Lims with batch
+    queries, and write them to a local snapshot for use_snapshot. Any previous snapshot of the project in
+    snapshot_file is replaced.
+    :param str project_id:
+    :param str snapshot_file: sqlite file to write
+    :return: the number of samples exported
+    """
+    lims = connection()
+    samples = lims.get_samples(projectname=project_id)
+    lims.get_batch(samples)
+    artifacts = [s.artifact for s in samples]
+    lims.get_batch(artifacts)
+    lims.get_batch(list(set(a.container for a in artifacts if a.container)))
+
+    release_dates = {}
+    artifact_ids = [a.id for a in artifacts]
+    for start in range(0, len(artifact_ids), 100):
+        procs = lims.get_processes(type='Data Release EG 1.0', inputartifactlimsid=artifact_ids[start:start + 100])
+        for p in procs:
+            for a in p.all_inputs():
+                release_dates[a.id] = max(release_dates.get(a.id) or p.date_run, p.date_run)  # the latest one
+
+    sample_names = dict((s.id, s.name) for s in samples)
+    run_elements = []
+    runs = lims.get_processes(type='AUTOMATED - Sequence', projectname=project_id)
+    lims.get_batch([a for p in runs for a in p.all_inputs()])
+    for p in runs:
+        run_id = p.udf.get('RunID')
+        for artifact in p.all_inputs():
+            if artifact.udf.get('Lane Failed?', False):
+                continue
+            lane = artifact.location[1].split(':')[0]
+            run_elements.extend((sample_names[s.id], run_id, lane) for s in artifact.samples if s.id in sample_names)
+
+    snapshot_samples = []
+    for s in samples:
+        container, well = s.artifact.location
+        snapshot_samples.append(
+            {
+                'name': s.name,
+                'udf': dict(s.udf.items()),
+                'artifact_id': s.artifact.id,
+                'container_name': container.name if container else None,
+                'container_type': container.type.name if container else None,
+                'well': well,
+                'release_date': release_dates.get(s.artifact.id)
+            }
+        )
+
+    from egcg_core.lims_snapshot import LimsSnapshot
+    snapshot = LimsSnapshot(snapshot_file)
+    snapshot.add_project(project_id, snapshot_samples, run_elements)
+    snapshot.close()
+    app_logger.info('Exported %s samples and %s run elements of %s to %s', len(snapshot_samples),
+                    len(run_elements), project_id, snapshot_file)
+    return len(snapshot_samples)
+
+
 def get_valid_lanes(flowcell_name):
     """
     Get all valid lanes for a given flowcell
@@ -59,7 +262,9 @@ def find_project_name_from_sample(sample_name):
 
 def find_run_elements_from_sample(sample_name):
     sample = get_sample(sample_name)
-    if sample:
+    if sample and _snapshot:
+        yield from _snapshot.get_run_elements(sample.name)
+    elif sample:
         run_log_files = connection().get_artifacts(
             sample_name=sample.name,
             process_type='AUTOMATED - Sequence'
@@ -110,6 +315,13 @@ substitutions = (
 
 
 def get_list_of_samples(sample_names):
+    if _snapshot:
+        samples = _snapshot.get_samples(c for s in sample_names for c in _lims_name_candidates(s))
+        remainder = sorted(n for n, s in _match_samples(sample_names, samples).items() if s is None)
+        if remainder:
+            app_logger.warning('Could not find %s in snapshot' % remainder)
+        return samples
+
     max_query = 100
     results = []
     for start in range(0, len(sample_names), max_query):
@@ -139,6 +351,14 @@ def _get_list_of_samples(sample_names, sub=0):
 
 
 def get_samples(sample_name):
+    if _snapshot:
+        samples = _snapshot.get_samples(_lims_name_candidates(sample_name))
+        for candidate in _lims_name_candidates(sample_name):  # same precedence as the Lims queries below
+            matching = [s for s in samples if s.name == candidate]
+            if matching:
+                return matching
+        return []
+
     lims = connection()
     samples = lims.get_samples(name=sample_name)
     # FIXME: Remove the hack when we're sure our sample id don't have colon
@@ -182,17 +402,142 @@ def get_sample_gender(sample_name):
         return gender
 
 
+def _lims_name_candidates(sample_name):
+    """All the names a sample may have in the Lims, following the substitutions in get_list_of_samples."""
+    candidates = [sample_name]
+    for pattern, repl in substitutions[1:]:
+        candidates.append(pattern.sub(repl, candidates[-1]))
+    return candidates
+
+
+def _match_samples(sample_names, samples):
+    """
+    Map requested sample names to the Lims samples returned by get_list_of_samples
+    :param list sample_names: our internal sample IDs
+    :param list samples: genologics Sample entities
+    :return: dict of sample name to Sample, or None if not found
+    """
+    lims_samples = dict((s.name, s) for s in samples)
+    matched = {}
+    for sample_name in sample_names:
+        matched[sample_name] = None
+        for candidate in _lims_name_candidates(sample_name):
+            if candidate in lims_samples:
+                matched[sample_name] = lims_samples[candidate]
+                break
+    return matched
+
+
+def _expected_md5(headers):
+    """
+    :return: The hex md5 of a download, from its Content-MD5 header or from an ETag that is an md5, or None if
+             neither is reported
+    """
+    if headers.get('Content-MD5'):
+        return base64.b64decode(headers['Content-MD5']).hex()
+    etag = (headers.get('ETag') or '').strip('"')
+    if re.fullmatch(r'[0-9a-fA-F]{32}', etag):
+        return etag.lower()
+
+
+def _file_md5(file_name, chunk_size=65536):
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _download_file(file_id, output_file_name, chunk_size=65536):
+    """
+    Stream a Lims file to disk chunk by chunk, skipping the download if the local file has the checksum reported by
+    the Lims. The download is written to a partial file, checked against the Content-Length and checksum reported
+    by the Lims, and then moved to output_file_name. The partial file is removed if the download fails.
+    :param str file_id: Lims id of the file to download
+    :param str output_file_name: Where to write the file
+    :param int chunk_size: Number of bytes to read and write at a time
+    :return: output_file_name
+    """
+    lims = connection()
+    response = lims.download(lims.get_uri('files', file_id, 'download'))
+    partial_file = output_file_name + '.part'
+    try:
+        lims.validate_response(response)
+        expected_size = response.headers.get('Content-Length')
+        if expected_size is not None:
+            expected_size = int(expected_size)
+        expected_md5 = _expected_md5(response.headers)
+        if expected_md5 and os.path.isfile(output_file_name) and \
+                expected_size in (None, os.path.getsize(output_file_name)) and \
+                _file_md5(output_file_name) == expected_md5:
+            app_logger.debug('%s already downloaded - skipping', output_file_name)
+            return output_file_name
+
+        md5 = hashlib.md5()
+        with open(partial_file, 'wb') as open_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                open_file.write(chunk)
+                md5.update(chunk)
+    except Exception:
+        if os.path.isfile(partial_file):
+            os.remove(partial_file)
+        raise
+    finally:
+        response.close()
+
+    observed_size = os.path.getsize(partial_file)
+    if expected_size is not None and observed_size != expected_size:
+        os.remove(partial_file)
+        raise EGCGError(
+            'Incomplete download of Lims file %s: expected %s bytes, got %s' % (file_id, expected_size, observed_size)
+        )
+    if expected_md5 and md5.hexdigest() != expected_md5:
+        os.remove(partial_file)
+        raise EGCGError(
+            'Corrupt download of Lims file %s: expected md5 %s, got %s' % (file_id, expected_md5, md5.hexdigest())
+        )
+    os.replace(partial_file, output_file_name)
+    return output_file_name
+
+
+def _download_genotype(sample, output_file_name):
+    file_id = sample.udf.get('Genotyping results file id')
+    if file_id:
+        return _download_file(file_id, output_file_name)
+    else:
+        app_logger.warning('Cannot download genotype results for %s', sample.name)
+
+
 def get_sample_genotype(sample_name, output_file_name):
     sample = get_sample(sample_name)
     if sample:
-        file_id = sample.udf.get('Genotyping results file id')
-        if file_id:
-            file_content = connection().get_file_contents(id=file_id)
-            with open(output_file_name, 'w') as open_file:
-                open_file.write(file_content)
-            return output_file_name
-        else:
-            app_logger.warning('Cannot download genotype results for %s', sample_name)
+        return _download_genotype(sample, output_file_name)
+
+
+def get_sample_genotypes(sample_names_and_files, max_workers=4):
+    """
+    Download the genotype results for many samples. The samples are resolved with batch queries and the files
+    are then downloaded concurrently. A failed download is logged and does not stop the others.
+    :param dict sample_names_and_files: sample name to output file name
+    :param int max_workers: Maximum number of concurrent downloads
+    :return: dict of sample name to the downloaded file, or None if not available or if the download failed
+    """
+    sample_names = list(sample_names_and_files)
+    samples = _match_samples(sample_names, get_list_of_samples(sample_names))
+    genotypes = dict((sample_name, None) for sample_name in sample_names)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = dict(
+            (sample_name, pool.submit(_download_genotype, sample, sample_names_and_files[sample_name]))
+            for sample_name, sample in samples.items() if sample
+        )
+        for sample_name, future in futures.items():
+            try:
+                genotypes[sample_name] = future.result()
+            except Exception as e:
+                app_logger.error('Could not download genotype results for %s: %s', sample_name, e)
+
+    return genotypes
 
 
 def get_expected_yield_for_sample(sample_name):
@@ -217,12 +562,51 @@ def get_run(run_id):
     return runs[0]
 
 
-def route_samples_to_delivery_workflow(sample_names):
+def route_samples_to_delivery_workflow(sample_names, chunk_size=None, raise_on_failure=True):
+    """
+    Route the samples' artifacts to the delivery workflow. Samples are resolved with batch queries, and the
+    artifacts are routed in chunks.
+    :param list sample_names: our internal sample IDs
+    :param int chunk_size: Number of artifacts per routing request (default: 'route_chunk_size' in the
+                           clarity config, or 100)
+    :param bool raise_on_failure: Once all chunks have been tried, raise the error of the first failed routing
+                                  request, if any. If False, failed samples are only listed in the report.
+    :return: sample names routed, not found in the Lims, and whose routing request failed
+    :rtype: dict[str, list]
+    :raises: requests.exceptions.RequestException if a routing request failed and raise_on_failure is set
+    """
+    if chunk_size is None:
+        chunk_size = cfg.query('clarity', 'route_chunk_size', ret_default=100)
+
     lims = connection()
-    samples = [get_sample(sample_name) for sample_name in sample_names]
-    artifacts = [sample.artifact for sample in samples]
+    samples = _match_samples(sample_names, get_list_of_samples(list(sample_names)))
+    report = {'routed': [], 'unresolved': [], 'failed': []}
+    errors = []
+    to_route = []
+    for sample_name in sample_names:
+        if samples[sample_name]:
+            to_route.append(sample_name)
+        else:
+            report['unresolved'].append(sample_name)
+
     workflow_uri = lims.get_uri('configuration', 'workflows', '401')
-    lims.route_artifacts(artifacts, workflow_uri=workflow_uri)
+    for start in range(0, len(to_route), chunk_size):
+        chunk = to_route[start:start + chunk_size]
+        # the artifact uri comes with the sample, so there is no need to retrieve the artifacts themselves
+        artifacts = [samples[sample_name].artifact for sample_name in chunk]
+        try:
+            lims.route_artifacts(artifacts, workflow_uri=workflow_uri)
+            report['routed'].extend(chunk)
+        except requests.exceptions.RequestException as e:
+            app_logger.error('Could not route %s samples to %s: %s', len(chunk), workflow_uri, str(e))
+            report['failed'].extend(chunk)
+            errors.append(e)
+
+    if report['unresolved']:
+        app_logger.warning('Could not find %s samples to route: %s', len(report['unresolved']), report['unresolved'])
+    if errors and raise_on_failure:
+        raise errors[0]
+    return report
 
 
 def get_plate_id_and_well(sample_name):
@@ -235,6 +619,12 @@ def get_plate_id_and_well(sample_name):
 
 
 def get_sample_names_from_plate(plate_id):
+    if _snapshot:
+        samples = _snapshot.get_container_samples(plate_id)
+        if samples:
+            return [sanitize_user_id(s.name) for s in samples]
+        return None
+
     containers = connection().get_containers(type='96 well plate', name=plate_id)
     if containers:
         samples = {}
@@ -246,6 +636,8 @@ def get_sample_names_from_plate(plate_id):
 
 
 def get_sample_names_from_project(project_id):
+    if _snapshot:
+        return [sample.name for sample in _snapshot.get_project_samples(project_id)]
     samples = connection().get_samples(projectname=project_id)
     sample_names = [sample.name for sample in samples]
     return sample_names
@@ -307,6 +699,8 @@ def get_sample_release_date(sample_id):
     s = get_sample(sample_id)
     if not s:
         return None
+    if _snapshot:
+        return _snapshot.get_release_date(s.name)
     procs = connection().get_processes(type='Data Release EG 1.0', inputartifactlimsid=s.artifact.id)
     if not procs:
         return None
@@ -1,39 +1,93 @@
+import os
 from .executor import Executor
 from .stream_executor import StreamExecutor
 from .array_executor import ArrayExecutor
-from .cluster_executor import PBSExecutor, SlurmExecutor, stop_running_jobs
+from .cluster_executor import PBSExecutor, SlurmExecutor, stop_running_jobs, stop_jobs_on_signal, reattach
+from .job_registry import JobRegistry
+from .job_graph import JobGraph
+from .command_cache import CommandCache, CachedExecutor, get_cache
+from .worker_pool import WorkerPool, PoolExecutor
 from egcg_core.config import cfg
 from egcg_core.exceptions import EGCGError
 
 
-def local_execute(*cmds, parallel=True):
+def _cached_execute(cache, cmds, run, inputs, outputs, working_dir=None, extra=None):
+    """
+    Start the commands not found in a command cache through run, and return a CachedExecutor recording the ones
+    that succeed.
+    :param cache: True for the cache configured in the executor config, or a CommandCache
+    :param run: Function starting a subset of cmds, taking their indexes
+    """
+    if cache is True:
+        cache = get_cache()
+    e = CachedExecutor(cache, cmds, run, inputs, outputs, working_dir, extra)
+    e.start()
+    return e
+
+
+def _select(config, per_cmd_keys, idxs):
+    """Restrict the per-command lists in a config, e.g. cpus, to the commands at idxs."""
+    config = dict(config)
+    for k in per_cmd_keys:
+        if config.get(k):
+            config[k] = [config[k][i] for i in idxs]
+    return config
+
+
+def local_execute(*cmds, parallel=True, shell=False, timeout=None, cache=None, inputs=None, outputs=None,
+                  **pool_config):
     """
     Execute commands locally
     :param cmds:
     :param parallel: Whether to execute multiple cmds in parallel or sequentially
-    :return: Executor
+    :param shell: Run cmds through Bash - see Executor
+    :param timeout: Seconds after which each command is terminated - see Executor
+    :param cache: Skip the commands that already succeeded with the same inputs, and record those that succeed, in
+                  a CommandCache - True for the one at 'command_cache' in the executor config
+    :param list inputs: Files read by the commands, or a list of files for each command, to key the cache with
+    :param list outputs: Files written by the commands, or a list of files for each command, which must not have
+                         changed for a command to be skipped
+    :param pool_config: max_parallel, cpus, mem, max_mem, total_timeout and fail_fast for running multiple cmds - see
+                        ArrayExecutor
+    :return: Executor, or CachedExecutor if using a cache
     """
+    if cache:
+        def run(idxs):
+            config = _select(pool_config, ('cpus', 'mem'), idxs)
+            return local_execute(*[cmds[i] for i in idxs], parallel=parallel, shell=shell, timeout=timeout, **config)
+        return _cached_execute(cache, cmds, run, inputs, outputs, os.getcwd(), extra={'shell': shell})
+
     if len(cmds) == 1:
         if parallel:
-            e = StreamExecutor(cmds[0])
+            e = StreamExecutor(cmds[0], shell=shell, timeout=timeout)
         else:
-            e = Executor(cmds[0])
+            e = Executor(cmds[0], shell=shell, timeout=timeout)
     else:
-        e = ArrayExecutor(cmds, stream=parallel)
+        e = ArrayExecutor(cmds, stream=parallel, shell=shell, timeout=timeout, **pool_config)
 
     e.start()
     return e
 
 
-def cluster_execute(*cmds, env=None, prelim_cmds=None, **cluster_config):
+def cluster_execute(*cmds, env=None, prelim_cmds=None, cache=None, inputs=None, outputs=None, **cluster_config):
     """
     Execute commands on a compute cluster
     :param cmds:
     :param env: The kind of resource manager being run
     :param prelim_cmds: Any commands to execute before starting a job array
+    :param cache: As local_execute. Cached commands are not submitted, and the job only runs the others.
+    :param list inputs: As local_execute
+    :param list outputs: As local_execute
     :param cluster_config:
-    :return: ClusterExecutor
+    :return: ClusterExecutor, or CachedExecutor if using a cache
     """
+    if cache:
+        def run(idxs):
+            config = _select(cluster_config, ('cmd_costs',), idxs)
+            return cluster_execute(*[cmds[i] for i in idxs], env=env, prelim_cmds=prelim_cmds, **config)
+        return _cached_execute(cache, cmds, run, inputs, outputs, cluster_config.get('working_dir'),
+                               extra={'prelim_cmds': prelim_cmds})
+
     if env is None:
         env = cfg.query('executor', 'job_execution')
 
@@ -49,11 +103,37 @@ def cluster_execute(*cmds, env=None, prelim_cmds=None, **cluster_config):
     return e
 
 
-def execute(*cmds, env=None, prelim_cmds=None, **cluster_config):
+def pool_execute(*cmds, prelim_cmds=None, cache=None, inputs=None, outputs=None, **cluster_config):
+    """
+    Execute commands on the workers of the WorkerPool configured in 'worker_pool' in the executor config
+    :param cmds:
+    :param prelim_cmds: Any commands to execute before each command
+    :param cache: As local_execute
+    :param list inputs: As local_execute
+    :param list outputs: As local_execute
+    :param cluster_config: job_name and working_dir, as cluster_execute. Resource options are ignored.
+    :return: PoolExecutor, or CachedExecutor if using a cache
+    """
+    if cache:
+        def run(idxs):
+            return pool_execute(*[cmds[i] for i in idxs], prelim_cmds=prelim_cmds, **cluster_config)
+        return _cached_execute(cache, cmds, run, inputs, outputs, cluster_config.get('working_dir'),
+                               extra={'prelim_cmds': prelim_cmds})
+
+    e = PoolExecutor(*cmds, prelim_cmds=prelim_cmds, **cluster_config)
+    e.start()
+    return e
+
+
+def execute(*cmds, env=None, prelim_cmds=None, cache=None, inputs=None, outputs=None, **cluster_config):
     if env is None:
         env = cfg.query('executor', 'job_execution')
 
     if env == 'local':
-        return local_execute(*cmds)
+        return local_execute(*cmds, cache=cache, inputs=inputs, outputs=outputs)
+    elif env == 'pool':
+        return pool_execute(*cmds, prelim_cmds=prelim_cmds, cache=cache, inputs=inputs, outputs=outputs,
+                            **cluster_config)
     else:
-        return cluster_execute(*cmds, env=env, prelim_cmds=prelim_cmds, **cluster_config)
+        return cluster_execute(*cmds, env=env, prelim_cmds=prelim_cmds, cache=cache, inputs=inputs, outputs=outputs,
+                               **cluster_config)
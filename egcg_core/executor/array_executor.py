@@ -1,39 +1,159 @@
+import os
+import selectors
+from time import time
+from collections import deque
 from threading import Thread
 from egcg_core.exceptions import EGCGError
+from .executor import timeout_exit_status, cancelled_exit_status
 from .stream_executor import StreamExecutor
 
 
 class ArrayExecutor(StreamExecutor):
-    def __init__(self, cmds, stream):
+    def __init__(self, cmds, stream, max_parallel=None, cpus=None, mem=None, max_mem=None, max_line_rate=None,
+                 sample_every=None, shell=False, timeout=None, total_timeout=None, kill_grace=None, fail_fast=False):
         """
         :param cmds:
         :param bool stream: Whether to run all commands in parallel or one after another
+        :param int max_parallel: Number of slots for running commands in parallel (default: the number of cpus)
+        :param list cpus: Number of slots taken by each command (default: 1 each)
+        :param list mem: Memory needed by each command, in the same unit as max_mem
+        :param max_mem: Memory available to commands running in parallel (default: unlimited)
+        :param int max_line_rate: As StreamExecutor, for each command
+        :param int sample_every: As StreamExecutor, for each command
+        :param bool shell: As Executor, for each command
+        :param float timeout: As Executor, for each command
+        :param float total_timeout: Seconds after which all running commands are terminated as timed out, and
+                                    commands not started yet are not run, with the timeout exit status
+        :param float kill_grace: As Executor
+        :param bool fail_fast: Once a command fails, terminate the running commands and do not start the others.
+                               These have the exit status 143.
         """
-        super().__init__(cmds)
+        super().__init__(cmds, max_line_rate, sample_every, shell, kill_grace=kill_grace)
         self.executors = []
         self.exit_statuses = []
         self.stream = stream
+        self.max_parallel = max_parallel or os.cpu_count() or 1
+        self.cpus = cpus or [1] * len(cmds)
+        self.mem = mem or [0] * len(cmds)
+        self.max_mem = max_mem
+        self.total_timeout = total_timeout
+        self.fail_fast = fail_fast
         for c in cmds:
-            self.executors.append(StreamExecutor(c))
+            self.executors.append(
+                StreamExecutor(c, self.max_line_rate, self.sample_every, shell, timeout, self.kill_grace)
+            )
 
     def run(self):
+        if self.total_timeout:
+            self.deadline = time() + self.total_timeout
         try:
             if self.stream:
-                for e in self.executors:
-                    e.start()
-                for e in self.executors:
-                    self.exit_statuses.append(e.join())
+                self._run_parallel()
             else:
                 for e in self.executors:
+                    skipped_status = self._skipped_status()
+                    if skipped_status:
+                        self.exit_statuses.append(skipped_status)
+                        continue
+                    e.deadline = self.deadline
                     e.start()
                     self.exit_statuses.append(e.join())
         except Exception as err:
             self.exception = err
 
+    def _skipped_status(self):
+        """The exit status to give a command not started yet because of total_timeout or fail_fast, if any."""
+        if self.deadline and time() >= self.deadline:
+            return timeout_exit_status
+        if self.fail_fast and any(self.exit_statuses):
+            return cancelled_exit_status
+
+    def kill(self):
+        for e in self.executors:
+            e.kill()
+
+    def _can_start(self, idx, running):
+        """Whether a command fits in the slots and memory left. A command too big for an empty pool runs alone."""
+        if not running:
+            return True
+        cpus = sum(self.cpus[i] for i in running) + self.cpus[idx]
+        mem = sum(self.mem[i] for i in running) + self.mem[idx]
+        return cpus <= self.max_parallel and (self.max_mem is None or mem <= self.max_mem)
+
+    def _launch(self, idx, selector):
+        """Start a command's subprocess and register its stdout/stderr, prefixed with the command number."""
+        e = self.executors[idx]
+        e.deadline = self.deadline
+        try:
+            proc = e._process()
+        except Exception as err:
+            e.error('Encountered a %s error: %s' % (err.__class__.__name__, str(err)))
+            raise EGCGError('self.proc command failed: ' + e.cmd) from err
+
+        streams = e._output_streams(proc, prefix='[%s] ' % (idx + 1))
+        for stream in streams:
+            selector.register(stream, selectors.EVENT_READ, (idx, streams))
+
+    def _run_parallel(self):
+        """
+        Work queue: start commands in input order while they fit in max_parallel/max_mem, and start the next one
+        each time one finishes. All subprocesses' output is multiplexed in this thread with a selector, so the
+        number of threads does not grow with the number of commands. If a command cannot be started, no more
+        commands are started. The select timeout is the nearest of the running commands' deadlines, so that
+        timeouts are enforced from the same loop.
+        """
+        self.exit_statuses = [None] * len(self.executors)
+        pending = deque(range(len(self.executors)))
+        running = set()
+        exception = None
+        with selectors.DefaultSelector() as selector:
+            while running or (pending and not exception):
+                while pending and not exception:
+                    skipped_status = self._skipped_status()
+                    if skipped_status:
+                        for idx in pending:
+                            self.exit_statuses[idx] = skipped_status
+                        pending.clear()
+                        break
+                    if not self._can_start(pending[0], running):
+                        break
+
+                    idx = pending.popleft()
+                    try:
+                        self._launch(idx, selector)
+                        running.add(idx)
+                    except EGCGError as err:
+                        exception = err
+
+                if not running:  # the last command to start failed
+                    break
+
+                timeouts = [t for t in (self.executors[i]._check_deadline() for i in running) if t is not None]
+                for key, mask in selector.select(min(timeouts) if timeouts else None):
+                    stream = key.fileobj
+                    idx, streams = key.data
+                    if not stream.read():
+                        selector.unregister(stream)
+                        streams.remove(stream)
+                        if not streams:  # both stdout and stderr closed
+                            self.exit_statuses[idx] = self.executors[idx]._wait()
+                            running.remove(idx)
+                            if self.fail_fast and self.exit_statuses[idx]:
+                                for i in running:
+                                    self.executors[i].terminate('cancelled')
+
+        if exception:
+            raise exception
+
+    @property
+    def usages(self):
+        return [e.usage for e in self.executors if e.usage]
+
     def join(self, timeout=None):
         # noinspection PyCallByClass
         Thread.join(self, timeout)
         if self.exception:
+            self.kill()
             self._stop()
             self.error(self.exception.__class__.__name__ + ': ' + str(self.exception))
             raise EGCGError('Commands failed: ' + str(self.exit_statuses))
@@ -1,19 +1,154 @@
+import os
+import json
+import re
+import sys
+import signal
 import subprocess
-from time import sleep
+from math import ceil
+from time import sleep, time
+from threading import Lock, Thread
+from weakref import WeakSet
+from collections import OrderedDict
 from egcg_core.exceptions import EGCGError
-from egcg_core.app_logging import AppLogger
+from egcg_core.app_logging import AppLogger, logging_default as log_cfg
 from egcg_core.config import cfg
 from . import script_writers
+from .resource_usage import ResourceUsage, parse_duration, parse_memory, record_usage
+from .job_registry import get_registry
+from .submission_queue import SubmissionQueue, backoff
 
+app_logger = log_cfg.get_logger('cluster_executor')
 running_executors = {}
-
-
-def stop_running_jobs():
-    for job_id in running_executors:
-        running_executors[job_id].cancel_job()
-
-    for job_id in list(running_executors):
-        running_executors[job_id].join()
+lost_exit_status = 9  # as tasks ending in any state other than COMPLETED on Slurm
+
+
+def stop_running_jobs(timeout=None):
+    """
+    Cancel all running jobs, with one call to the resource manager per ClusterExecutor subclass, then wait for them
+    all concurrently, for at most timeout seconds overall.
+    :param float timeout: Defaults to 'stop_timeout' in the executor config, or 60
+    :return: The exit status of each job, or None for jobs not finished by the deadline
+    :rtype: dict
+    """
+    timeout = timeout or cfg.query('executor', 'stop_timeout', ret_default=60)
+    executors = list(running_executors.values())
+    executors_by_class = OrderedDict()
+    for e in executors:
+        executors_by_class.setdefault(e.__class__, []).append(e)
+    for cls, class_executors in executors_by_class.items():
+        cls.cancel_jobs(class_executors)
+
+    exit_statuses = OrderedDict((e.job_id, None) for e in executors)
+
+    def _join(executor):
+        try:
+            exit_statuses[executor.job_id] = executor.join()
+        except Exception as err:
+            app_logger.error('Could not join job %s: %s', executor.job_id, err)
+
+    threads = [Thread(target=_join, args=(e,), daemon=True) for e in executors]
+    for t in threads:
+        t.start()
+    deadline = time() + timeout
+    for t in threads:
+        t.join(max(deadline - time(), 0))
+
+    unfinished = [job_id for job_id, exit_status in exit_statuses.items() if exit_status is None]
+    if unfinished:
+        app_logger.warning('%s jobs not finished after %ss: %s', len(unfinished), timeout, unfinished)
+    return exit_statuses
+
+
+def stop_jobs_on_signal(*signals, timeout=None):
+    """
+    Install a handler calling stop_running_jobs when receiving any of these signals (default: SIGTERM), then calling
+    the signal's previous handler if any, or exiting with status 128 + the signal number. Must be called from the
+    main thread.
+    :param float timeout: As stop_running_jobs
+    """
+    for signum in signals or (signal.SIGTERM,):
+        previous_handler = signal.getsignal(signum)
+
+        def _handler(received, frame, previous_handler=previous_handler):
+            app_logger.warning('Received signal %s - stopping %s running jobs', received, len(running_executors))
+            stop_running_jobs(timeout)
+            if callable(previous_handler):
+                previous_handler(received, frame)
+            else:
+                sys.exit(128 + received)
+
+        signal.signal(signum, _handler)
+
+
+class JobStatusPoller:
+    """
+    Shared by all running executors of one ClusterExecutor subclass. Queries the resource manager about all of their
+    jobs at once, at most every 'status_max_age' seconds (default: 5), and answers each executor's status checks
+    from the latest reports, so that the number of queries does not grow with the number of jobs. If a query
+    fails, the previous reports are kept until the next one. Likewise, the accounting of finished jobs is queried
+    for all those whose usage has not been read yet at once.
+    """
+    pollers = {}
+    pollers_lock = Lock()
+
+    def __init__(self):
+        self.max_age = cfg.query('executor', 'status_max_age', ret_default=5)
+        self.lock = Lock()
+        self.reports = {}
+        self.queried_job_ids = set()
+        self.last_query = None
+        self.unread_usages = WeakSet()  # finished executors whose accounting has not been queried yet
+
+    @classmethod
+    def for_executor(cls, executor):
+        with cls.pollers_lock:
+            if executor.__class__ not in cls.pollers:
+                cls.pollers[executor.__class__] = cls()
+            return cls.pollers[executor.__class__]
+
+    def report(self, executor):
+        """
+        :param ClusterExecutor executor: Executor to return the report for, and through which to query the resource
+                                         manager if the reports are out of date or do not cover its job
+        :return: The report for executor's job, as built by executor._query_jobs, or None if there is none, e.g. if
+                 the resource manager could not be queried since the job was submitted
+        """
+        with self.lock:
+            if self.last_query is None or time() - self.last_query >= self.max_age or \
+                    executor.job_id not in self.queried_job_ids:
+                job_ids = set(j for j, e in running_executors.items() if e.__class__ is executor.__class__)
+                job_ids.add(executor.job_id)
+                try:
+                    self.reports = executor._query_jobs(sorted(job_ids, key=str))
+                except EGCGError as e:
+                    executor.warning('Could not query job statuses, keeping the previous reports: %s', e)
+                self.queried_job_ids = job_ids
+                self.last_query = time()
+            return self.reports.get(executor.job_id)
+
+    def add_finished(self, executor):
+        """Include executor's job in the next accounting query, until its usage is read."""
+        with self.lock:
+            self.unread_usages.add(executor)
+
+    def usage_report(self, executor):
+        """
+        :param ClusterExecutor executor: Finished executor to return the accounting report for. If it has not been
+                                         queried yet, it is queried along with all the other finished executors'
+        :return: The report for executor's job, as built by executor._query_usage
+        :raises: EGCGError if the resource manager could not be queried, in which case the unread jobs are queried
+                 again at the next call
+        """
+        with self.lock:
+            if executor._usage_report is None:
+                executors = set(self.unread_usages)
+                executors.add(executor)
+                reports = executor._query_usage(sorted(set(e.job_id for e in executors), key=str))
+                for e in executors:
+                    e._usage_report = reports.get(e._job_number(e.job_id), [])
+                    self.unread_usages.discard(e)
+            report, executor._usage_report = executor._usage_report, None
+            return report
 
 
 class ClusterExecutor(AppLogger):
@@ -21,18 +156,54 @@ class ClusterExecutor(AppLogger):
     finished_statuses = None
     unfinished_statuses = None
 
-    def __init__(self, *cmds, prelim_cmds=None, **cluster_config):
+    def __init__(self, *cmds, prelim_cmds=None, retries=None, retry_mem_factor=None, retry_walltime_factor=None,
+                 **cluster_config):
         """
         :param list cmds: Full path to a job submission script
+        :param int retries: Number of times to resubmit the job's failed array tasks (default: 'retries' in the
+                            executor config, or 0)
+        :param float retry_mem_factor: Factor applied to the job's mem at each resubmission (default: 1)
+        :param float retry_walltime_factor: Factor applied to the job's walltime at each resubmission (default: 1)
         """
         self.interval = cfg.query('executor', 'join_interval', ret_default=30)
+        self.min_interval = cfg.query('executor', 'join_min_interval', ret_default=5)
+        self.use_status_files = cfg.query('executor', 'status_files', ret_default=False)
+        self.use_exit_status_files = cfg.query('executor', 'exit_status_files', ret_default=self.use_status_files)
+        self.exit_status_file_interval = cfg.query('executor', 'exit_status_file_interval', ret_default=1)
+        self.max_missing_polls = cfg.query('executor', 'max_missing_polls', ret_default=10)
+        self.missing_polls = 0
+        self.lost = False
         self.job_id = None
         self.job_name = cluster_config.get('job_name')
         self.cmds = cmds
         self.prelim_cmds = prelim_cmds
+        self._usages = None  # collected when first read after the job has finished
+        self._usage_report = None
+        self.finished = False
+        self.retries = retries if retries is not None else cfg.query('executor', 'retries', ret_default=0)
+        self.retry_mem_factor = retry_mem_factor or cfg.query('executor', 'retry_mem_factor', ret_default=1)
+        self.retry_walltime_factor = retry_walltime_factor or cfg.query('executor', 'retry_walltime_factor',
+                                                                        ret_default=1)
+        self.attempts = 0
+        self.cancelled = False
+        self.exit_status = None  # once the job and all its retries have finished
+        self.retry_executor = None
+        self.retry_executors = []  # every resubmission of the job's failed tasks, in order
+        self.retried_tasks = []  # index of the job's task run by each task of retry_executor
+        self.task_exit_statuses = None
+        self.batch = None  # job array this executor's command was submitted in, with other executors'
+        self.batch_index = None
+        self.batch_lock = Lock()
+        self.batch_exit_status = None
+        self.cluster_config = cluster_config
         self.writer = self._get_writer(job_queue=cfg['executor']['job_queue'], **cluster_config)
 
     def write_script(self):
+        if self.use_exit_status_files:
+            self.writer.add_exit_status_trap()
+        if self.use_status_files:
+            self.writer.add_status_recording()
+
         if self.prelim_cmds:
             self.writer.register_cmds(*self.prelim_cmds, parallel=False)
 
@@ -45,37 +216,453 @@ class ClusterExecutor(AppLogger):
         self.writer.add_header()
         self.writer.save()
 
+        for f in self._exit_status_files() + self._status_files():
+            if os.path.isfile(f):  # from a previous run of the same job
+                os.remove(f)
+
     def start(self):
-        """Write the jobs into a script, submit it and capture qsub's output as self.job_id."""
+        """
+        Write the jobs into a script, submit it and capture qsub's output as self.job_id. Submissions go through the
+        process-wide SubmissionQueue, which may instead submit this executor's command as a task of a batch job, in
+        which case self.job_id is the id of this task.
+        """
+        if SubmissionQueue.get().batch(self):
+            self.info('Submitted as task %s of batch job %s', self.batch_index, self.batch.job_id)
+            return
+
         self.write_script()
         self._submit_job()
         running_executors[self.job_id] = self  # register to running_executors
         self.info('Submitted "%s" as job %s' % (self.writer.script_name, self.job_id))
+        registry = get_registry()
+        if registry:
+            config = dict(self.cluster_config, retries=self.retries, retry_mem_factor=self.retry_mem_factor,
+                          retry_walltime_factor=self.retry_walltime_factor)
+            registry.add(self.job_id, self.__class__.__name__, self.job_name, self.writer.script_name, self.cmds,
+                         self.prelim_cmds, config, self.writer.array_tasks)
 
     def join(self):
-        """Wait until the job has finished, then return its exit status."""
-        sleep(5)
-        while not self._job_finished():
-            sleep(self.interval)
-        running_executors.pop(self.job_id, None)  # unregister from running_executors
-        return self._job_exit_code()
+        """
+        Wait until the job has finished, then return its exit status. The resource manager is queried at increasing
+        intervals, from join_min_interval up to join_interval. With exit_status_files, the job's exit status files
+        are also checked every exit_status_file_interval, so that a finished job is noticed without querying the
+        resource manager. With retries, failed array tasks are resubmitted and waited for in turn, and the exit
+        status combines the last attempt of each task. Once the job has finished, its exit status is returned
+        without querying the resource manager again.
+        """
+        if self.exit_status is not None:
+            return self.exit_status
+        if self.batch:
+            self.exit_status = self._batch_task_result(block=True)
+            return self.exit_status
+
+        exit_status = self._task_results(self, self._wait_for_job())
+        while self._retry_needed(exit_status):
+            self._resubmit_failed_tasks()
+            exit_status = self._task_results(self.retry_executor, self.retry_executor._wait_for_job())
+        self.exit_status = exit_status
+        return exit_status
+
+    def poll(self):
+        """
+        Check once whether the job has finished, without waiting. Return its exit status if so, otherwise None. With
+        retries, failed array tasks are resubmitted, and the job is not finished until they are. Once the job has
+        finished, its exit status is returned without querying the resource manager again.
+        """
+        if self.exit_status is not None:
+            return self.exit_status
+        if self.batch:
+            self.exit_status = self._batch_task_result(block=False)
+            return self.exit_status
+
+        executor = self.retry_executor or self
+        exit_status = executor._poll_job()
+        if exit_status is None:
+            return None
+        exit_status = self._task_results(executor, exit_status)
+        if self._retry_needed(exit_status):
+            self._resubmit_failed_tasks()
+            return None
+        self.exit_status = exit_status
+        return exit_status
+
+    def _batch_key(self):
+        """
+        :return: A key shared by the executors that can run as tasks of the same job array, or None if this
+                 executor's job cannot be batched with others
+        """
+        if len(self.cmds) != 1 or any(self.cluster_config.get(k) for k in ('max_concurrent', 'pack_tasks',
+                                                                            'cmd_costs', 'cmd_file')):
+            return None
+        config = dict(self.cluster_config, prelim_cmds=self.prelim_cmds, retries=self.retries,
+                      retry_mem_factor=self.retry_mem_factor, retry_walltime_factor=self.retry_walltime_factor)
+        config.pop('job_name', None)
+        return self.__class__, json.dumps(config, sort_keys=True, default=str)
+
+    def _batch_task_result(self, block):
+        """
+        Exit status of this executor's task in its batch job. The batch job is joined or polled once for all the
+        executors batched in it, and its exit statuses are split per task, from the exit status files or accounting.
+        :param bool block: Wait for the batch job to finish, or return None if it has not
+        """
+        b = self.batch
+        if not b.batch_lock.acquire(blocking=block):  # another executor of the batch is joining it
+            return None
+        try:
+            if b.batch_exit_status is None:
+                b.batch_exit_status = b.join() if block else b.poll()
+                if b.batch_exit_status and b.task_exit_statuses is None:
+                    b.task_exit_statuses = b._task_exit_statuses()
+        finally:
+            b.batch_lock.release()
+
+        if b.batch_exit_status is None:
+            return None
+        if not b.batch_exit_status:
+            return 0
+        if b.task_exit_statuses is None:  # cannot tell which tasks failed
+            return b.batch_exit_status
+        return b.task_exit_statuses.get(self.batch_index, 0)
+
+    def _wait_for_job(self):
+        exit_status = None
+        waited = 0
+        poll_interval = self.min_interval
+        next_poll = poll_interval
+        while exit_status is None:
+            wait = next_poll - waited
+            if self.use_exit_status_files:
+                wait = min(wait, self.exit_status_file_interval)
+            sleep(wait)
+            waited = round(waited + wait, 6)  # so that float errors do not put off the next query
+
+            if self.use_exit_status_files:
+                exit_status = self._exit_status_from_files()
+            if exit_status is None and waited >= next_poll:
+                if self._job_finished():
+                    exit_status = self._finished_exit_code()
+                poll_interval = min(poll_interval * 2, self.interval)
+                next_poll = round(waited + poll_interval, 6)
+
+        self._finish(exit_status)
+        return exit_status
+
+    def _poll_job(self):
+        exit_status = None
+        if self.use_exit_status_files:
+            exit_status = self._exit_status_from_files()
+        if exit_status is None and self._job_finished():
+            exit_status = self._finished_exit_code()
+        if exit_status is not None:
+            self._finish(exit_status)
+        return exit_status
+
+    def _finished_exit_code(self):
+        return lost_exit_status if self.lost else self._job_exit_code()
+
+    def _unregister(self, exit_status=None):
+        """
+        Remove the job from running_executors, and mark it as finished or cancelled in the job registry, so that
+        reattach does not rebuild it. Also used for jobs cancelled without being joined, with no exit status.
+        """
+        running_executors.pop(self.job_id, None)
+        registry = get_registry()
+        if registry:
+            registry.update(self.job_id, 'cancelled' if self.cancelled else 'finished', exit_status)
+
+    def _finish(self, exit_status):
+        self._unregister(exit_status)
+        self.finished = True
+        self._usages = None
+        if not self.use_status_files:
+            self._poller().add_finished(self)
+        if cfg.query('executor', 'usage_ledger'):
+            record_usage(self.usages)
+
+    def _task_results(self, executor, exit_status):
+        """
+        Update the latest exit status of each of the job's array tasks from a finished attempt.
+        :param ClusterExecutor executor: This executor, or the resubmission of its failed tasks
+        :param int exit_status: The exit status of executor's job
+        :return: The exit status of the job, combining the last attempt of each task
+        """
+        if executor is self:
+            if exit_status and self.retries:  # only needed to find out which tasks to retry
+                self.task_exit_statuses = self._task_exit_statuses()
+            return exit_status
+
+        self.retry_executors.append(executor)
+        self.cancelled = self.cancelled or executor.cancelled
+        statuses = executor._task_exit_statuses()
+        retried = set(self.retried_tasks)
+        if statuses is None:  # cannot tell which tasks failed again, so stop retrying
+            previous, self.task_exit_statuses = self.task_exit_statuses, None
+            return sum(s for i, s in previous.items() if i not in retried) + exit_status
+
+        for i in retried:
+            self.task_exit_statuses[i] = 0
+        for retry_idx, s in statuses.items():
+            self.task_exit_statuses[self.retried_tasks[retry_idx - 1]] += s
+        return sum(self.task_exit_statuses.values())
+
+    def _retry_needed(self, exit_status):
+        return bool(exit_status) and not self.cancelled and self.attempts < self.retries and \
+            bool(self.task_exit_statuses) and any(self.task_exit_statuses.values())
+
+    def _resubmit_failed_tasks(self):
+        """
+        Submit a new job running only the commands of the failed array tasks, one per task, with mem and walltime
+        escalated by retry_mem_factor and retry_walltime_factor.
+        """
+        self.attempts += 1
+        failed = sorted(i for i, s in self.task_exit_statuses.items() if s)
+        cmds = []
+        self.retried_tasks = []
+        for i in failed:
+            task_cmds = self.writer.array_tasks[i - 1] if self.writer.array_tasks else self.cmds
+            cmds.extend(task_cmds)
+            self.retried_tasks.extend([i] * len(task_cmds))
+
+        config = dict(self.cluster_config, job_name='%s_retry%s' % (self.job_name, self.attempts), dependencies=None,
+                      pack_tasks=None, cmd_costs=None)
+        if self.cluster_config.get('log_files') and not self.cluster_config.get('pack_tasks'):
+            # one command per task, e.g. a batch job, so the retried commands keep writing to their own log files
+            config['log_files'] = [self.cluster_config['log_files'][i - 1] for i in self.retried_tasks]
+        else:
+            config['log_files'] = None
+        config['mem'] = ceil(self.writer.cluster_config['mem'] * self.retry_mem_factor ** self.attempts)
+        if self.writer.cluster_config.get('walltime'):
+            config['walltime'] = ceil(
+                int(self.writer.cluster_config['walltime']) * self.retry_walltime_factor ** self.attempts
+            )
+
+        self.warning('Resubmitting %s failed tasks of job %s (attempt %s of %s): %s', len(failed), self.job_id,
+                     self.attempts, self.retries, failed)
+        self.retry_executor = self.__class__(*cmds, prelim_cmds=self.prelim_cmds, retries=0, **config)
+        self.retry_executor.start()
+
+    def _task_files(self, base_name):
+        """The files written by each of the job's array tasks, i.e. base_name suffixed with the array index."""
+        if len(self.writer.array_tasks) <= 1:
+            return [base_name]
+        return [base_name + str(i + 1) for i in range(len(self.writer.array_tasks))]
+
+    def _exit_status_files(self):
+        return self._task_files(self.writer.exit_status_file)
+
+    def _status_files(self):
+        return self._task_files(self.writer.status_file)
+
+    def task_statuses(self):
+        """
+        Read the status files written by the job's commands with status_files.
+        :return: For each array task index (1 if not an array), the commands run so far, in order of completion,
+                 as dicts with label, exit_status, start, end and max_rss (kB, None if unknown). Tasks without a
+                 status file yet are absent.
+        :rtype: dict
+        """
+        statuses = {}
+        for idx, f in enumerate(self._status_files()):
+            if not os.path.isfile(f):
+                continue
+            statuses[idx + 1] = []
+            with open(f) as open_file:
+                for line in open_file:
+                    if not line.strip():
+                        continue
+                    label, exit_status, start, end, max_rss = line.split()
+                    statuses[idx + 1].append({
+                        'label': label,
+                        'exit_status': int(exit_status),
+                        'start': float(start),
+                        'end': float(end),
+                        'max_rss': int(max_rss) if max_rss.isdigit() else None
+                    })
+        return statuses
+
+    def _exit_status_from_files(self):
+        """
+        :return: The sum of the exit statuses written by the job, or None if it has not finished writing them
+        """
+        statuses = self._exit_statuses_from_files()
+        if statuses is None:
+            return None
+        self.debug('Found exit status files for job %s', self.job_id)
+        return sum(statuses.values())
+
+    def _exit_statuses_from_files(self):
+        """
+        :return: The exit status written by each array task (1 if not an array), or None if any is missing
+        :rtype: dict
+        """
+        statuses = {}
+        for idx, f in enumerate(self._exit_status_files()):
+            if not os.path.isfile(f):
+                return None
+            with open(f) as open_file:
+                statuses[idx + 1] = int(open_file.read().strip())
+        return statuses
+
+    def _task_exit_statuses(self):
+        """
+        :return: The exit status of each of the finished job's array tasks (1 if not an array), from the exit status
+                 files if complete, otherwise from the resource manager, or None if unknown
+        :rtype: dict
+        """
+        statuses = self._exit_statuses_from_files() if self.use_exit_status_files else None
+        if statuses is None:
+            try:
+                statuses = self._accounting_exit_statuses()
+            except Exception as e:
+                self.warning('Could not get the exit status of each task of job %s: %s', self.job_id, e)
+                return None
+        if statuses is not None and len(statuses) < max(len(self.writer.array_tasks), 1):
+            return None
+        return statuses
+
+    def _accounting_exit_statuses(self):
+        return None
+
+    @property
+    def usages(self):
+        """
+        The resources used by each command, including those of resubmitted tasks. Only collected when first read after
+        the job has finished, or when it finishes if 'usage_ledger' is set in the executor config, so that jobs whose
+        usage is not needed do not query the resource manager's accounting.
+        :rtype: list[ResourceUsage]
+        """
+        if self.batch:
+            usages = [u for u in self.batch.usages if u.job_id == self.job_id]
+            for u in usages:
+                u.job_name = self.job_name
+            return usages
+
+        if self._usages is None and self.finished:
+            self._collect_usage()
+        return (self._usages or []) + [u for e in self.retry_executors for u in e.usages]
+
+    def _collect_usage(self):
+        """
+        Get the resources used by each command, from the status files if complete, otherwise from the resource
+        manager.
+        """
+        try:
+            self._usages = self._usage_from_status_files() if self.use_status_files else None
+            if self._usages is None:
+                self._usages = self._resource_usage()
+        except Exception as e:
+            self.warning('Could not get the resource usage of job %s: %s', self.job_id, e)
+            self._usages = []
+            return
+        self.debug('Resource usage: %s', self._usages)
+
+    def _usage_from_status_files(self):
+        """
+        Build a ResourceUsage for each command from the status files, with its exact exit status, wall time and the
+        peak memory of its array task up to its end. Failed preliminary commands are logged.
+        :return: The usages, or None if a task has not written a status file, e.g. if it was killed before starting
+        """
+        statuses = self.task_statuses()
+        if len(statuses) < len(self._status_files()):
+            return None
+
+        usages = []
+        for idx, task_statuses in sorted(statuses.items()):
+            for s in task_statuses:
+                if s['label'].startswith('prelim'):
+                    if s['exit_status']:
+                        self.warning('Preliminary command %s of task %s exited with status %s',
+                                      s['label'][len('prelim'):], idx, s['exit_status'])
+                    continue
+                usages.append(
+                    ResourceUsage(
+                        self.cmds[int(s['label'][len('cmd'):]) - 1], exit_status=s['exit_status'],
+                        wall_time=s['end'] - s['start'], max_rss=s['max_rss'], job_name=self.job_name,
+                        job_id=self._task_id(idx)
+                    )
+                )
+        return usages
+
+    def _task_id(self, array_index):
+        """Job id of one of the job's array tasks, as reported by the resource manager."""
+        if len(self.writer.array_tasks) <= 1:
+            return self.job_id
+        return '%s_%s' % (self.job_id, array_index)
+
+    def _resource_usage(self):
+        return []
+
+    def _query_usage(self, job_ids):
+        """
+        Query the resource manager's accounting about several finished jobs at once.
+        :param list job_ids:
+        :return: The accounting report of each job, by job number, in the format used by the subclass' _resource_usage
+        :rtype: dict
+        """
+        raise NotImplementedError
 
-    def _get_writer(self, job_name, working_dir, job_queue, walltime=None, cpus=1, mem=2, log_commands=True):
-        return self.script_writer(job_name, working_dir, job_queue, log_commands=log_commands, cpus=cpus, mem=mem, walltime=walltime)
+    def _usage_for_task(self, task_id, array_index):
+        """
+        :param str task_id: Job id of the job or job array task
+        :param array_index: Index of the task in the job array, or None if not an array
+        :rtype: ResourceUsage
+        """
+        if array_index and self.writer.array_tasks:
+            cmd = '; '.join(self.writer.array_tasks[int(array_index) - 1])
+        elif array_index:
+            cmd = self.cmds[int(array_index) - 1]
+        else:
+            cmd = ' '.join(self.cmds)
+        return ResourceUsage(cmd, job_name=self.job_name, job_id=task_id)
+
+    def _get_writer(self, job_name, working_dir, job_queue, walltime=None, cpus=1, mem=2, log_commands=True,
+                    dependencies=None, max_concurrent=None, pack_tasks=None, cmd_costs=None, cmd_file=False,
+                    log_files=None):
+        return self.script_writer(job_name, working_dir, job_queue, log_commands=log_commands, cpus=cpus, mem=mem,
+                                  walltime=walltime, dependencies=dependencies, max_concurrent=max_concurrent,
+                                  pack_tasks=pack_tasks, cmd_costs=cmd_costs, cmd_file=cmd_file, log_files=log_files)
 
     def _job_statuses(self):
         return ()
 
+    def _poller(self):
+        return JobStatusPoller.for_executor(self)
+
+    def _query_jobs(self, job_ids):
+        """
+        Query the resource manager about several jobs at once.
+        :param list job_ids:
+        :return: A report for each job id, in the format used by the subclass' status checks
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _job_number(job_id):
+        """The numeric part of a job id, e.g. '1337' for '1337[2].a_server' or '1337_2'."""
+        return re.match(r'\d*', str(job_id)).group(0) or str(job_id)
+
     def _job_exit_code(self):
         raise NotImplementedError
 
     def _submit_job(self):
-        self.job_id = self._run_and_retry(cfg['executor']['qsub'] + ' ' + self.writer.script_name)
+        """
+        Submit the job script, retrying 'submit_retries' times (default: 5) with a backoff from 'submit_retry_backoff'
+        (default: 2s), i.e. for at least 15s, as a busy resource manager can reject submissions for a while.
+        """
+        self.job_id = self._run_and_retry(cfg['executor']['qsub'] + ' ' + self.writer.script_name,
+                                          retry=cfg.query('executor', 'submit_retries', ret_default=5),
+                                          limiter=SubmissionQueue.get().limiter,
+                                          backoff_base=cfg.query('executor', 'submit_retry_backoff', ret_default=2))
         if self.job_id is None:
             raise EGCGError('Job submission failed')
 
     def _job_finished(self):
         statuses = self._job_statuses()
+        if not statuses:  # no record of the job, e.g. if the resource manager could not be queried
+            return self._job_missing()
+
+        self.missing_polls = 0
         for s in statuses:
             if s in self.finished_statuses:
                 pass
@@ -85,6 +672,18 @@ class ClusterExecutor(AppLogger):
                 raise EGCGError('Bad job status: %s', s)
         return True
 
+    def _job_missing(self):
+        """
+        Count the status checks without any record of the job, and consider it finished as lost after
+        'max_missing_polls' (default: 10) in a row, rather than waiting for it forever.
+        """
+        self.missing_polls += 1
+        if self.missing_polls < self.max_missing_polls:
+            return False
+        self.warning('No record of job %s in %s status checks - assuming it failed', self.job_id, self.missing_polls)
+        self.lost = True
+        return True
+
     def _get_stdout(self, cmd):
         p = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         exit_status = p.wait()
@@ -95,19 +694,58 @@ class ClusterExecutor(AppLogger):
         else:
             return o.decode('utf-8').strip()
 
-    def _run_and_retry(self, cmd, retry=3):
+    def _run_and_retry(self, cmd, retry=3, limiter=None, backoff_base=None):
+        """
+        Run a resource manager command, retrying it with exponential backoff if it fails.
+        :param TokenBucket limiter: Rate limit to apply to each attempt, e.g. for submissions
+        :param float backoff_base: Wait after the first attempt (default: 'retry_backoff' in the executor config)
+        :return: The command's stdout, or None if all attempts failed
+        """
         attempt = 0
         while attempt < retry:
+            if limiter:
+                limiter.acquire()
             msg = self._get_stdout(cmd)
             if msg is not None:
                 return msg
-            sleep(5)
             attempt += 1
+            if attempt < retry:
+                sleep(backoff(attempt, backoff_base))
 
     def cancel_job(self):
-        if not self._job_finished():
+        self.cancelled = True
+        if self.batch:  # cancel this executor's task only
+            if self._batch_task_result(block=False) is None:
+                self._cancel_job()
+        elif self.retry_executor:
+            self.retry_executor.cancel_job()
+        elif not self._job_finished():
             self._cancel_job()
 
+    @classmethod
+    def cancel_jobs(cls, executors):
+        """Cancel the jobs of several executors of this class. Subclasses cancel them all in one command."""
+        for e in executors:
+            e.cancel_job()
+
+    @classmethod
+    def _cancel_all(cls, executors, cancel_cmd):
+        """
+        Run one cancel_cmd for all executors' jobs, without checking whether they have finished. If this fails, e.g.
+        because the resource manager rejects a finished job, cancel the jobs one by one.
+        """
+        if not executors:
+            return
+        for e in executors:
+            e.cancelled = True
+        msg = executors[0]._get_stdout(cancel_cmd + ' ' + ' '.join(e.job_id for e in executors))
+        if msg is None:
+            app_logger.warning('Could not cancel %s jobs at once - cancelling them one by one', len(executors))
+            for e in executors:
+                e.cancel_job()
+        elif msg:
+            app_logger.info(msg)
+
     def _cancel_job(self):
         raise NotImplementedError
 
@@ -118,8 +756,25 @@ class PBSExecutor(ClusterExecutor):
     finished_statuses = 'FXM'
 
     def _qstat(self):
-        data = self._run_and_retry('qstat -xt {j}'.format(j=self.job_id)).split('\n')
-        return [d for d in data[2:] if d]
+        return self._poller().report(self) or []
+
+    def _query_jobs(self, job_ids):
+        """
+        Query 'qstat -xt' for all job_ids at once.
+        :return: qstat's report lines for each job and its subjobs, empty for jobs not in qstat
+        :raises: EGCGError if qstat failed
+        """
+        reports = dict((j, []) for j in job_ids)
+        job_numbers = dict((self._job_number(j), j) for j in job_ids)
+        data = self._run_and_retry('qstat -xt ' + ' '.join(str(j) for j in job_ids))
+        if data is None:
+            raise EGCGError('qstat failed for jobs ' + ' '.join(str(j) for j in job_ids))
+        for line in data.split('\n')[2:]:
+            if line.strip():
+                job_id = job_numbers.get(self._job_number(line.split()[0]))
+                if job_id in reports:
+                    reports[job_id].append(line)
+        return reports
 
     def _job_statuses(self):
         statuses = set()
@@ -135,10 +790,62 @@ class PBSExecutor(ClusterExecutor):
             exit_status += self.finished_statuses.index(s)
         return exit_status
 
+    def _qstat_full(self, job_ids):
+        """
+        Parse the full report of 'qstat -xf -t', e.g. 'resources_used.walltime = 01:02:03', for each subjob.
+        :param list job_ids:
+        :return: The job id, array index (None if not an array) and attributes of each subjob
+        """
+        data = self._run_and_retry('qstat -xf -t ' + ' '.join(job_ids))
+        reports = []
+        for report in data.split('Job Id: ')[1:]:
+            lines = report.split('\n')
+            task_id = lines[0].strip()
+            if '[]' in task_id:  # the array itself, rather than one of its subjobs
+                continue
+            attrs = dict(l.strip().split(' = ', 1) for l in lines[1:] if ' = ' in l)
+            array_index = re.search(r'\[(\d+)\]', task_id)
+            reports.append((task_id, array_index.group(1) if array_index else None, attrs))
+        return reports
+
+    def _accounting_exit_statuses(self):
+        statuses = {}
+        for task_id, array_index, attrs in self._qstat_full([self.job_id]):
+            if 'Exit_status' in attrs:
+                statuses[int(array_index or 1)] = int(attrs['Exit_status'])
+        return statuses
+
+    def _query_usage(self, job_ids):
+        reports = {}
+        for subjob in self._qstat_full(job_ids):
+            reports.setdefault(self._job_number(subjob[0]), []).append(subjob)
+        return reports
+
+    def _resource_usage(self):
+        usages = []
+        for task_id, array_index, attrs in self._poller().usage_report(self):
+            usage = self._usage_for_task(task_id, array_index)
+            if 'Exit_status' in attrs:
+                usage.exit_status = int(attrs['Exit_status'])
+            usage.wall_time = parse_duration(attrs.get('resources_used.walltime'))
+            usage.user_time = parse_duration(attrs.get('resources_used.cput'))  # PBS only reports user + system
+            usage.max_rss = parse_memory(attrs.get('resources_used.mem'))
+            usages.append(usage)
+        return usages
+
+    def _task_id(self, array_index):
+        if len(self.writer.array_tasks) <= 1:
+            return self.job_id
+        return self.job_id.replace('[]', '[%s]' % array_index)
+
     def _cancel_job(self):
         msg = self._run_and_retry('qdel ' + self.job_id)
         self.info(msg)
 
+    @classmethod
+    def cancel_jobs(cls, executors):
+        cls._cancel_all(executors, 'qdel')
+
 
 class SlurmExecutor(ClusterExecutor):
     script_writer = script_writers.SlurmWriter
@@ -152,19 +859,54 @@ class SlurmExecutor(ClusterExecutor):
         self.job_id = self.job_id.split()[-1].strip()
 
     def _sacct(self, output_format):
-        data = self._run_and_retry('sacct -nX -j {j} -o {o}'.format(j=self.job_id, o=output_format))
-        return set(d.strip() for d in data.split('\n'))
+        """
+        :param str output_format: Comma-separated sacct fields, out of State and ExitCode
+        :return: The distinct values of these fields for the job's array tasks, separated by spaces
+        """
+        return set(' '.join(row[f] for f in output_format.split(',')) for row in self._report()['sacct'])
 
     def _squeue(self):
-        s = self._run_and_retry('squeue -h -j {j} -o %T'.format(j=self.job_id))
-        if s:
-            return set(s.split('\n'))
+        return self._report()['squeue'] or None
+
+    def _report(self):
+        return self._poller().report(self) or {'squeue': set(), 'sacct': []}
+
+    def _query_jobs(self, job_ids):
+        """
+        Query squeue for all job_ids at once, then sacct for those no longer in squeue.
+        :return: For each job id, the states of its array tasks in squeue, and their State/ExitCode in sacct
+        :raises: EGCGError if sacct failed, as the state of jobs not in squeue is then unknown
+        """
+        reports = dict((j, {'squeue': set(), 'sacct': []}) for j in job_ids)
+        data = self._run_and_retry('squeue -h -j {j} -o %F|%T'.format(j=','.join(job_ids)))
+        for line in (data or '').split('\n'):
+            if '|' in line:
+                job_id, state = line.strip().split('|')
+                if job_id in reports:
+                    reports[job_id]['squeue'].add(state)
+
+        finished = [j for j in job_ids if not reports[j]['squeue']]
+        if finished:
+            data = self._run_and_retry('sacct -nXP -j {j} -o JobID,State,ExitCode'.format(j=','.join(finished)))
+            if data is None:
+                raise EGCGError('sacct failed for jobs ' + ','.join(finished))
+            for line in data.split('\n'):
+                if '|' in line:
+                    job_id, state, exit_code = line.strip().split('|')
+                    job_id = self._job_number(job_id)
+                    if job_id in reports:  # e.g. 'CANCELLED by 1234' -> 'CANCELLED'
+                        reports[job_id]['sacct'].append(
+                            {'JobID': line.split('|')[0], 'State': state.split()[0], 'ExitCode': exit_code}
+                        )
+        return reports
 
     def _job_statuses(self):
         s = self._squeue()
         if s:  # job is in squeue, so use that
             return s
-        return set(s.rstrip('+') for s in self._sacct('State'))  # job no longer in squeue, so use sacct
+        s = self._sacct('State')  # job no longer in squeue, so use sacct
+        # if not in sacct yet either, e.g. just after submission, the job is missing until it appears
+        return set(state.rstrip('+') for state in s)
 
     def _job_exit_code(self):
         exit_status = 0
@@ -172,18 +914,107 @@ class SlurmExecutor(ClusterExecutor):
         reports = self._sacct('State,ExitCode')
         for r in reports:
             state, exit_code = r.split()
-            state = state.rstrip('+')
-            states.add(state)
-            exit_code = int(exit_code.split(':')[0])
-            if state == 'CANCELLED' and not exit_code:  # cancelled jobs can still be exit status 0
-                self.debug('Found a cancelled job - using exit status 9')
-                exit_code = 9
-            exit_status += exit_code
+            states.add(state.rstrip('+'))
+            exit_status += self._task_exit_code(state, exit_code)
 
         self.info('Got %s states from %s (%s) with %s jobs: %s', len(states), self.job_name, self.job_id,
                   len(reports), states)
         return exit_status
 
+    def _task_exit_code(self, state, exit_code):
+        """
+        :param str state: The State of a job or array task in sacct
+        :param str exit_code: Its ExitCode, e.g. '1:0'
+        """
+        state = state.rstrip('+')
+        exit_code = int(exit_code.split(':')[0])
+        if state != 'COMPLETED' and not exit_code:  # cancelled, failed nodes, etc. can still be exit status 0
+            self.debug('Found a %s job - using exit status 9', state)
+            exit_code = 9
+        return exit_code
+
+    def _accounting_exit_statuses(self):
+        statuses = {}
+        for row in self._report()['sacct']:
+            array_index = re.search(r'_(\d+)$', row['JobID'])
+            statuses[int(array_index.group(1)) if array_index else 1] = self._task_exit_code(row['State'],
+                                                                                              row['ExitCode'])
+        return statuses
+
+    def _resource_usage(self):
+        """
+        Parse sacct's report for each job array task and its steps, e.g. '123_4|65|00:10.5|00:01.2||0:0|COMPLETED'
+        followed by '123_4.batch|65|00:10.5|00:01.2|2048K|0:0|COMPLETED'. Times are reported for the whole task and
+        memory for each step. Exit statuses are as _task_exit_code, so that cancelled tasks do not look successful.
+        """
+        usages = {}
+        for line in self._poller().usage_report(self):
+            job_id, elapsed, user_time, sys_time, max_rss, exit_code, state = line.strip().split('|')
+            task_id, _, step = job_id.partition('.')
+            if task_id not in usages:
+                array_index = task_id.split('_')[1] if '_' in task_id else None
+                usages[task_id] = self._usage_for_task(task_id, array_index)
+            usage = usages[task_id]
+
+            if not step:
+                usage.exit_status = self._task_exit_code(state.split()[0], exit_code)  # e.g. 'CANCELLED by 1234'
+                usage.wall_time = parse_duration(elapsed)
+                usage.user_time = parse_duration(user_time)
+                usage.sys_time = parse_duration(sys_time)
+            max_rss = parse_memory(max_rss)
+            if max_rss:
+                usage.max_rss = max(usage.max_rss or 0, max_rss)
+        return list(usages.values())
+
+    def _query_usage(self, job_ids):
+        """
+        Query sacct about the array tasks and steps of all job_ids at once.
+        :return: The lines of sacct's report for each job number
+        :raises: EGCGError if sacct failed
+        """
+        data = self._run_and_retry(
+            'sacct -nP -j {j} -o JobID,ElapsedRaw,UserCPU,SystemCPU,MaxRSS,ExitCode,State'.format(j=','.join(job_ids))
+        )
+        if data is None:
+            raise EGCGError('sacct failed for jobs ' + ','.join(job_ids))
+        reports = {}
+        for line in data.split('\n'):
+            if line.strip():
+                reports.setdefault(self._job_number(line.split('|')[0]), []).append(line.strip())
+        return reports
+
     def _cancel_job(self):
         msg = self._run_and_retry('scancel ' + self.job_id)
         self.info(msg)
+
+    @classmethod
+    def cancel_jobs(cls, executors):
+        cls._cancel_all(executors, 'scancel')
+
+
+executor_classes = {'PBSExecutor': PBSExecutor, 'SlurmExecutor': SlurmExecutor}
+
+
+def reattach(registry=None):
+    """
+    Rebuild the executors of the jobs still running according to the job registry, e.g. after the process that
+    submitted them has restarted, and register them to running_executors, so that they can be joined, polled or
+    stopped as if just submitted, without submitting them again. Jobs already finished or cancelled are skipped.
+    :param JobRegistry registry: Defaults to the registry in the executor config
+    :return: The rebuilt executors, in order of submission
+    :rtype: list[ClusterExecutor]
+    """
+    registry = registry or get_registry()
+    if registry is None:
+        raise EGCGError('No job registry to reattach jobs from')
+
+    executors = []
+    for job in registry.jobs(state='running'):
+        cls = executor_classes[job['executor']]
+        e = cls(*job['cmds'], prelim_cmds=job['prelim_cmds'], **job['config'])
+        e.job_id = job['job_id']
+        e.writer.array_tasks = job['array_tasks']
+        running_executors[e.job_id] = e
+        executors.append(e)
+        app_logger.info('Reattached to job %s (%s)', e.job_id, e.job_name)
+    return executors
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from time import time
+from egcg_core.app_logging import AppLogger
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+
+caches = {}
+caches_lock = threading.Lock()
+env_var_pattern = re.compile(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)')
+
+
+def get_cache(index_file=None):
+    """
+    :param str index_file: Defaults to 'command_cache' in the executor config
+    :return: The process-wide CommandCache for this file
+    :raises: EGCGError if no cache index is configured
+    """
+    index_file = index_file or cfg.query('executor', 'command_cache')
+    if not index_file:
+        raise EGCGError('No command cache index configured')
+    with caches_lock:
+        if index_file not in caches:
+            caches[index_file] = CommandCache(index_file)
+        return caches[index_file]
+
+
+def per_command(paths, ncmds):
+    """
+    :param list paths: Paths declared for all commands, or a list of paths for each command
+    :return: A list of paths for each command
+    """
+    if paths and all(isinstance(p, (list, tuple)) for p in paths):
+        if len(paths) != ncmds:
+            raise EGCGError('Got %s lists of paths for %s commands' % (len(paths), ncmds))
+        return [list(p) for p in paths]
+    return [list(paths or [])] * ncmds
+
+
+class CommandCache(AppLogger):
+    """
+    Local sqlite index of the commands that completed successfully, with the size and modification time of their
+    declared output files. A command is keyed by its string, its working directory, the environment variables it
+    depends on and the size/mtime, or content hash, of its declared input files, so that a command is only skipped
+    if it would run the same way on the same inputs and its outputs have not changed since.
+    """
+    def __init__(self, index_file, hash_inputs=None, env_vars=None):
+        """
+        :param str index_file: sqlite file to keep the index in
+        :param bool hash_inputs: Key input files by their sha256 rather than their size and mtime (default:
+                                 'cache_hash_inputs' in the executor config)
+        :param list env_vars: Environment variables to key all commands by, in addition to PATH and those referred
+                              to in each command (default: 'cache_env_vars' in the executor config)
+        """
+        self.index_file = index_file
+        if hash_inputs is None:
+            hash_inputs = cfg.query('executor', 'cache_hash_inputs', ret_default=False)
+        self.hash_inputs = hash_inputs
+        self.env_vars = env_vars or cfg.query('executor', 'cache_env_vars', ret_default=[])
+        import sqlite3  # only needed if a cache is used
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(index_file, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS commands (key text PRIMARY KEY, cmd text, outputs text, '
+                        'recorded real)')
+        self.db.commit()
+
+    @staticmethod
+    def file_stat(path):
+        """:return: The size and mtime of a file, or None if it does not exist"""
+        try:
+            s = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [s.st_size, s.st_mtime_ns]
+
+    @staticmethod
+    def file_hash(path):
+        """:return: The sha256 hex digest of a file, or None if it does not exist"""
+        h = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    h.update(chunk)
+        except FileNotFoundError:
+            return None
+        return h.hexdigest()
+
+    def key(self, cmd, inputs=None, working_dir=None, extra=None):
+        """
+        :param str cmd:
+        :param list inputs: Files read by the command
+        :param str working_dir: Directory the command runs in (default: the current directory)
+        :param extra: Anything else the result depends on, e.g. preliminary commands, as a json-serialisable object
+        :rtype: str
+        """
+        signature = self.file_hash if self.hash_inputs else self.file_stat
+        env_vars = sorted(set(['PATH'] + list(self.env_vars) + env_var_pattern.findall(cmd)))
+        content = {
+            'cmd': cmd,
+            'working_dir': os.path.abspath(working_dir or os.getcwd()),
+            'env': [(v, os.environ.get(v)) for v in env_vars],
+            'inputs': [(os.path.abspath(i), signature(i)) for i in sorted(inputs or [])],
+            'extra': extra
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def is_cached(self, key):
+        """:return: Whether a command has completed with this key, and its output files have not changed since"""
+        with self.lock:
+            rows = self.db.execute('SELECT outputs FROM commands WHERE key=?', (key,)).fetchall()
+        if not rows:
+            return False
+        return all(self.file_stat(path) == stat for path, stat in json.loads(rows[0][0]).items())
+
+    def record(self, key, cmd, outputs=None):
+        """
+        Record a successful command with the current state of its output files.
+        :return: False if an output file is missing, in which case nothing is recorded
+        """
+        output_stats = dict((os.path.abspath(o), self.file_stat(o)) for o in outputs or [])
+        missing = [o for o, stat in output_stats.items() if stat is None]
+        if missing:
+            self.warning('Not caching command %s, as its outputs are missing: %s', cmd, missing)
+            return False
+
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO commands VALUES (?, ?, ?, ?)',
+                            (key, cmd, json.dumps(output_stats), time()))
+        return True
+
+    def invalidate(self, key):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM commands WHERE key=?', (key,))
+
+    def close(self):
+        self.db.close()
+
+
+class CachedExecutor(AppLogger):
+    """
+    Runs only the commands of an execute call that are not already in a CommandCache, through the executor returned
+    by run, and records the commands that succeed. Attributes not defined here, e.g. job_id, are the executor's.
+    """
+    def __init__(self, cache, cmds, run, inputs=None, outputs=None, working_dir=None, extra=None):
+        """
+        :param CommandCache cache:
+        :param list cmds:
+        :param run: Function starting the commands at a list of indexes in cmds and returning their executor
+        :param list inputs: Input files of all commands, or a list of input files for each command
+        :param list outputs: Output files of all commands, or a list of output files for each command
+        :param str working_dir: As CommandCache.key
+        :param extra: As CommandCache.key
+        """
+        self.cache = cache
+        self.cmds = cmds
+        self.run = run
+        self.outputs = per_command(outputs, len(cmds))
+        self.keys = [cache.key(c, i, working_dir, extra) for c, i in zip(cmds, per_command(inputs, len(cmds)))]
+        self.to_run = []
+        self.executor = None
+        self.exit_status = None
+
+    def __getattr__(self, item):
+        if item == 'executor':  # not set yet
+            raise AttributeError(item)
+        return getattr(self.executor, item)
+
+    @property
+    def usages(self):
+        return self.executor.usages if self.executor else []
+
+    def start(self):
+        for idx, (cmd, key) in enumerate(zip(self.cmds, self.keys)):
+            if self.cache.is_cached(key):
+                self.info('Skipping cached command: %s', cmd)
+            else:
+                self.to_run.append(idx)
+
+        if self.to_run:
+            self.executor = self.run(self.to_run)
+
+    def join(self):
+        if self.executor:
+            self._finish(self.executor.join())
+        else:
+            self.exit_status = 0
+        return self.exit_status
+
+    def poll(self):
+        """:return: As ClusterExecutor.poll, for cluster jobs"""
+        if self.executor and self.exit_status is None:
+            exit_status = self.executor.poll()
+            if exit_status is not None:
+                self._finish(exit_status)
+        elif not self.executor:
+            self.exit_status = 0
+        return self.exit_status
+
+    def _finish(self, exit_status):
+        self.exit_status = exit_status
+        for idx, cmd_exit_status in zip(self.to_run, self._cmd_exit_statuses(exit_status)):
+            if cmd_exit_status == 0:
+                self.cache.record(self.keys[idx], self.cmds[idx], self.outputs[idx])
+
+    def _cmd_exit_statuses(self, exit_status):
+        """:return: The exit status of each command run, None where unknown"""
+        if exit_status == 0:
+            return [0] * len(self.to_run)
+        if len(self.to_run) == 1:
+            return [exit_status]
+        if getattr(self.executor, 'exit_statuses', None):  # ArrayExecutor
+            return self.executor.exit_statuses
+
+        # cluster jobs: exact per command with status files or one command per array task, last attempt last
+        usage_statuses = dict((u.cmd, u.exit_status) for u in self.executor.usages or [])
+        return [usage_statuses.get(self.cmds[idx]) for idx in self.to_run]
@@ -1,13 +1,140 @@
+import os
+import signal
 import subprocess
-import shlex
+from time import time, sleep
+from collections import deque
+from selectors import DefaultSelector, EVENT_READ
 from egcg_core.app_logging import AppLogger
+from egcg_core.config import cfg
 from egcg_core.exceptions import EGCGError
+from .pipeline import Pipeline, new_process_group, parse_command, read_output
+from .resource_usage import wait_for, local_usage, record_usage
+
+
+timeout_exit_status = 124  # as GNU timeout
+cancelled_exit_status = 143  # as a shell reports a command terminated by SIGTERM
+
+
+class OutputStream:
+    """
+    Reads a subprocess' pipe in chunks, reassembles the chunks into lines and passes each line to emit. Carriage
+    returns, as in progress bars, also end a line, and overlong lines are cut. Logging can be limited to a number
+    of lines per second and/or to one line in every sample_every, with a summary of what was not logged.
+    """
+    chunk_size = 65536
+    max_line_length = 65536
+
+    def __init__(self, stream, emit, prefix='', max_line_rate=None, sample_every=None, tee=None):
+        """
+        :param stream: File object of the pipe to read from
+        :param emit: Function to call on each line, e.g. a log method
+        :param str prefix: String to prepend to each line
+        :param int max_line_rate: Maximum number of lines to emit per second
+        :param int sample_every: Only emit one line in every sample_every
+        :param tee: Binary file object to also write all the data read to
+        """
+        self.stream = stream
+        self.emit = emit
+        self.prefix = prefix
+        self.max_line_rate = max_line_rate
+        self.sample_every = sample_every or 1
+        self.tee = tee
+        self.partial = b''
+        self.nlines = 0
+        self.nemitted = 0
+        self.window_start = 0
+        self.window_lines = 0
+        self.window_skipped = 0
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def read(self):
+        """
+        Read one chunk, which does not block once select has reported the stream as readable.
+        :return: False if the stream has reached EOF and has been closed, otherwise True
+        """
+        data = os.read(self.fileno(), self.chunk_size)
+        if not data:
+            if self.partial:
+                self._add_line(self.partial)
+                self.partial = b''
+            if self.nemitted < self.nlines:
+                self.emit('%s%s lines of output, %s logged' % (self.prefix, self.nlines, self.nemitted))
+            self.stream.close()
+            return False
+
+        if self.tee:
+            self.tee.write(data)
+        lines = (self.partial + data).replace(b'\r', b'\n').split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._add_line(line)
+        while len(self.partial) > self.max_line_length:
+            self._add_line(self.partial[:self.max_line_length])
+            self.partial = self.partial[self.max_line_length:]
+        return True
+
+    def _add_line(self, line):
+        if not line.strip():
+            return
+        self.nlines += 1
+        if (self.nlines - 1) % self.sample_every:
+            return
+
+        if self.max_line_rate:
+            now = time()
+            if now - self.window_start >= 1:
+                if self.window_skipped:
+                    self.emit('%s%s lines not logged' % (self.prefix, self.window_skipped))
+                self.window_start = now
+                self.window_lines = 0
+                self.window_skipped = 0
+            if self.window_lines >= self.max_line_rate:
+                self.window_skipped += 1
+                return
+            self.window_lines += 1
+
+        self.nemitted += 1
+        self.emit(self.prefix + line.decode('utf-8', errors='replace').strip())
 
 
 class Executor(AppLogger):
-    def __init__(self, cmd):
+    def __init__(self, cmd, capture=None, log_file=None, tail_lines=50, shell=False, timeout=None, kill_grace=None):
+        """
+        :param str cmd: A shell command to be executed. Pipes and redirection of stdin/stdout are run as a
+                        Pipeline, and commands with any other shell syntax, e.g. '&&', variables or globs, are
+                        run with Bash as with shell=True, so that they are interpreted as Bash would either way
+        :param str capture: How join handles the command's output. By default, it is buffered in memory and
+                            logged when the command finishes. With 'file', it is written to log_file as it comes,
+                            and with 'discard' it is dropped. In both cases, only the last tail_lines of stdout
+                            and stderr are kept in memory, and logged if the command fails.
+        :param str log_file: File to write stdout and stderr to with capture='file'
+        :param int tail_lines: Number of lines of stdout/stderr to keep with capture='file' or 'discard'
+        :param bool shell: Run cmd with 'bash -o pipefail -c', for Bash constructs such as process substitution
+        :param float timeout: Seconds after which the command's process group is sent SIGTERM, then SIGKILL after
+                              kill_grace seconds. A timed out command has the exit status 124.
+        :param float kill_grace: Default: 'kill_grace' in the executor config, or 10
+        """
+        if capture not in (None, 'file', 'discard'):
+            raise EGCGError('Invalid capture mode: %s' % capture)
+        if capture == 'file' and not log_file:
+            raise EGCGError('A log file is needed to capture output to file')
+
         self.cmd = cmd
+        self.shell = shell
         self.proc = None
+        self.start_time = None
+        self.usage = None
+        self.timeout = timeout
+        self.kill_grace = kill_grace or cfg.query('executor', 'kill_grace', ret_default=10)
+        self.deadline = None
+        self.exit_reason = None
+        self._kill_time = None
+        self.capture = capture
+        self.log_file = log_file
+        self.stdout_tail = deque(maxlen=tail_lines)
+        self.stderr_tail = deque(maxlen=tail_lines)
 
     def join(self):
         """
@@ -16,11 +143,16 @@ class Executor(AppLogger):
         :raises: EGCGError on any exception
         """
         try:
-            out, err = self._process().communicate()
+            if self.capture:
+                return self._capture_output()
+
+            proc = self._process()
+            out, err = read_output(proc.stdout, proc.stderr, self._check_deadline)
+            exit_status = self._wait()
             for stream, emit in ((out, self.info), (err, self.error)):
                 for line in stream.decode('utf-8').split('\n'):
                     emit(line)
-            return self.proc.poll()
+            return exit_status
 
         except Exception as e:
             raise EGCGError('Command failed: ' + self.cmd) from e
@@ -28,6 +160,32 @@ class Executor(AppLogger):
     def start(self):
         raise NotImplementedError
 
+    def _capture_output(self):
+        """Read stdout/stderr chunk by chunk into the tail buffers, writing them to self.log_file if needed."""
+        proc = self._process()
+        log_file = open(self.log_file, 'wb') if self.capture == 'file' else None
+        try:
+            with DefaultSelector() as selector:
+                selector.register(OutputStream(proc.stdout, self.stdout_tail.append, tee=log_file), EVENT_READ)
+                selector.register(OutputStream(proc.stderr, self.stderr_tail.append, tee=log_file), EVENT_READ)
+                while selector.get_map():
+                    for key, mask in selector.select(self._check_deadline()):
+                        if not key.fileobj.read():
+                            selector.unregister(key.fileobj)
+        finally:
+            if log_file:
+                log_file.close()
+
+        exit_status = self._wait()
+        if exit_status:
+            self.error('Command exited with status %s: %s', exit_status, self.cmd)
+            if isinstance(proc, Pipeline):
+                self.error('Pipeline stage exit statuses: %s', proc.returncodes)
+            for stream, tail in (('stdout', self.stdout_tail), ('stderr', self.stderr_tail)):
+                for line in tail:
+                    self.error('%s: %s', stream, line)
+        return exit_status
+
     def _process(self):
         """
         Translate self.cmd to a subprocess. Override to manipulate how the process is run, e.g. with different
@@ -35,6 +193,118 @@ class Executor(AppLogger):
         :rtype: subprocess.Popen
         """
         self.info('Executing: ' + self.cmd)
-        # TODO: explore how to run commands with Bash constructs , e.g. 'command <(sub command)'
-        self.proc = subprocess.Popen(shlex.split(self.cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.start_time = time()
+        if self.timeout:
+            self.deadline = min(d for d in (self.deadline, self.start_time + self.timeout) if d)
+
+        # each command runs in its own process group, so that it can be signalled with everything it spawned
+        if self.shell:
+            return self._shell_process()
+
+        try:
+            stages, stdin_file, stdout_file, append = parse_command(self.cmd)
+        except (EGCGError, ValueError) as e:  # e.g. '&&', '$HOME', '*.txt' or unbalanced quotes
+            self.debug('Running command with Bash: %s', e)
+            return self._shell_process()
+
+        if len(stages) == 1 and not stdin_file and not stdout_file:
+            self.proc = subprocess.Popen(
+                stages[0], stdout=subprocess.PIPE, stderr=subprocess.PIPE, **new_process_group
+            )
+        else:
+            self.proc = Pipeline(stages, stdin_file, stdout_file, append)
+        return self.proc
+
+    def _shell_process(self):
+        self.proc = subprocess.Popen(
+            ['bash', '-o', 'pipefail', '-c', self.cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            **new_process_group
+        )
         return self.proc
+
+    def _wait(self):
+        """
+        Wait for self.proc, record its wall time, CPU time and peak memory in self.usage and in the usage ledger, if
+        configured, and return its exit status.
+        """
+        if self.usage is None:
+            procs = self._procs()
+            if self.deadline or self._kill_time:
+                while not all(self._exited(p) for p in procs):
+                    sleep(min(self._check_deadline() or 0.1, 0.1))
+
+            rusages = [wait_for(p) for p in procs]
+            if isinstance(self.proc, Pipeline):
+                self.proc.wait()
+            self.usage = local_usage(self.cmd, procs, rusages, self.start_time)
+            if self.exit_reason == 'timeout':
+                self.usage.exit_status = timeout_exit_status
+            elif self.exit_reason == 'cancelled':
+                self.usage.exit_status = cancelled_exit_status
+            self.debug('Resource usage: %s', self.usage)
+            record_usage([self.usage])
+        return self.usage.exit_status
+
+    def _procs(self):
+        return self.proc.procs if isinstance(self.proc, Pipeline) else [self.proc]
+
+    @staticmethod
+    def _exited(proc):
+        """Whether a process has finished, without reaping it so that _wait can still get its resource usage."""
+        return proc.returncode is not None or os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+
+    def _signal(self, sig):
+        """Send a signal to the process group of each of self.proc's processes still running."""
+        for p in self._procs():
+            if p.returncode is None:
+                try:
+                    os.killpg(p.pid, sig)
+                except (ProcessLookupError, PermissionError):  # already finished
+                    pass
+
+    def terminate(self, reason='cancelled'):
+        """
+        Send SIGTERM to the command, escalating to SIGKILL if it is still running after kill_grace seconds.
+        :param str reason: 'timeout' or 'cancelled', which decides the exit status reported
+        """
+        if self.proc is None or self.exit_reason:
+            return
+        self.warning('Terminating command (%s): %s', reason, self.cmd)
+        self.exit_reason = reason
+        self._signal(signal.SIGTERM)
+        self._kill_time = time() + self.kill_grace
+
+    def kill(self):
+        """Send SIGKILL to the command straight away."""
+        if self.proc is not None:
+            self._signal(signal.SIGKILL)
+
+    def _check_deadline(self):
+        """
+        Terminate the command if it is past its deadline, and kill it if it is past its kill grace period.
+        :return: Seconds until this needs checking again, or None if it does not
+        """
+        now = time()
+        if self.deadline and not self.exit_reason:
+            if now < self.deadline:
+                return self.deadline - now
+            self.terminate('timeout')
+        if self._kill_time:
+            if now < self._kill_time:
+                return self._kill_time - now
+            self.warning('Killing command: %s', self.cmd)
+            self.kill()
+            self._kill_time = None
+
+    @property
+    def usages(self):
+        """Resource usage of each command run, as a list of ResourceUsage."""
+        return [self.usage] if self.usage else []
+
+    @property
+    def stage_exit_statuses(self):
+        """Exit status of each stage of a Pipeline, or of the single process otherwise."""
+        if isinstance(self.proc, Pipeline):
+            return self.proc.returncodes
+        if self.proc:
+            return [self.proc.returncode]
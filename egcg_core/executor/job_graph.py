@@ -0,0 +1,150 @@
+from time import sleep
+from collections import OrderedDict
+from egcg_core.app_logging import AppLogger
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+from .cluster_executor import PBSExecutor, SlurmExecutor
+
+
+class JobGraph(AppLogger):
+    """
+    Submits a pipeline of cluster jobs all at once, each job depending on the success of the jobs it needs through
+    the resource manager (afterok), so that queueing overlaps with running work. Jobs are added in order, after the
+    jobs they depend on, so the graph has no cycles. While joining, the state of every job is tracked, and when a
+    job fails, all the jobs depending on it, directly or not, are cancelled. Jobs depending on a job with retries
+    are held until it has succeeded, as their afterok dependency would only cover its first attempt.
+
+        graph = JobGraph()
+        graph.add_job('align', 'bwa mem ...', working_dir=working_dir)
+        graph.add_job('call', 'gatk ...', depends_on=['align'], working_dir=working_dir, mem=16)
+        graph.start()
+        graph.join()
+    """
+    executor_classes = {'pbs': PBSExecutor, 'slurm': SlurmExecutor}
+
+    def __init__(self, env=None):
+        """
+        :param str env: The kind of resource manager being run (default: 'job_execution' in the executor config)
+        """
+        env = env or cfg.query('executor', 'job_execution')
+        if env not in self.executor_classes:
+            raise EGCGError('Job graphs are not supported in execution environment: %s' % env)
+        self.executor_cls = self.executor_classes[env]
+        self.interval = cfg.query('executor', 'join_min_interval', ret_default=5)
+        self.jobs = OrderedDict()
+        self.dependencies = {}
+        self.executors = {}
+        self.states = {}
+        self.exit_statuses = {}
+
+    def add_job(self, name, *cmds, depends_on=(), prelim_cmds=None, **cluster_config):
+        """
+        :param str name: Unique name of the job in the graph, also used as job_name unless given
+        :param cmds: As cluster_execute
+        :param list depends_on: Names of jobs already added that need to succeed before this one starts
+        :param list prelim_cmds: As cluster_execute
+        :param cluster_config: As cluster_execute
+        :return: The job's name
+        """
+        if name in self.jobs:
+            raise EGCGError('Job %s is already in the graph' % name)
+        unknown = [d for d in depends_on if d not in self.jobs]
+        if unknown:
+            raise EGCGError('Job %s depends on jobs not in the graph: %s' % (name, unknown))
+
+        cluster_config.setdefault('job_name', name)
+        self.jobs[name] = (cmds, prelim_cmds, cluster_config)
+        self.dependencies[name] = list(depends_on)
+        self.states[name] = 'pending'
+        return name
+
+    def dependants(self, name):
+        """All the jobs depending on a job, directly or not, in submission order."""
+        found = set([name])
+        for job in self.jobs:  # jobs come after their dependencies, so a single pass is enough
+            if found.intersection(self.dependencies[job]):
+                found.add(job)
+        found.remove(name)
+        return [j for j in self.jobs if j in found]
+
+    def start(self):
+        """Submit all jobs that can be, in order, with each one's dependencies on the jobs it needs."""
+        self._submit_ready_jobs()
+
+    def _ready(self, name):
+        """
+        Whether a pending job can be submitted, i.e. whether each of its dependencies has finished, or is submitted
+        without retries, in which case the job can depend on it with afterok.
+        """
+        for d in self.dependencies[name]:
+            if self.states[d] == 'finished':
+                continue
+            if self.states[d] != 'submitted' or self.executors[d].retries:
+                return False
+        return True
+
+    def _submit_ready_jobs(self):
+        for name, (cmds, prelim_cmds, cluster_config) in self.jobs.items():
+            # not cancelled because a dependency failed, and not held by a dependency that may be retried
+            if self.states[name] != 'pending' or not self._ready(name):
+                continue
+
+            dependencies = [self.executors[d].job_id for d in self.dependencies[name]
+                            if self.states[d] == 'submitted']
+            e = self.executor_cls(*cmds, prelim_cmds=prelim_cmds, dependencies=dependencies, **cluster_config)
+            try:
+                e.start()
+            except EGCGError as err:
+                self.error('Could not submit job %s: %s', name, err)
+                self._set_failed(name, None)
+                continue
+            self.executors[name] = e
+            self.states[name] = 'submitted'
+
+    def join(self):
+        """
+        Wait until all jobs have finished or have been cancelled, submitting the held ones as they become ready.
+        :return: The sum of the exit statuses of the jobs that have run
+        """
+        while True:
+            running = [n for n in self.jobs if self.states[n] == 'submitted']
+            if not running:
+                break
+            sleep(self.interval)
+            for name in running:
+                if self.states[name] != 'submitted':  # cancelled by a failure earlier in this round
+                    continue
+                exit_status = self.executors[name].poll()
+                if exit_status is None:
+                    continue
+
+                self.exit_statuses[name] = exit_status
+                if exit_status:
+                    self._set_failed(name, exit_status)
+                else:
+                    self.info('Job %s finished', name)
+                    self.states[name] = 'finished'
+            self._submit_ready_jobs()
+
+        self.info('Job states: %s', self.states)
+        return sum(s for s in self.exit_statuses.values() if s)
+
+    def _set_failed(self, name, exit_status):
+        self.error('Job %s failed with exit status %s - cancelling its dependants', name, exit_status)
+        self.states[name] = 'failed'
+        for d in self.dependants(name):
+            self._cancel(d)
+
+    def _cancel(self, name):
+        if self.states[name] == 'submitted':
+            e = self.executors[name]
+            e.cancelled = True
+            e._cancel_job()
+            e._unregister()  # not joined, so not unregistered by _finish
+        if self.states[name] in ('pending', 'submitted'):
+            self.states[name] = 'cancelled'
+
+    def cancel(self):
+        """Cancel all jobs not finished yet."""
+        for name in self.jobs:
+            self._cancel(name)
@@ -0,0 +1,91 @@
+import json
+import threading
+from time import time
+from egcg_core.config import cfg
+
+registries = {}
+registries_lock = threading.Lock()
+
+
+def get_registry(db_file=None):
+    """
+    :param str db_file: Defaults to 'job_registry' in the executor config
+    :return: The process-wide JobRegistry for this file, or None if no registry is configured
+    """
+    db_file = db_file or cfg.query('executor', 'job_registry')
+    if not db_file:
+        return None
+    with registries_lock:
+        if db_file not in registries:
+            registries[db_file] = JobRegistry(db_file)
+        return registries[db_file]
+
+
+class JobRegistry:
+    """
+    On-disk sqlite record of the jobs submitted by cluster executors: what they run, how they were configured, and
+    their state ('running', 'finished' or 'cancelled') and exit status. Jobs still running can be picked up again
+    with cluster_executor.reattach after the submitting process restarts.
+    """
+    columns = ('job_id', 'executor', 'job_name', 'script', 'cmds', 'prelim_cmds', 'config', 'array_tasks', 'state',
+               'exit_status', 'submitted', 'updated')
+    json_columns = ('cmds', 'prelim_cmds', 'config', 'array_tasks')
+
+    def __init__(self, db_file):
+        import sqlite3  # only needed if a registry is used
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (job_id text PRIMARY KEY, executor text, job_name text, script text, '
+            'cmds text, prelim_cmds text, config text, array_tasks text, state text, exit_status integer, '
+            'submitted real, updated real)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+        self.db.commit()
+
+    def add(self, job_id, executor, job_name, script, cmds, prelim_cmds, config, array_tasks):
+        """
+        Register a newly submitted job as running.
+        :param str executor: Name of the ClusterExecutor subclass that submitted the job
+        :param dict config: Arguments to rebuild the executor with, besides cmds and prelim_cmds
+        :param list array_tasks: The commands of each of the job's array tasks
+        """
+        now = time()
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, executor, job_name, script, json.dumps(list(cmds)), json.dumps(prelim_cmds),
+                 json.dumps(config), json.dumps(array_tasks), 'running', None, now, now)
+            )
+
+    def update(self, job_id, state, exit_status=None):
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE jobs SET state=?, exit_status=?, updated=? WHERE job_id=?', (state, exit_status, time(), job_id)
+            )
+
+    def _build(self, row):
+        job = dict(zip(self.columns, row))
+        for c in self.json_columns:
+            job[c] = json.loads(job[c])
+        return job
+
+    def get(self, job_id):
+        """:return: The job as a dict with the keys in self.columns, or None if not registered"""
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM jobs WHERE job_id=?', (job_id,)).fetchall()
+        if rows:
+            return self._build(rows[0])
+
+    def jobs(self, state=None):
+        """:return: All jobs, or those in a given state, in order of submission"""
+        with self.lock:
+            if state:
+                rows = self.db.execute('SELECT * FROM jobs WHERE state=? ORDER BY submitted', (state,)).fetchall()
+            else:
+                rows = self.db.execute('SELECT * FROM jobs ORDER BY submitted').fetchall()
+        return [self._build(r) for r in rows]
+
+    def close(self):
+        self.db.close()
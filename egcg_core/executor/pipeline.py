@@ -0,0 +1,223 @@
+import os
+import re
+import sys
+import shlex
+import subprocess
+from selectors import DefaultSelector, EVENT_READ
+from egcg_core.exceptions import EGCGError
+
+supported_operators = ('|', '<', '>', '>>')
+operator_chars = '|<>&;()'
+expansion_chars = '$`*?[{~#'  # expanded or interpreted by a shell outside quotes, e.g. variables, globs, comments
+quoted_expansion_chars = '$`'  # also expanded inside double quotes
+
+# Popen arguments starting a process in its own process group, so that it can be signalled with everything it
+# spawned, but in the same session, so that it keeps the controlling terminal, e.g. for Ctrl-C
+if sys.version_info >= (3, 11):
+    new_process_group = {'process_group': 0}
+else:
+    new_process_group = {'preexec_fn': os.setpgrp}
+
+
+def _split_operators(cmd):
+    """
+    Split cmd on unquoted, unescaped operator characters.
+    :return: alternating word strings and operators, starting and ending with a word string
+    :rtype: list[str]
+    """
+    parts = []
+    current = ''
+    quote = None
+    i = 0
+    while i < len(cmd):
+        c = cmd[i]
+        if c == '\\' and quote != "'" and i + 1 < len(cmd):
+            current += cmd[i:i + 2]
+            i += 1
+        elif quote:
+            current += c
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+            current += c
+        elif c in operator_chars:
+            op = c
+            while i + 1 < len(cmd) and cmd[i + 1] in operator_chars:
+                i += 1
+                op += cmd[i]
+            parts.extend([current, op])
+            current = ''
+        else:
+            current += c
+        i += 1
+    parts.append(current)
+    return parts
+
+
+def _find_expansion(cmd):
+    """
+    :return: The first character of cmd that a shell would expand or interpret rather than pass on as it is, e.g.
+             '$' in '$HOME' or '"$HOME"', or '*' in '*.txt' but not in '"*.txt"', or None if there is none
+    """
+    quote = None
+    i = 0
+    while i < len(cmd):
+        c = cmd[i]
+        if c == '\\' and quote != "'":
+            i += 1
+        elif quote:
+            if c == quote:
+                quote = None
+            elif quote == '"' and c in quoted_expansion_chars:
+                return c
+        elif c in '\'"':
+            quote = c
+        elif c in expansion_chars:
+            return c
+        i += 1
+    return None
+
+
+def parse_command(cmd):
+    """
+    Split a command into pipeline stages, e.g. 'samtools view x.bam | gzip > y.gz'. Only pipes and redirection
+    of the pipeline's stdin/stdout of plain words are supported - anything else, including variables, globs, '~'
+    or environment assignments, needs a shell, which Executor falls back to so that the command means the same
+    as it would in Bash.
+    :param str cmd:
+    :return: list of stages' args, file to read stdin from, file to write stdout to, whether to append to it
+    :rtype: tuple[list[list[str]], str, str, bool]
+    """
+    expansion = _find_expansion(cmd)
+    if expansion:
+        raise EGCGError('Unsupported shell expansion "%s" in: %s - needs a shell' % (expansion, cmd))
+
+    parts = _split_operators(cmd)
+    stages = [shlex.split(parts[0])]
+    stdin_file = stdout_file = None
+    append = False
+    for i in range(1, len(parts), 2):
+        op = parts[i]
+        words = shlex.split(parts[i + 1])
+        if op not in supported_operators:
+            raise EGCGError('Unsupported shell construct "%s" in: %s - needs a shell' % (op, cmd))
+
+        if op == '|':
+            if not stages[-1] or stdout_file:
+                raise EGCGError('Invalid pipeline: ' + cmd)
+            stages.append(words)
+            continue
+
+        if not words:
+            raise EGCGError('Missing file for redirection "%s" in: %s' % (op, cmd))
+        if re.search(r'(^|\s)\d+$', parts[i - 1]) and op != '<':
+            raise EGCGError('Unsupported redirection of a file descriptor in: %s - needs a shell' % cmd)
+        if op == '<':
+            if len(stages) > 1:
+                raise EGCGError('Only the first stage of a pipeline can read from a file: ' + cmd)
+            stdin_file = words[0]
+        else:
+            stdout_file = words[0]
+            append = op == '>>'
+        stages[-1].extend(words[1:])
+
+    if not stages[-1]:
+        raise EGCGError('Invalid pipeline: ' + cmd)
+    if any(re.match(r'[A-Za-z_]\w*=', stage[0]) for stage in stages):
+        raise EGCGError('Unsupported environment assignment in: %s - needs a shell' % cmd)
+    return stages, stdin_file, stdout_file, append
+
+
+def read_output(stdout, stderr, get_timeout=None):
+    """
+    Read two pipes until EOF without blocking on either, then close them.
+    :param get_timeout: Function returning the maximum number of seconds to wait for output before calling it again
+    """
+    out = {stdout: [], stderr: []}
+    with DefaultSelector() as selector:
+        for stream in out:
+            selector.register(stream, EVENT_READ)
+        while selector.get_map():
+            for key, mask in selector.select(get_timeout() if get_timeout else None):
+                data = os.read(key.fileobj.fileno(), 65536)
+                if data:
+                    out[key.fileobj].append(data)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+    return b''.join(out[stdout]), b''.join(out[stderr])
+
+
+class Pipeline:
+    """
+    Chain of subprocesses connected by OS pipes, with no intermediate files, exposing the parts of the
+    subprocess.Popen interface used by the executors. All stages write their stderr to one shared pipe, and each
+    runs in its own process group. The exit status follows Bash's pipefail: the last non-zero exit status of any stage,
+    otherwise 0.
+    """
+    def __init__(self, stages, stdin_file=None, stdout_file=None, append=False):
+        self.procs = []
+        self.returncodes = None
+        self.returncode = None
+        stderr_read, stderr_write = os.pipe()
+        stdin = open(stdin_file, 'rb') if stdin_file else None
+        try:
+            for i, args in enumerate(stages):
+                if i == len(stages) - 1 and stdout_file:
+                    stdout = open(stdout_file, 'ab' if append else 'wb')
+                else:
+                    stdout = subprocess.PIPE
+
+                proc = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr_write,
+                                        **new_process_group)
+                self.procs.append(proc)
+                if stdin is not None:
+                    stdin.close()  # leave it open only in the stage reading it, so that SIGPIPE propagates upstream
+                stdin = proc.stdout if stdout is subprocess.PIPE else None
+                if stdout is not subprocess.PIPE:
+                    stdout.close()
+        except Exception:
+            for p in self.procs:
+                p.kill()
+            os.close(stderr_read)
+            raise
+        finally:
+            os.close(stderr_write)
+
+        if stdin is None:  # stdout written to a file, so give readers a pipe that is already at EOF
+            stdout_read, stdout_write = os.pipe()
+            os.close(stdout_write)
+            stdin = os.fdopen(stdout_read, 'rb')
+        self.stdout = stdin
+        self.stderr = os.fdopen(stderr_read, 'rb')
+
+    @property
+    def pid(self):
+        return self.procs[-1].pid
+
+    def _set_returncode(self):
+        self.returncodes = [p.returncode for p in self.procs]
+        non_zero = [r for r in self.returncodes if r]
+        self.returncode = non_zero[-1] if non_zero else 0
+
+    def poll(self):
+        if all(p.poll() is not None for p in self.procs):
+            self._set_returncode()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        for p in self.procs:
+            p.wait(timeout)
+        self._set_returncode()
+        return self.returncode
+
+    def kill(self):
+        for p in self.procs:
+            p.kill()
+
+    def communicate(self):
+        """Read the pipeline's stdout and stderr until EOF, then wait for all stages."""
+        out, err = read_output(self.stdout, self.stderr)
+        self.wait()
+        return out, err
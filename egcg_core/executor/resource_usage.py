@@ -0,0 +1,157 @@
+import os
+import json
+from math import ceil
+from time import time, strftime
+from egcg_core.config import cfg
+
+
+class ResourceUsage:
+    """
+    Resources used by one command: wall time, user/system CPU time (in seconds) and peak resident memory (in kB).
+    Fields not reported by the source, e.g. system time on PBS, are None.
+    """
+    fields = ('cmd', 'job_name', 'job_id', 'exit_status', 'wall_time', 'user_time', 'sys_time', 'max_rss')
+
+    def __init__(self, cmd, exit_status=None, wall_time=None, user_time=None, sys_time=None, max_rss=None,
+                 job_name=None, job_id=None):
+        self.cmd = cmd
+        self.exit_status = exit_status
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.sys_time = sys_time
+        self.max_rss = max_rss
+        self.job_name = job_name
+        self.job_id = job_id
+
+    @property
+    def cpu_time(self):
+        if self.user_time is not None:
+            return self.user_time + (self.sys_time or 0)
+
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.fields))
+
+
+def exit_code(status):
+    """Translate a status from os.wait4 into an exit status, negative for a signal as in subprocess."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_for(proc):
+    """
+    Wait for a subprocess.Popen, reaping it with os.wait4 to get its resource usage, and set its returncode.
+    :return: the process' resource.struct_rusage, or None if it has already been reaped elsewhere
+    """
+    if proc.returncode is not None:
+        return None
+    try:
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:  # reaped elsewhere in the meantime
+        proc.wait()
+        return None
+    proc.returncode = exit_code(status)
+    return rusage
+
+
+def local_usage(cmd, procs, rusages, start_time):
+    """
+    Build a ResourceUsage for a command run as one or more concurrent processes, e.g. pipeline stages. CPU times
+    are summed, and so are the processes' peak memory, giving an upper bound on the command's peak memory.
+    :param list procs: Finished subprocess.Popen objects
+    :param list rusages: Each process' resource.struct_rusage, or None if unknown
+    """
+    known = [r for r in rusages if r is not None]
+    non_zero = [p.returncode for p in procs if p.returncode]
+    usage = ResourceUsage(cmd, exit_status=non_zero[-1] if non_zero else 0, wall_time=time() - start_time)
+    if known:
+        usage.user_time = sum(r.ru_utime for r in known)
+        usage.sys_time = sum(r.ru_stime for r in known)
+        usage.max_rss = sum(r.ru_maxrss for r in known)  # kB on Linux
+    return usage
+
+
+def parse_duration(duration):
+    """
+    Parse a duration as reported by sacct or qstat, e.g. '1-02:03:04', '02:03:04', '03:04.567' or '65', into
+    seconds.
+    """
+    if not duration:
+        return None
+    days = 0
+    if '-' in duration:
+        days, duration = duration.split('-')
+    seconds = 0
+    for part in duration.split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(days) * 86400 + seconds
+
+
+def parse_memory(mem):
+    """Parse a memory amount as reported by sacct or qstat, e.g. '2048K', '1.5G' or '123456kb', into kB."""
+    if not mem:
+        return None
+    mem = mem.lower().rstrip('b')
+    units = {'k': 1, 'm': 1024, 'g': 1024 ** 2, 't': 1024 ** 3}
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(float(mem) / 1024)  # plain bytes
+
+
+def record_usage(usages, ledger_file=None):
+    """
+    Append ResourceUsages as JSON lines to a ledger.
+    :param list[ResourceUsage] usages:
+    :param str ledger_file: Defaults to 'usage_ledger' in the executor config. If neither is set, nothing is written.
+    """
+    ledger_file = ledger_file or cfg.query('executor', 'usage_ledger')
+    if not ledger_file or not usages:
+        return
+    timestamp = strftime('%Y-%m-%d %H:%M:%S')
+    with open(ledger_file, 'a') as f:
+        for u in usages:
+            f.write(json.dumps(dict(u.to_dict(), timestamp=timestamp)) + '\n')
+
+
+def read_ledger(ledger_file=None, job_name=None):
+    """
+    :param str ledger_file: Defaults to 'usage_ledger' in the executor config
+    :param str job_name: Only return entries for this job name
+    :rtype: list[ResourceUsage]
+    """
+    ledger_file = ledger_file or cfg.query('executor', 'usage_ledger')
+    usages = []
+    with open(ledger_file) as f:
+        for line in f:
+            entry = json.loads(line)
+            if job_name is None or entry.get('job_name') == job_name:
+                usages.append(ResourceUsage(**dict((k, entry.get(k)) for k in ResourceUsage.fields)))
+    return usages
+
+
+def suggest_resources(job_name, ledger_file=None, headroom=1.2):
+    """
+    Suggest cluster resources for a job from the peak usage of its previous successful runs in the ledger.
+    :param str job_name:
+    :param str ledger_file:
+    :param float headroom: Factor to apply to the observed peaks
+    :return: cpus, mem (in gb) and walltime (in hours), as taken by ClusterExecutor/ScriptWriter, or None if there
+             is no history for this job
+    :rtype: dict
+    """
+    usages = [u for u in read_ledger(ledger_file, job_name) if u.exit_status == 0 and u.wall_time]
+    if not usages:
+        return None
+
+    max_rss = max(u.max_rss or 0 for u in usages)
+    max_wall_time = max(u.wall_time for u in usages)
+    max_cpus = max((u.cpu_time or 0) / u.wall_time for u in usages)
+    return {
+        'cpus': max(1, ceil(max_cpus * headroom)),
+        'mem': max(1, ceil(max_rss * headroom / 1024 ** 2)),
+        'walltime': max(1, ceil(max_wall_time * headroom / 3600))
+    }
@@ -1,7 +1,93 @@
+import heapq
+import shlex
 from os.path import join
 from egcg_core.app_logging import AppLogger
 from egcg_core.exceptions import EGCGError
 
+# Runs each argument as a command in a subshell, at most $1 at a time, and returns the last non-zero exit status of
+# the commands, in their order, like pipefail. The number of failed commands is written to stderr, as a count would
+# be truncated modulo 256 in the exit status
+run_packed_function = '''run_packed() {
+    local max=$1 failed=0 status=0 pids=() pid cmd
+    shift
+    for cmd in "$@"; do
+        while [ $(jobs -rp | wc -l) -ge $max ]; do
+            wait -n
+        done
+        ( eval "$cmd" ) &
+        pids+=($!)
+    done
+    for pid in "${pids[@]}"; do
+        wait $pid || { status=$?; failed=$((failed + 1)); }
+    done
+    if [ $failed -gt 0 ]; then
+        echo "run_packed: $failed of ${#pids[@]} commands failed" >&2
+    fi
+    return $status
+}'''
+
+# Run by every command of a job when recording statuses: 'record_status <label> <command>' runs the command, then
+# appends a line to $EGCG_STATUS_FILE with the label, exit status, start and end times, and the peak memory (kB)
+# used by the job so far, read from its memory cgroup if available. Job array commands run in a subshell, so that
+# they are recorded even if they call exit
+record_status_function = '''peak_rss() {
+    local cgroup f
+    cgroup=$( (grep ':memory:' /proc/self/cgroup || grep '^0::' /proc/self/cgroup) 2>/dev/null | head -n 1)
+    cgroup=${cgroup#*:*:}
+    for f in "/sys/fs/cgroup/memory$cgroup/memory.max_usage_in_bytes" "/sys/fs/cgroup$cgroup/memory.peak"; do
+        if [ -r "$f" ]; then
+            echo $(($(cat "$f") / 1024))
+            return
+        fi
+    done
+    echo -
+}
+record_status() {
+    local _rs_start _rs_exit_status
+    _rs_start=$(date +%s.%N)
+    if [[ $1 == cmd* ]]; then
+        ( eval "$2" )
+    else
+        eval "$2"
+    fi
+    _rs_exit_status=$?
+    echo "$1 $_rs_exit_status $_rs_start $(date +%s.%N) $(peak_rss)" >> "$EGCG_STATUS_FILE"
+    return $_rs_exit_status
+}'''
+
+
+def pack_commands(ncmds, ntasks, costs=None):
+    """
+    Group commands into at most ntasks job array tasks. Without costs, consecutive commands are grouped in chunks of
+    even size. With a cost for each command, e.g. its expected run time, commands are assigned from the most costly
+    to the least loaded task (longest processing time first), which balances the tasks' total costs.
+    :param int ncmds: Number of commands
+    :param int ntasks: Maximum number of tasks
+    :param list costs: Optional cost of each command
+    :return: Indexes of the commands in each task
+    :rtype: list[list[int]]
+    """
+    ntasks = max(1, min(ntasks, ncmds))
+    if costs is None:
+        size, extra = divmod(ncmds, ntasks)
+        groups = []
+        start = 0
+        for t in range(ntasks):
+            end = start + size + (1 if t < extra else 0)
+            groups.append(list(range(start, end)))
+            start = end
+        return groups
+
+    if len(costs) != ncmds:
+        raise EGCGError('Got %s costs for %s commands' % (len(costs), ncmds))
+    groups = [[] for _ in range(ntasks)]
+    loads = [(0, t) for t in range(ntasks)]
+    for i in sorted(range(ncmds), key=lambda i: costs[i], reverse=True):
+        load, t = heapq.heappop(loads)
+        groups[t].append(i)
+        heapq.heappush(loads, (load + costs[i], t))
+    return [sorted(g) for g in groups if g]
+
 
 class ScriptWriter(AppLogger):
     """
@@ -19,30 +105,53 @@ class ScriptWriter(AppLogger):
     )
     walltime_header = '# walltime: {walltime}'
     array_header = '# job array: 1-{jobs}'
+    dependency_header = '# dependencies: afterok:{dependencies}'
     suffix = '.sh'
     array_index = 'JOB_INDEX'
 
     def __init__(self, job_name, working_dir, job_queue, log_commands=True, **cluster_config):
         """
         :param str job_name: Desired full path to the pbs script to write
+        :param cluster_config: Resources and options for the job: cpus, mem, walltime, dependencies (list of job
+                               ids), max_concurrent (maximum number of array tasks running at once), pack_tasks
+                               (maximum number of array tasks to pack the commands into) and cmd_costs (cost of each
+                               command, used to balance packed tasks), cmd_file (write the job array's commands
+                               to a command file instead of the script) and log_files (log file of each command of
+                               the job array, instead of the job's log file suffixed with the command's number)
         """
         self.script_name = join(working_dir, job_name + self.suffix)
         self.log_commands = log_commands
         self.working_dir = working_dir
         self.log_file = join(self.working_dir, job_name + '.log')
+        self.exit_status_file = join(self.working_dir, job_name + '.exit')
+        self.cmd_file = join(self.working_dir, job_name + '.cmds')
+        self.offsets_file = join(self.working_dir, job_name + '.offsets')
+        self.status_file = join(self.working_dir, job_name + '.status')
+        self.record_status = False
+        self.prelim_cmds_written = 0
         self.info('Writing job "%s" in %s', job_name, working_dir)
         self.lines = []
         self.array_jobs_written = 0
+        self.array_tasks = []
         self.cluster_config = dict(cluster_config, job_name=job_name, log_file=self.log_file, job_queue=job_queue)
 
-    def register_cmd(self, cmd, log_file=None):
+    def register_cmd(self, cmd, log_file=None, label=None):
+        """
+        :param str label: Label of the command in the status file, if recording statuses (default: 'prelim<n>')
+        """
         if log_file:
             cmd += ' > %s 2>&1' % log_file
-        self.add_line(cmd)
+        if self.record_status and not label:
+            self.prelim_cmds_written += 1
+            label = 'prelim%s' % self.prelim_cmds_written
+        self.add_line(self._recorded(cmd, label))
 
     def register_cmds(self, *cmds, parallel):
         if parallel:
             self.add_job_array(*cmds)
+        elif self.record_status:
+            for cmd in cmds:
+                self.register_cmd(cmd)
         else:
             self.lines.extend(list(cmds))
 
@@ -50,20 +159,84 @@ class ScriptWriter(AppLogger):
         if self.array_jobs_written != 0:
             raise EGCGError('Already written a job array - can only have one per script')
 
+        pack_tasks = self.cluster_config.get('pack_tasks')
+        if pack_tasks:
+            groups = pack_commands(len(cmds), pack_tasks, self.cluster_config.get('cmd_costs'))
+        else:
+            groups = [[i] for i in range(len(cmds))]
+        self.array_tasks = [[cmds[i] for i in g] for g in groups]
+
         if len(cmds) == 1:
-            self.register_cmd(cmds[0])
+            self.register_cmd(cmds[0], label='cmd1')
         else:
-            self._start_array()
-            for idx, cmd in enumerate(cmds):
-                self._register_array_cmd(
-                    idx + 1,
-                    cmd,
-                    log_file=self.log_file + str(idx + 1) if self.log_commands else None
-                )
-            self._finish_array()
+            if any(len(g) > 1 for g in groups):
+                self.add_line(run_packed_function)
+            if len(groups) == 1:
+                self.add_line(self._packed_cmd(cmds, groups[0]))
+            elif self.cluster_config.get('cmd_file'):
+                self._write_cmd_file([self._task_cmd(cmds, g) for g in groups])
+            else:
+                self._start_array()
+                for idx, g in enumerate(groups):
+                    self._register_array_cmd(idx + 1, self._task_cmd(cmds, g))
+                self._finish_array()
 
         self.array_jobs_written += len(cmds)
 
+    def _task_cmd(self, cmds, group):
+        """The command run by an array task for a group of commands, with its log file."""
+        if len(group) > 1:
+            return self._packed_cmd(cmds, group)
+        cmd = cmds[group[0]]
+        if self.log_commands:
+            cmd += ' > %s 2>&1' % self._cmd_log_file(group[0])
+        return self._recorded(cmd, 'cmd%s' % (group[0] + 1))
+
+    def _cmd_log_file(self, i):
+        """The log file of the job array's command at index i."""
+        log_files = self.cluster_config.get('log_files')
+        return log_files[i] if log_files else self.log_file + str(i + 1)
+
+    def _write_cmd_file(self, task_cmds):
+        """
+        Write each array task's command as a line of self.cmd_file, and the byte offset of each line as a fixed-width
+        record of self.offsets_file, so that each task reads only its own command: its offset with dd, then the
+        command with tail, which seeks to the offset. This keeps the script small whatever the number of commands.
+        """
+        record_size = 20  # 19 digits and a newline
+        offsets = []
+        offset = 0
+        lines = []
+        for cmd in task_cmds:
+            if '\n' in cmd:
+                raise EGCGError('Commands written to a command file cannot contain newlines: %r' % cmd)
+            line = (cmd + '\n').encode('utf-8')
+            offsets.append('%019d\n' % offset)
+            lines.append(line)
+            offset += len(line)
+
+        with open(self.cmd_file, 'wb') as f:
+            f.write(b''.join(lines))
+        with open(self.offsets_file, 'w') as f:
+            f.write(''.join(offsets))
+
+        self.add_line(
+            'offset=$(dd if="{offsets}" bs={size} skip=$((${idx} - 1)) count=1 2>/dev/null)'.format(
+                offsets=self.offsets_file, size=record_size, idx=self.array_index
+            )
+        )
+        self.add_line('eval "$(tail -c +$((10#$offset + 1)) "%s" | head -n 1)"' % self.cmd_file)
+
+    def _packed_cmd(self, cmds, group):
+        """Run several commands in one array task, as many at once as the job has cpus, each with its own log."""
+        args = []
+        for i in group:
+            cmd = cmds[i]
+            if self.log_commands:
+                cmd += ' > %s 2>&1' % self._cmd_log_file(i)
+            args.append(shlex.quote(self._recorded(cmd, 'cmd%s' % (i + 1))))
+        return 'run_packed %s %s' % (self.cluster_config.get('cpus') or 1, ' '.join(args))
+
     def _register_array_cmd(self, idx, cmd, log_file=None):
         """
         :param int idx: The index of the job, i.e. which number the job has in the array
@@ -75,6 +248,29 @@ class ScriptWriter(AppLogger):
         line += '\n' + ';;'
         self.add_line(line)
 
+    def add_exit_status_trap(self):
+        """
+        Make the script write its exit status to self.exit_status_file when it exits, suffixed with the job array
+        index if any. The file is written to a temporary name and moved, so that it appears complete.
+        """
+        exit_status_file = '%s${%s}' % (self.exit_status_file, self.array_index)
+        self.add_line("trap 'echo $? > \"{f}.tmp\"; mv \"{f}.tmp\" \"{f}\"' EXIT".format(f=exit_status_file))
+
+    def add_status_recording(self):
+        """
+        Make every command registered from now on record its exit status, start and end times and the job's peak
+        memory in self.status_file, suffixed with the job array index if any. Each command adds a line to the file,
+        labelled 'prelim<n>' for preliminary commands and 'cmd<n>' for the nth command of the job array.
+        """
+        self.record_status = True
+        self.add_line('EGCG_STATUS_FILE="%s${%s}"' % (self.status_file, self.array_index))
+        self.add_line(record_status_function)
+
+    def _recorded(self, cmd, label):
+        if self.record_status:
+            return 'record_status %s %s' % (label, shlex.quote(cmd))
+        return cmd
+
     def add_line(self, line):
         self.lines.append(line)
 
@@ -95,13 +291,20 @@ class ScriptWriter(AppLogger):
 
     def add_header(self):
         """Write a header for a given resource manager. If multiple jobs, split them into a job array."""
-        header_mapping = dict(self.cluster_config, log_file=self.log_file, jobs=str(self.array_jobs_written))
+        jobs = str(len(self.array_tasks))
+        if self.cluster_config.get('max_concurrent'):
+            jobs += '%' + str(self.cluster_config['max_concurrent'])
+        header_mapping = dict(self.cluster_config, log_file=self.log_file, jobs=jobs)
         header_lines = list(self.header)
 
         if self.cluster_config.get('walltime'):
             header_lines.append(self.walltime_header)
 
-        if self.array_jobs_written > 1:
+        if self.cluster_config.get('dependencies'):
+            header_lines.append(self.dependency_header)
+            header_mapping['dependencies'] = ':'.join(self.cluster_config['dependencies'])
+
+        if len(self.array_tasks) > 1:
             header_lines.append(self.array_header)
 
         header_lines.extend(['', 'cd ' + self.working_dir, ''])  # prepend the formatted header
@@ -123,6 +326,7 @@ class SlurmWriter(ScriptWriter):
     )
     walltime_header = '#SBATCH --time={walltime}:00:00'
     array_header = '#SBATCH --array=1-{jobs}'
+    dependency_header = '#SBATCH --dependency=afterok:{dependencies}'
 
 
 class PBSWriter(ScriptWriter):
@@ -140,6 +344,7 @@ class PBSWriter(ScriptWriter):
     )
     walltime_header = '#PBS -l walltime={walltime}:00:00'
     array_header = '#PBS -J 1-{jobs}'
+    dependency_header = '#PBS -W depend=afterok:{dependencies}'
 
     def __init__(self, job_name, working_dir, job_queue, log_commands=True, **cluster_config):
         super().__init__(job_name, working_dir, job_queue, log_commands, **cluster_config)
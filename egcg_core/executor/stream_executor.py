@@ -1,29 +1,45 @@
 from select import select
 from threading import Thread
+from egcg_core.config import cfg
 from egcg_core.executor import Executor
+from .executor import OutputStream
 from egcg_core.exceptions import EGCGError
 
 
 class StreamExecutor(Thread, Executor):
-    def __init__(self, cmd):
+    def __init__(self, cmd, max_line_rate=None, sample_every=None, shell=False, timeout=None, kill_grace=None):
         """
         :param str cmd: A shell command to be executed
+        :param int max_line_rate: Maximum lines of output to log per second (default: 'max_line_rate' in the
+                                  executor config, or no limit)
+        :param int sample_every: Only log one line of output in every sample_every (default: 'log_sample_every'
+                                 in the executor config, or log every line)
+        :param bool shell: As Executor
+        :param float timeout: As Executor
+        :param float kill_grace: As Executor
         """
         self.exception = None
-        Executor.__init__(self, cmd)
+        self.max_line_rate = max_line_rate or cfg.query('executor', 'max_line_rate')
+        self.sample_every = sample_every or cfg.query('executor', 'log_sample_every')
+        Executor.__init__(self, cmd, shell=shell, timeout=timeout, kill_grace=kill_grace)
         Thread.__init__(self)
 
     def join(self, timeout=None):
         """
-        Ensure that both the thread and the subprocess have finished, and return self.proc's exit status.
+        Wait for the thread, which reaps the subprocess once its output is closed, and return self.proc's exit
+        status.
         :param int timeout: As Thread.join
+        :return: The exit status, or None if the command is still running after timeout
         """
         super().join(timeout=timeout)
         if self.exception:
+            self.kill()
             self._stop()
             self.error('Encountered a %s error: %s' % (self.exception.__class__.__name__, str(self.exception)))
             raise EGCGError('self.proc command failed: ' + self.cmd)
-        return self.proc.wait()
+        if self.is_alive():
+            return None
+        return self.usage.exit_status
 
     def run(self):
         try:
@@ -31,20 +47,21 @@ class StreamExecutor(Thread, Executor):
         except Exception as e:
             self.exception = e
 
+    def _output_streams(self, proc, prefix=''):
+        return [
+            OutputStream(proc.stdout, self.info, prefix, self.max_line_rate, self.sample_every),
+            OutputStream(proc.stderr, self.error, prefix, self.max_line_rate, self.sample_every)
+        ]
+
     def _stream_output(self):
         """
-        Run self._process and log its stdout/stderr until an EOF.
+        Run self._process, log its stdout/stderr until an EOF, and reap it, so that its usage is recorded when it
+        finishes rather than when it is joined.
         """
-        proc = self._process()
-        read_set = [proc.stdout, proc.stderr]
+        read_set = self._output_streams(self._process())
         while read_set:
-            rlist, wlist, xlist = select(read_set, [], [])
-
-            for stream, emit in ((proc.stdout, self.info), (proc.stderr, self.error)):
-                if stream in rlist:
-                    line = stream.readline().decode('utf-8').strip()
-                    if line:
-                        emit(line)
-                    else:
-                        stream.close()
-                        read_set.remove(stream)
+            rlist, wlist, xlist = select(read_set, [], [], self._check_deadline())
+            for stream in rlist:
+                if not stream.read():
+                    read_set.remove(stream)
+        self._wait()
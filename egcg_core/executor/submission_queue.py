@@ -0,0 +1,144 @@
+import random
+from time import time, sleep
+from threading import Lock, Event
+from egcg_core.app_logging import AppLogger
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+
+
+def backoff(attempt, base=None):
+    """
+    Wait before retrying a resource manager command, doubling from 'retry_backoff' (default: 1s) with each attempt
+    up to 'retry_max_wait' (default: 30s), with a random half of it as jitter, so that threads failing at the same
+    time do not retry at the same time.
+    :param int attempt: Number of attempts made so far, from 1
+    :param float base: Wait after the first attempt, instead of 'retry_backoff'
+    :return: Seconds to wait
+    """
+    wait = min((base or cfg.query('executor', 'retry_backoff', ret_default=1)) * 2 ** (attempt - 1),
+               cfg.query('executor', 'retry_max_wait', ret_default=30))
+    return wait / 2 + random.uniform(0, wait / 2)
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, and up to burst calls at once after a quiet period."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time()
+        self.lock = Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class Batch:
+    def __init__(self):
+        self.executors = []
+        self.full = Event()
+        self.submitted = Event()
+        self.error = None
+
+
+class SubmissionQueue(AppLogger):
+    """
+    Process-wide gate for cluster job submissions. Submissions are limited to 'submit_rate' per second on average,
+    in bursts of up to 'submit_burst' (default: 1), with a token bucket. With 'batch_window' in the executor config,
+    the single-command jobs of compatible executors started within this many seconds of the first are submitted as
+    one job array of at most 'batch_size' (default: 1000) tasks, one per executor.
+    """
+    current = None
+    current_lock = Lock()
+
+    def __init__(self, rate=None, burst=None, batch_window=None, batch_size=None):
+        rate = rate or cfg.query('executor', 'submit_rate')
+        burst = burst or cfg.query('executor', 'submit_burst', ret_default=1)
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.batch_window = batch_window or cfg.query('executor', 'batch_window', ret_default=0)
+        self.batch_size = batch_size or cfg.query('executor', 'batch_size', ret_default=1000)
+        self.lock = Lock()
+        self.pending = {}
+        self.nbatches = 0
+
+    @classmethod
+    def get(cls):
+        with cls.current_lock:
+            if cls.current is None:
+                cls.current = cls()
+            return cls.current
+
+    def batch(self, executor):
+        """
+        Add an executor to the pending batch of compatible executors, or start one and submit it at the end of the
+        batch window or once full. The first executor of a batch submits it, and the others wait for it.
+        :param ClusterExecutor executor:
+        :return: False if the executor should submit its own job, i.e. if it cannot be batched or is alone in its
+                 batch, otherwise True once the batch has been submitted as executor.batch
+        :raises: EGCGError if the batch's submission failed
+        """
+        key = executor._batch_key() if self.batch_window else None
+        if key is None:
+            return False
+
+        with self.lock:
+            batch = self.pending.get(key)
+            first = batch is None
+            if first:
+                batch = self.pending[key] = Batch()
+            batch.executors.append(executor)
+            if len(batch.executors) >= self.batch_size:
+                self.pending.pop(key)
+                batch.full.set()
+
+        if not first:
+            batch.submitted.wait()
+            if batch.error:
+                raise EGCGError('Submission of batch job failed') from batch.error
+            return True
+
+        batch.full.wait(self.batch_window)
+        with self.lock:
+            if self.pending.get(key) is batch:
+                self.pending.pop(key)
+        if len(batch.executors) == 1:
+            return False
+
+        try:
+            self._submit_batch(batch.executors)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.submitted.set()
+        return True
+
+    def _submit_batch(self, executors):
+        with self.lock:
+            self.nbatches += 1
+            nbatch = self.nbatches
+
+        first = executors[0]
+        # each task writes its command's output to its executor's log file, as if it had been submitted on its own
+        config = dict(first.cluster_config, job_name='%s_batch%s' % (first.job_name, nbatch),
+                      log_files=[e.writer.log_file for e in executors])
+        batch_executor = first.__class__(
+            *[e.cmds[0] for e in executors], prelim_cmds=first.prelim_cmds, retries=first.retries,
+            retry_mem_factor=first.retry_mem_factor, retry_walltime_factor=first.retry_walltime_factor, **config
+        )
+        batch_executor.start()
+        for i, e in enumerate(executors, start=1):
+            e.batch = batch_executor
+            e.batch_index = i
+            e.job_id = batch_executor._task_id(i)
+        self.info('Batched %s jobs into job %s', len(executors), batch_executor.job_id)
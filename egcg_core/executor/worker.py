@@ -0,0 +1,151 @@
+"""
+Worker of a WorkerPool, run as a long-lived cluster job on the pool's shared-filesystem task queue:
+
+    python -m egcg_core.executor.worker <pool_dir> [--slots 1] [--idle_timeout 300] [--poll_interval 0.5]
+
+Each task is a json file in <pool_dir>/pending. A worker claims it by moving it to <pool_dir>/running, which only
+one worker can do, runs its command with Bash in its working directory, and writes its exit status, times and
+peak memory to <pool_dir>/done. Running tasks' files are touched every poll_interval as a heartbeat, and a running
+task is terminated if a file of the same name appears in <pool_dir>/cancel, or killed if its file leaves
+<pool_dir>/running, e.g. if it was requeued as lost. Workers exit once <pool_dir>/stop
+exists, or after idle_timeout seconds without a task.
+"""
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+import subprocess
+from time import time, sleep
+from .resource_usage import exit_code
+
+subdirs = ('pending', 'running', 'done', 'cancel', 'tmp')
+cancelled_exit_status = 9  # as cancelled cluster jobs
+
+
+def write_json(pool_dir, subdir, name, content):
+    """Write a json file into one of the pool's subdirectories atomically, through a temporary file."""
+    tmp_file = os.path.join(pool_dir, 'tmp', '%s.%s.%s' % (name, socket.gethostname(), os.getpid()))
+    with open(tmp_file, 'w') as f:
+        json.dump(content, f)
+    os.rename(tmp_file, os.path.join(pool_dir, subdir, name))
+
+
+def read_json(pool_dir, subdir, name):
+    with open(os.path.join(pool_dir, subdir, name)) as f:
+        return json.load(f)
+
+
+class Worker:
+    def __init__(self, pool_dir, slots=1, idle_timeout=300, poll_interval=0.5):
+        self.pool_dir = pool_dir
+        self.slots = slots
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.name = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.running = {}  # task file name -> (subprocess.Popen, task, start time)
+        self.nb_tasks = 0
+
+    def path(self, *parts):
+        return os.path.join(self.pool_dir, *parts)
+
+    def claim(self):
+        """:return: The file name and content of the oldest pending task claimed by this worker, or None"""
+        for name in sorted(os.listdir(self.path('pending'))):
+            try:
+                os.rename(self.path('pending', name), self.path('running', name))
+            except FileNotFoundError:  # claimed by another worker
+                continue
+            return name, read_json(self.pool_dir, 'running', name)
+
+    def start_task(self, name, task):
+        with open(task['log_file'], 'a') if task.get('log_file') else open(os.devnull, 'w') as log:
+            proc = subprocess.Popen(['bash', '-c', task['cmd']], stdout=log, stderr=subprocess.STDOUT,
+                                    cwd=task.get('working_dir'), start_new_session=True)
+        self.running[name] = (proc, task, time())
+
+    def check_task(self, name):
+        """
+        Heartbeat a running task, terminate it if cancelled, and report it if finished. If its file is no longer in
+        running, e.g. if it was requeued as lost because this worker was too slow to heartbeat it, the task now
+        belongs to another attempt, so it is killed and dropped without being reported.
+        """
+        proc, task, start = self.running[name]
+        try:
+            os.utime(self.path('running', name))
+        except FileNotFoundError:
+            self.drop_task(name)
+            return
+
+        cancelled = os.path.isfile(self.path('cancel', name))
+        if cancelled:
+            self.signal_task(proc, signal.SIGTERM)
+
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if not pid:
+            return
+        proc.returncode = exit_code(status)
+        del self.running[name]
+        try:
+            os.remove(self.path('running', name))
+        except FileNotFoundError:  # requeued since the heartbeat, so leave the result to the next attempt
+            return
+        write_json(
+            self.pool_dir, 'done', name,
+            {'exit_status': cancelled_exit_status if cancelled else proc.returncode, 'start': start, 'end': time(),
+             'user_time': rusage.ru_utime, 'sys_time': rusage.ru_stime, 'max_rss': rusage.ru_maxrss,
+             'worker': self.name}
+        )
+        self.nb_tasks += 1
+
+    @staticmethod
+    def signal_task(proc, sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def drop_task(self, name):
+        """Kill a task no longer assigned to this worker, and reap it."""
+        proc, task, start = self.running.pop(name)
+        print('Task %s is no longer running on this worker - killing it' % name)
+        self.signal_task(proc, signal.SIGKILL)
+        proc.wait()
+
+    def run(self):
+        last_task = time()
+        while True:
+            for name in list(self.running):
+                self.check_task(name)
+
+            claimed = False
+            stopping = os.path.isfile(self.path('stop'))
+            while not stopping and len(self.running) < self.slots:
+                task = self.claim()
+                if task is None:
+                    break
+                self.start_task(*task)
+                claimed = True
+
+            if self.running or claimed:
+                last_task = time()
+            elif stopping or time() - last_task >= self.idle_timeout:
+                return self.nb_tasks
+            sleep(self.poll_interval)
+
+
+def main(argv=None):
+    a = argparse.ArgumentParser()
+    a.add_argument('pool_dir')
+    a.add_argument('--slots', type=int, default=1, help='Number of tasks to run at once')
+    a.add_argument('--idle_timeout', type=float, default=300, help='Seconds without tasks after which to exit')
+    a.add_argument('--poll_interval', type=float, default=0.5)
+    args = a.parse_args(argv)
+
+    w = Worker(args.pool_dir, args.slots, args.idle_timeout, args.poll_interval)
+    print('Worker %s ran %s tasks' % (w.name, w.run()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
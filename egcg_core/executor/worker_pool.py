@@ -0,0 +1,226 @@
+import os
+import sys
+import uuid
+from time import time, sleep, strftime
+from threading import Lock
+from egcg_core.app_logging import AppLogger
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+from . import worker
+from .cluster_executor import PBSExecutor, SlurmExecutor, running_executors
+from .resource_usage import ResourceUsage, record_usage
+
+
+class WorkerPool(AppLogger):
+    """
+    Pilot jobs for many short commands: a fixed number of long-lived worker jobs, submitted as one job array through
+    SlurmExecutor/PBSExecutor, pull commands from a task queue on the shared filesystem (see worker) and report
+    their exit statuses back, so that each command does not pay the resource manager's queueing and start-up time.
+    Workers are submitted when commands are added and none are running, and exit after idle_timeout without tasks.
+    """
+    pools = {}
+    pools_lock = Lock()
+    executor_classes = {'pbs': PBSExecutor, 'slurm': SlurmExecutor}
+
+    def __init__(self, pool_dir, env='slurm', workers=4, slots=None, idle_timeout=300, poll_interval=1,
+                 lost_timeout=None, **cluster_config):
+        """
+        :param str pool_dir: Directory of the task queue, on a filesystem shared with the compute nodes
+        :param str env: Resource manager to submit the workers to, 'slurm' or 'pbs'
+        :param int workers: Number of worker jobs
+        :param int slots: Number of commands each worker runs at once (default: the workers' cpus, or 1)
+        :param float idle_timeout: Seconds without tasks after which a worker exits
+        :param float poll_interval: Seconds between checks for new tasks by workers, and for finished tasks here
+        :param float lost_timeout: Seconds without heartbeat after which a running task is requeued, e.g. if its
+                                   worker was killed (default: 60 + 10 * poll_interval)
+        :param cluster_config: Resources and options for the worker jobs, e.g. cpus, mem, walltime - see
+                               cluster_execute
+        """
+        if env not in self.executor_classes:
+            raise EGCGError('Unknown execution environment for worker pool: %s' % env)
+        self.pool_dir = os.path.abspath(pool_dir)
+        self.env = env
+        self.workers = workers
+        self.slots = slots or cluster_config.get('cpus') or 1
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.lost_timeout = lost_timeout or 60 + 10 * poll_interval
+        self.cluster_config = cluster_config
+        self.executor = None
+        self.lock = Lock()
+        for d in worker.subdirs:
+            os.makedirs(os.path.join(self.pool_dir, d), exist_ok=True)
+
+    @classmethod
+    def get(cls):
+        """:return: The process-wide pool configured in 'worker_pool' in the executor config"""
+        config = cfg.query('executor', 'worker_pool')
+        if not config or not config.get('pool_dir'):
+            raise EGCGError('No worker pool configured')
+        with cls.pools_lock:
+            if config['pool_dir'] not in cls.pools:
+                cls.pools[config['pool_dir']] = cls(**config)
+            return cls.pools[config['pool_dir']]
+
+    def path(self, *parts):
+        return os.path.join(self.pool_dir, *parts)
+
+    def worker_cmd(self):
+        return '%s -m egcg_core.executor.worker %s --slots %s --idle_timeout %s --poll_interval %s' % (
+            sys.executable, self.pool_dir, self.slots, self.idle_timeout, self.poll_interval
+        )
+
+    def add_tasks(self, tasks):
+        """
+        :param dict tasks: Task file name to task: cmd, working_dir and log_file
+        """
+        for name, task in tasks.items():
+            worker.write_json(self.pool_dir, 'pending', name, task)
+        self.check_workers()
+
+    def workers_running(self):
+        with self.lock:
+            return self.executor is not None and self.executor.poll() is None
+
+    def check_workers(self):
+        """Submit the workers if they are not running, e.g. not submitted yet or exited when idle."""
+        with self.lock:
+            if self.executor and self.executor.poll() is None:
+                return
+            if os.path.isfile(self.path('stop')):
+                os.remove(self.path('stop'))
+
+            config = dict(self.cluster_config)
+            config.setdefault('job_name', 'worker_pool')
+            config.setdefault('working_dir', self.pool_dir)
+            self.executor = self.executor_classes[self.env](*[self.worker_cmd()] * self.workers, **config)
+            self.executor.start()
+            self.info('Submitted %s workers as job %s', self.workers, self.executor.job_id)
+
+    def requeue_lost_tasks(self, names):
+        """Move the tasks that have not had a heartbeat for lost_timeout seconds back to pending."""
+        for name in names:
+            try:
+                if time() - os.path.getmtime(self.path('running', name)) < self.lost_timeout:
+                    continue
+                os.rename(self.path('running', name), self.path('pending', name))
+            except FileNotFoundError:  # finished, or claimed again, in the meantime
+                continue
+            self.warning('Requeued task %s, lost by its worker', name)
+            self.check_workers()
+
+    def shutdown(self, wait=True):
+        """
+        Tell the workers to exit once they have finished their current tasks, without starting the pending ones.
+        :param bool wait: Join the worker job
+        :return: The worker job's exit status if waited for
+        """
+        open(self.path('stop'), 'w').close()
+        with self.lock:
+            executor = self.executor
+        if executor and wait:
+            return executor.join()
+
+
+class PoolExecutor(AppLogger):
+    """Runs commands as tasks of a WorkerPool, with the same interface as ClusterExecutor."""
+    def __init__(self, *cmds, pool=None, prelim_cmds=None, job_name=None, working_dir=None, **cluster_config):
+        """
+        :param cmds:
+        :param WorkerPool pool: Default: WorkerPool.get()
+        :param list prelim_cmds: Commands run before each command, in the same Bash process
+        :param str job_name: Used to name the commands' log files, <job_name>.log<n>
+        :param str working_dir: Directory the commands run in, and to write the log files to
+        :param cluster_config: Resource options for cluster jobs, ignored as commands run on the pool's workers
+        """
+        self.pool = pool or WorkerPool.get()
+        self.cmds = cmds
+        self.prelim_cmds = prelim_cmds
+        self.job_name = job_name or 'pool_job'
+        self.working_dir = os.path.abspath(working_dir or os.getcwd())
+        self.job_id = '%s_%s_%s' % (strftime('%Y%m%d%H%M%S'), self.job_name, uuid.uuid4().hex[:8])
+        self.tasks = ['%s.%s' % (self.job_id, i) for i in range(1, len(cmds) + 1)]
+        self.task_results = {}
+        self.cancelled = False
+        self.usages = []
+        self.exit_status = None
+
+    def start(self):
+        tasks = {}
+        for i, (cmd, name) in enumerate(zip(self.cmds, self.tasks), start=1):
+            tasks[name] = {
+                'cmd': '\n'.join(list(self.prelim_cmds or []) + [cmd]),
+                'working_dir': self.working_dir,
+                'log_file': os.path.join(self.working_dir, '%s.log%s' % (self.job_name, i))
+            }
+        running_executors[self.job_id] = self
+        self.pool.add_tasks(tasks)
+        self.info('Queued %s commands as pool job %s', len(tasks), self.job_id)
+
+    def poll(self):
+        """:return: The sum of the commands' exit statuses if all have finished, otherwise None"""
+        if self.exit_status is not None:
+            return self.exit_status
+
+        for name in self.tasks:
+            if name not in self.task_results and os.path.isfile(self.pool.path('done', name)):
+                self.task_results[name] = worker.read_json(self.pool.pool_dir, 'done', name)
+        if len(self.task_results) < len(self.tasks):
+            unfinished = [n for n in self.tasks if n not in self.task_results]
+            if not self.cancelled:
+                self.pool.requeue_lost_tasks(n for n in unfinished if os.path.isfile(self.pool.path('running', n)))
+                self.pool.check_workers()
+                return None
+            if self.pool.workers_running():  # will terminate the cancelled tasks
+                return None
+            for name in unfinished:  # cancelled along with the workers
+                self.task_results[name] = self._cancelled_result()
+
+        self._finish()
+        return self.exit_status
+
+    def join(self):
+        exit_status = self.poll()
+        while exit_status is None:
+            sleep(self.pool.poll_interval)
+            exit_status = self.poll()
+        return exit_status
+
+    def _finish(self):
+        running_executors.pop(self.job_id, None)
+        for cmd, name in zip(self.cmds, self.tasks):
+            r = self.task_results[name]
+            self.usages.append(
+                ResourceUsage(cmd, exit_status=r['exit_status'], wall_time=r['end'] - r['start'],
+                              user_time=r['user_time'], sys_time=r['sys_time'], max_rss=r['max_rss'],
+                              job_name=self.job_name, job_id=name)
+            )
+            for subdir in ('done', 'cancel'):
+                if os.path.isfile(self.pool.path(subdir, name)):
+                    os.remove(self.pool.path(subdir, name))
+        record_usage(self.usages)
+        self.exit_status = sum(u.exit_status for u in self.usages)
+        self.info('Pool job %s finished with exit status %s', self.job_id, self.exit_status)
+
+    def cancel_job(self):
+        """Remove the pending commands from the queue, and have the workers terminate the running ones."""
+        self.cancelled = True
+        for name in self.tasks:
+            try:
+                os.remove(self.pool.path('pending', name))
+            except FileNotFoundError:  # running or finished
+                if not os.path.isfile(self.pool.path('done', name)):
+                    open(self.pool.path('cancel', name), 'w').close()
+                continue
+            worker.write_json(self.pool.pool_dir, 'done', name, self._cancelled_result())
+
+    @staticmethod
+    def _cancelled_result():
+        now = time()
+        return {'exit_status': worker.cancelled_exit_status, 'start': now, 'end': now, 'user_time': None,
+                'sys_time': None, 'max_rss': None, 'worker': None}
+
+    @classmethod
+    def cancel_jobs(cls, executors):
+        for e in executors:
+            e.cancel_job()
@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import threading
+
+
+class SnapshotEntity:
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.__dict__.update(kwargs)
+
+
+class SnapshotSample(SnapshotEntity):
+    """Read-only stand-in for a genologics Sample, exposing the attributes used in egcg_core.clarity."""
+    def __init__(self, name, project, udf, artifact_id, container_name, container_type, well):
+        container = SnapshotEntity(container_name, type=SnapshotEntity(container_type))
+        super().__init__(
+            name,
+            project=SnapshotEntity(project),
+            udf=udf,
+            artifact=SnapshotEntity(artifact_id, id=artifact_id, container=container, location=(container, well))
+        )
+
+
+class LimsSnapshot:
+    """
+    Local sqlite copy of the Lims metadata of one or more projects: samples with their UDFs, plates and wells,
+    release dates and run elements. Populated by clarity.export_project_snapshot and queried by the clarity
+    helpers in offline mode.
+    """
+    sample_columns = ('name', 'project', 'udf', 'artifact_id', 'container_name', 'container_type', 'well')
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self._create_tables()
+
+    def _create_tables(self):
+        _create = 'CREATE TABLE IF NOT EXISTS '
+        self.db.execute(
+            _create + 'samples (name text PRIMARY KEY, project text, udf text, artifact_id text, '
+                      'container_name text, container_type text, well text, release_date text)'
+        )
+        self.db.execute(_create + 'run_elements (sample text REFERENCES samples(name), run_id text, lane text)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS samples_project ON samples (project)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS samples_container ON samples (container_name)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS run_elements_sample ON run_elements (sample)')
+        self.db.commit()
+
+    def _query(self, query, params=()):
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def add_project(self, project_id, samples, run_elements):
+        """
+        Replace the content of the snapshot for a project.
+        :param str project_id:
+        :param list[dict] samples: dicts with the keys in sample_columns, plus release_date
+        :param list[tuple] run_elements: (sample name, run id, lane)
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM run_elements WHERE sample IN (SELECT name FROM samples WHERE project=?)', (project_id,)
+            )
+            self.db.execute('DELETE FROM samples WHERE project=?', (project_id,))
+            self.db.executemany(
+                'INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (s['name'], project_id, json.dumps(s['udf'], default=str), s['artifact_id'],
+                     s['container_name'], s['container_type'], s['well'], s['release_date'])
+                    for s in samples
+                ]
+            )
+            self.db.executemany('INSERT INTO run_elements VALUES (?, ?, ?)', run_elements)
+
+    def _build_samples(self, rows):
+        return [
+            SnapshotSample(name, project, json.loads(udf), artifact_id, container_name, container_type, well)
+            for name, project, udf, artifact_id, container_name, container_type, well in rows
+        ]
+
+    def _select_samples(self, where, params):
+        return self._build_samples(
+            self._query('SELECT %s FROM samples WHERE %s' % (', '.join(self.sample_columns), where), params)
+        )
+
+    def get_samples(self, names):
+        names = sorted(set(names))
+        samples = []
+        for start in range(0, len(names), 500):  # stay below sqlite's limit on query parameters
+            chunk = names[start:start + 500]
+            samples.extend(self._select_samples('name IN (%s)' % ', '.join('?' * len(chunk)), chunk))
+        return samples
+
+    def get_project_samples(self, project_id):
+        return self._select_samples('project=?', (project_id,))
+
+    def get_container_samples(self, container_name):
+        return self._select_samples('container_name=?', (container_name,))
+
+    def get_release_date(self, sample_name):
+        rows = self._query('SELECT release_date FROM samples WHERE name=?', (sample_name,))
+        if rows:
+            return rows[0][0]
+
+    def get_run_elements(self, sample_name):
+        return self._query('SELECT run_id, lane FROM run_elements WHERE sample=? ORDER BY rowid', (sample_name,))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,95 @@
+"""
+Report the number of Lims requests and the wall time of the clarity helpers for projects of various sizes,
+using the offline FakeLims. Usage:
+
+    python -m tests.benchmarks.bench_clarity [--sizes 10 100 1000] [--latency 0.005] [--json results.json]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from time import time
+from unittest.mock import patch
+from egcg_core import clarity
+from tests.fake_lims import FakeLims
+
+
+def per_sample(func):
+    def _run(sample_names):
+        for s in sample_names:
+            r = func(s)
+            if hasattr(r, '__next__'):
+                list(r)
+    _run.__name__ = func.__name__
+    return _run
+
+
+def genotypes(sample_names):
+    output_dir = tempfile.mkdtemp()
+    try:
+        clarity.get_sample_genotypes(dict((s, os.path.join(output_dir, s + '.vcf')) for s in sample_names))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+benchmarks = (
+    ('get_list_of_samples', clarity.get_list_of_samples),
+    ('route_samples_to_delivery_workflow', clarity.route_samples_to_delivery_workflow),
+    ('get_sample_genotypes', genotypes),
+    ('get_sample_names_from_project', lambda sample_names: clarity.get_sample_names_from_project('a_project')),
+    ('get_released_samples', lambda sample_names: clarity.get_released_samples()),
+    ('get_user_sample_name (per sample)', per_sample(clarity.get_user_sample_name)),
+    ('get_sample_gender (per sample)', per_sample(clarity.get_sample_gender)),
+    ('get_plate_id_and_well (per sample)', per_sample(clarity.get_plate_id_and_well)),
+    ('get_sample_release_date (per sample)', per_sample(clarity.get_sample_release_date)),
+    ('find_run_elements_from_sample (per sample)', per_sample(clarity.find_run_elements_from_sample)),
+)
+
+
+def run_benchmarks(sizes, latency=0):
+    """
+    :return: one result per helper and project size, with the number of requests per endpoint type
+    :rtype: list[dict]
+    """
+    results = []
+    for size in sizes:
+        lims = FakeLims(latency=latency)
+        sample_names = lims.add_project('a_project', size)
+        with patch('egcg_core.clarity._lims', new=lims), patch('egcg_core.clarity.app_logger'):
+            for name, func in benchmarks:
+                lims.reset()
+                start = time()
+                func(sample_names)
+                results.append(
+                    {
+                        'helper': name,
+                        'samples': size,
+                        'requests': lims.nrequests,
+                        'endpoints': dict(lims.requests),
+                        'wall_time': time() - start
+                    }
+                )
+    return results
+
+
+def main(argv=None):
+    a = argparse.ArgumentParser()
+    a.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    a.add_argument('--latency', type=float, default=0, help='Simulated seconds per Lims request')
+    a.add_argument('--json', help='Also write the results to this file')
+    args = a.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.latency)
+    print('%-45s %8s %9s %10s' % ('helper', 'samples', 'requests', 'time (s)'))
+    for r in results:
+        print('%-45s %8s %9s %10.3f' % (r['helper'], r['samples'], r['requests'], r['wall_time']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
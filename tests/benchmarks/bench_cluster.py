@@ -0,0 +1,102 @@
+"""
+Report the submission throughput, polling overhead and end-to-end latency of cluster_execute for various numbers
+of jobs, against the local FakeScheduler. Usage:
+
+    python -m tests.benchmarks.bench_cluster [--sizes 1 10 100 1000 5000] [--scheduler slurm] [--slots 8]
+                                             [--queue_delay 0] [--fail_rate 0] [--interval 0.5] [--json results.json]
+
+For each size n, this measures:
+- submission: n single-command jobs submitted one after the other
+- polling: joining these n jobs, with the number of status queries (squeue/sacct or qstat) made
+- latency: one job array of n commands, from cluster_execute to the end of join
+"""
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from time import time
+from unittest.mock import patch
+from egcg_core.config import cfg
+from egcg_core.executor import cluster_execute
+from egcg_core.executor.cluster_executor import JobStatusPoller
+from tests import TestEGCG
+from tests.fake_scheduler import FakeScheduler
+
+status_queries = ('squeue', 'sacct', 'qstat')
+
+
+def bench_size(size, working_dir, scheduler_kind='slurm', **scheduler_config):
+    result = {'jobs': size}
+    with FakeScheduler(scheduler_kind, **scheduler_config) as scheduler:
+        start = time()
+        executors = [cluster_execute('true', job_name='job%s' % i, working_dir=working_dir) for i in range(size)]
+        result['submission_time'] = time() - start
+        result['submissions_per_s'] = size / result['submission_time']
+
+        start = time()
+        exit_statuses = [e.join() for e in executors]
+        result['join_time'] = time() - start
+        result['status_queries'] = sum(scheduler.calls[c] for c in status_queries)
+        result['failed_jobs'] = sum(1 for s in exit_statuses if s)
+
+        JobStatusPoller.pollers.clear()
+        calls = scheduler.calls
+        start = time()
+        e = cluster_execute(*['true'] * size, job_name='array_job', working_dir=working_dir)
+        e.join()
+        result['array_latency'] = time() - start
+        result['array_status_queries'] = sum(scheduler.calls[c] - calls[c] for c in status_queries)
+    return result
+
+
+def run_benchmarks(sizes, scheduler_kind='slurm', interval=0.5, **scheduler_config):
+    """
+    :param float interval: join_min_interval and status_max_age for the executors, join_interval being 4 times this
+    :return: one result per size
+    :rtype: list[dict]
+    """
+    if 'executor' not in cfg.content:
+        cfg.load_config_file(TestEGCG.etc_config)
+
+    results = []
+    working_dir = tempfile.mkdtemp(prefix='bench_cluster_')
+    polling = {'join_min_interval': interval, 'join_interval': interval * 4, 'status_max_age': interval}
+    try:
+        with patch.dict(cfg.content['executor'], polling), patch('egcg_core.executor.cluster_executor.AppLogger.info'):
+            for size in sizes:
+                results.append(bench_size(size, working_dir, scheduler_kind, **scheduler_config))
+                JobStatusPoller.pollers.clear()
+    finally:
+        shutil.rmtree(working_dir)
+    return results
+
+
+def main(argv=None):
+    a = argparse.ArgumentParser()
+    a.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100])
+    a.add_argument('--scheduler', choices=('slurm', 'pbs'), default='slurm')
+    a.add_argument('--slots', type=int, default=8, help='Number of tasks the fake scheduler runs at once')
+    a.add_argument('--queue_delay', type=float, default=0, help='Seconds before a submitted job can start')
+    a.add_argument('--fail_rate', type=float, default=0, help='Probability of a task failing with NODE_FAIL')
+    a.add_argument('--interval', type=float, default=0.5, help='Minimum interval between status queries')
+    a.add_argument('--json', help='Also write the results to this file')
+    args = a.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.scheduler, args.interval, slots=args.slots,
+                             queue_delay=args.queue_delay, fail_rate=args.fail_rate)
+    print('%6s %14s %14s %10s %8s %8s %14s %14s' % ('jobs', 'submission (s)', 'submissions/s', 'join (s)', 'queries',
+                                                   'failed', 'array join (s)', 'array queries'))
+    for r in results:
+        print('%6s %14.3f %14.1f %10.3f %8s %8s %14.3f %14s' % (
+            r['jobs'], r['submission_time'], r['submissions_per_s'], r['join_time'], r['status_queries'],
+            r['failed_jobs'], r['array_latency'], r['array_status_queries']
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+An offline stand-in for the parts of genologics.lims.Lims used by egcg_core.clarity. Entities behave like
+genologics entities: those returned by a list query are stubs which cost one request when first read, unless
+loaded through get_batch. Every request is counted by endpoint type, as in clarity.InstrumentedLims, and can
+be given an artificial latency.
+"""
+from collections import Counter
+from threading import Lock
+from time import sleep
+
+
+class FakeEntity:
+    endpoint = None
+
+    def __init__(self, lims, limsid, **fields):
+        self.lims = lims
+        self.id = limsid
+        self.uri = lims.get_uri(self.endpoint, limsid)
+        self._fields = fields
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self.lims.request(self.endpoint)
+            self._loaded = True
+
+    def __getattr__(self, item):
+        fields = self.__dict__.get('_fields', {})
+        if item in fields:
+            self._load()
+            return fields[item]
+        raise AttributeError(item)
+
+    def field(self, item):
+        """Read a field without making a request, as the server would when filtering a query."""
+        return self._fields[item]
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.id)
+
+
+class FakeSample(FakeEntity):
+    endpoint = 'samples'
+
+
+class FakeArtifact(FakeEntity):
+    endpoint = 'artifacts'
+
+    def __init__(self, lims, limsid, **fields):
+        super().__init__(lims, limsid, **fields)
+        lims.artifacts[limsid] = self
+
+
+class FakeContainerType(FakeEntity):
+    endpoint = 'containertypes'
+
+
+class FakeContainer(FakeEntity):
+    endpoint = 'containers'
+
+    def get_placements(self):
+        return self.placements
+
+
+class FakeProject(FakeEntity):
+    endpoint = 'projects'
+
+
+class FakeProcess(FakeEntity):
+    endpoint = 'processes'
+
+    def all_inputs(self, unique=True, resolve=False):
+        if resolve:
+            self.lims.get_batch(self.inputs)
+        return list(self.inputs)
+
+    def input_per_sample(self, sample_name):
+        # as genologics, this reads the samples of each input artifact
+        return [a for a in self.all_inputs() if sample_name in [s.name for s in a.samples]]
+
+    def outputs_per_input(self, artifact_id, **kwargs):
+        return list(self.io_map.get(artifact_id, []))
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+        self.headers = {'Content-Length': str(len(content))}
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, lims):
+        self.lims = lims
+
+    def get(self, uri, **kwargs):
+        self.lims.request('files')
+        file_id = uri.split('/')[-2]
+        return FakeResponse(self.lims.files[file_id])
+
+
+class FakeLims:
+    baseuri = 'http://fake_lims/'
+    username = 'a_user'
+    password = 'a_password'
+
+    def __init__(self, latency=0):
+        """
+        :param float latency: Seconds to wait on each request
+        """
+        self.latency = latency
+        self.requests = Counter()
+        self.lock = Lock()
+        self.request_session = FakeSession(self)
+        self.samples = {}
+        self.artifacts = {}
+        self.containers = {}
+        self.container_types = {}
+        self.projects = {}
+        self.processes = []
+        self.files = {}
+        self.routed = []
+
+    def request(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+        if self.latency:
+            sleep(self.latency)
+
+    @property
+    def nrequests(self):
+        return sum(self.requests.values())
+
+    def reset(self):
+        """Clear the request counts and unload all entities, as if starting from a new connection."""
+        self.requests.clear()
+        for e in self._all_entities():
+            e._loaded = False
+
+    def _all_entities(self):
+        yield from self.samples.values()
+        yield from self.artifacts.values()
+        yield from self.containers.values()
+        yield from self.container_types.values()
+        yield from self.projects.values()
+        yield from self.processes
+
+    def get_uri(self, *segments, **query):
+        return self.baseuri + 'api/v2/' + '/'.join(str(s) for s in segments)
+
+    def validate_response(self, response, accept_status_codes=(200,)):
+        return True
+
+    def get_samples(self, name=None, projectname=None, **kwargs):
+        self.request('samples')
+        samples = self.samples.values()
+        if name is not None:
+            names = name if isinstance(name, list) else [name]
+            samples = [self.samples[n] for n in names if n in self.samples]
+        if projectname is not None:
+            samples = [s for s in samples if s.field('project').field('name') == projectname]
+        return list(samples)
+
+    def get_artifacts(self, sample_name=None, process_type=None, **kwargs):
+        self.request('artifacts')
+        artifacts = []
+        for p in self.processes:
+            if process_type and p.field('type') != process_type:
+                continue
+            artifacts.extend(p.field('outputs'))
+        if process_type is None:
+            artifacts.extend(self.artifacts.values())
+        if sample_name is not None:
+            artifacts = [a for a in artifacts if sample_name in [s.id for s in a.field('samples')]]
+        return artifacts
+
+    def get_containers(self, name=None, type=None, **kwargs):
+        self.request('containers')
+        return [
+            c for c in self.containers.values()
+            if (name is None or c.field('name') == name) and (type is None or c.field('type').field('name') == type)
+        ]
+
+    def get_processes(self, type=None, udf=None, inputartifactlimsid=None, projectname=None, **kwargs):
+        self.request('processes')
+        processes = [p for p in self.processes if type is None or p.field('type') == type]
+        if projectname:
+            processes = [p for p in processes if projectname in self._projects_of(p.field('inputs'))]
+        if udf:
+            processes = [p for p in processes if all(p.field('udf').get(k) == v for k, v in udf.items())]
+        if inputartifactlimsid:
+            ids = inputartifactlimsid if isinstance(inputartifactlimsid, list) else [inputartifactlimsid]
+            processes = [p for p in processes if set(ids).intersection(a.id for a in p.field('inputs'))]
+        return processes
+
+    @staticmethod
+    def _projects_of(artifacts):
+        return set(s.field('project').field('name') for a in artifacts for s in a.field('samples'))
+
+    def get_projects(self, name=None, **kwargs):
+        self.request('projects')
+        return [p for p in self.projects.values() if name is None or p.field('name') == name]
+
+    def get_batch(self, instances, force=False):
+        to_load = [i for i in instances if force or not i._loaded]
+        if to_load:
+            self.request(to_load[0].endpoint + '/batch')
+            for i in to_load:
+                i._loaded = True
+        return list(instances)
+
+    def get_file_contents(self, id=None, uri=None):
+        self.request('files')
+        return self.files[id].decode('utf-8')
+
+    def download(self, uri):
+        return self.request_session.get(uri, stream=True)
+
+    def route_artifacts(self, artifact_list, workflow_uri=None, stage_uri=None, unassign=False):
+        self.request('route')
+        self.routed.extend(artifact_list)
+
+    def add_project(self, project_id, nsamples, nruns=1):
+        """
+        Populate the Lims with a project of nsamples, received in 96 well plates, genotyped, sequenced in nruns
+        runs of 8-lane flowcells and released.
+        """
+        project = self.projects[project_id] = FakeProject(self, project_id, name=project_id)
+        plate_type = self.container_types.setdefault(
+            '96 well plate', FakeContainerType(self, '1', name='96 well plate')
+        )
+        fc_type = self.container_types.setdefault(
+            'Patterned Flowcell', FakeContainerType(self, '2', name='Patterned Flowcell')
+        )
+
+        sample_artifacts = []
+        plate = None
+        for i in range(nsamples):
+            well_idx = i % 96
+            if well_idx == 0:
+                plate_name = '%s_P%03d' % (project_id, i // 96 + 1)
+                plate = self.containers[plate_name] = FakeContainer(
+                    self, plate_name, name=plate_name, type=plate_type, placements={}
+                )
+            well = '%s:%s' % ('ABCDEFGH'[well_idx % 8], well_idx // 8 + 1)
+            sample_name = '%s_%05d' % (project_id, i + 1)
+            file_id = 'genotype_' + sample_name
+            self.files[file_id] = ('##fileformat=VCFv4.1\n%s\n' % sample_name).encode()
+
+            artifact = FakeArtifact(self, sample_name + 'PA1', udf={}, container=plate, location=(plate, well))
+            sample = FakeSample(
+                self,
+                sample_name,
+                name=sample_name,
+                project=project,
+                artifact=artifact,
+                udf={
+                    'User Sample Name': 'user:' + sample_name,
+                    'Species': 'Homo sapiens',
+                    'Genome Version': 'hg38',
+                    'Sex': 'Female',
+                    'Yield for Quoted Coverage (Gb)': 120,
+                    'Genotyping results file id': file_id
+                }
+            )
+            artifact._fields['samples'] = [sample]
+            plate.field('placements')[well] = artifact
+            self.samples[sample_name] = sample
+            sample_artifacts.append(artifact)
+
+        for step in ('Genotyping Plate Preparation EG 1.0', 'Sequencing Plate Preparation EG 1.0'):
+            io_map = {}
+            for a in sample_artifacts:
+                output = FakeArtifact(self, a.id + step[:3], udf={}, samples=a.field('samples'),
+                                      container=a.field('container'))
+                io_map[a.id] = [output]
+            self.processes.append(
+                FakeProcess(self, '%s_%s' % (project_id, len(self.processes)), type=step, udf={},
+                            inputs=sample_artifacts, outputs=[], io_map=io_map)
+            )
+
+        all_samples = [a.field('samples')[0] for a in sample_artifacts]
+        for r in range(nruns):
+            run_id = '%s_RUN%s' % (project_id, r + 1)
+            lanes = []
+            placements = {}
+            for lane in range(1, 9):
+                lane_artifact = FakeArtifact(
+                    self, '%s_L%s' % (run_id, lane), udf={'Lane Failed?': lane == 8},
+                    samples=all_samples, position='%s:1' % lane, location=(None, '%s:1' % lane)
+                )
+                lanes.append(lane_artifact)
+                placements['%s:1' % lane] = lane_artifact
+            self.containers[run_id] = FakeContainer(self, run_id, name=run_id, type=fc_type, placements=placements)
+            process = FakeProcess(self, run_id, type='AUTOMATED - Sequence', udf={'RunID': run_id}, inputs=lanes,
+                                  outputs=[], io_map={})
+            process._fields['outputs'] = [
+                FakeArtifact(self, run_id + '_log', udf={}, samples=all_samples, parent_process=process)
+            ]
+            self.processes.append(process)
+
+        self.processes.append(
+            FakeProcess(self, project_id + '_release', type='Data Release EG 1.0', udf={}, inputs=sample_artifacts,
+                        outputs=[], io_map={}, date_run='2017-06-01')
+        )
+        return [a.field('samples')[0].id for a in sample_artifacts]
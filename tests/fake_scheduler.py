@@ -0,0 +1,433 @@
+"""
+A local stand-in for Slurm and PBS, to run PBSExecutor/SlurmExecutor without a cluster. FakeScheduler writes
+command-line shims for sbatch, squeue, sacct and scancel, and for qsub, qstat and qdel, which record submissions
+and cancellations as files in a state directory and report job states in the resource managers' formats. A
+scheduler thread runs the submitted job scripts, as array tasks if any, with at most `slots` tasks at once,
+after an optional queue delay, and can inject node failures and rejected submissions:
+
+    with FakeScheduler('slurm', queue_delay=0.1, slots=4, fail_rate=0.01) as scheduler:
+        e = cluster_execute('a_cmd', 'another_cmd', job_name='a_job', working_dir=working_dir)
+        e.join()
+        print(scheduler.calls)  # number of calls to each shim
+
+The shims only use the standard library, and are run as `python fake_scheduler.py <command> <state_dir> <args>`.
+"""
+import os
+import re
+import sys
+import json
+import fcntl
+import random
+import shutil
+import signal
+import tempfile
+import subprocess
+import threading
+from collections import Counter
+from time import time
+from unittest.mock import patch
+
+server = 'fakeserver'
+shims = ('sbatch', 'squeue', 'sacct', 'scancel', 'qsub', 'qstat', 'qdel')
+unfinished_states = ('PENDING', 'RUNNING')
+pbs_states = {'PENDING': 'Q', 'RUNNING': 'R'}  # finished subjobs are X, other finished jobs F
+
+
+def write_json(path, content):
+    """Write a file atomically, so that the shims and the scheduler never read it half-written."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f)
+    os.rename(path + '.tmp', path)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def job_number(job_id):
+    return re.match(r'\d*', job_id).group(0)
+
+
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class FakeScheduler:
+    def __init__(self, kind='slurm', queue_delay=0, slots=4, fail_rate=0, submit_fail_rate=0, seed=None,
+                 interval=0.02):
+        """
+        :param str kind: 'slurm' or 'pbs', setting job_execution and qsub in the executor config while running
+        :param float queue_delay: Seconds between a job's submission and the start of its first task
+        :param int slots: Maximum number of tasks running at once, over all jobs
+        :param float fail_rate: Probability for each task to fail with NODE_FAIL instead of running
+        :param float submit_fail_rate: Probability for each submission to be rejected
+        :param int seed: Seed for the task failures
+        :param float interval: Seconds between two rounds of the scheduler thread
+        """
+        self.kind = kind
+        self.queue_delay = queue_delay
+        self.slots = slots
+        self.fail_rate = fail_rate
+        self.interval = interval
+        self.random = random.Random(seed)
+        self.state_dir = tempfile.mkdtemp(prefix='fake_scheduler_')
+        self.bin_dir = os.path.join(self.state_dir, 'bin')
+        for d in ('bin', 'jobs', 'states', 'cancel'):
+            os.mkdir(os.path.join(self.state_dir, d))
+        write_json(os.path.join(self.state_dir, 'config.json'), {'submit_fail_rate': submit_fail_rate})
+
+        for shim in shims:
+            path = os.path.join(self.bin_dir, shim)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nexec %s %s %s %s "$@"\n' % (sys.executable, os.path.abspath(__file__), shim,
+                                                              self.state_dir))
+            os.chmod(path, 0o755)
+
+        self.jobs = {}
+        self.states = {}
+        self.running = {}  # subprocess.Popen -> (job id, task index)
+        self.thread = None
+        self.stopped = threading.Event()
+        self.patches = []
+
+    @property
+    def calls(self):
+        """The number of calls to each shim."""
+        with open(os.path.join(self.state_dir, 'calls.log'), 'a+') as f:
+            f.seek(0)
+            return Counter(f.read().split())
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        from egcg_core.config import cfg  # not at module level, so that the shims do not import egcg_core
+        qsub = os.path.join(self.bin_dir, 'sbatch' if self.kind == 'slurm' else 'qsub')
+        self.patches = [
+            patch.dict(os.environ, PATH=self.bin_dir + os.pathsep + os.environ.get('PATH', '')),
+            patch.dict(cfg.content['executor'], job_execution=self.kind, qsub=qsub)
+        ]
+        for p in self.patches:
+            p.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        for proc in list(self.running):
+            self._kill(proc)
+            proc.wait()
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.state_dir)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            changed = set()
+            self._read_submissions()
+            self._cancel_jobs(changed)
+            self._reap_tasks(changed)
+            self._start_tasks(changed)
+            for job_id in changed:
+                write_json(os.path.join(self.state_dir, 'states', job_id + '.json'), self.states[job_id])
+            self.stopped.wait(self.interval)
+
+    def _read_submissions(self):
+        for f in sorted(os.listdir(os.path.join(self.state_dir, 'jobs')), key=lambda f: int(job_number(f) or 0)):
+            job_id = f[:-len('.json')]
+            if f.endswith('.json') and job_id not in self.jobs:
+                self.jobs[job_id] = read_json(os.path.join(self.state_dir, 'jobs', f))
+                self.states[job_id] = dict((str(i), {'state': 'PENDING'}) for i in self._indexes(job_id))
+
+    def _indexes(self, job_id):
+        return range(1, self.jobs[job_id]['ntasks'] + 1)
+
+    def _cancel_jobs(self, changed):
+        for job_id in os.listdir(os.path.join(self.state_dir, 'cancel')):
+            if job_id not in self.jobs or self.jobs[job_id].get('cancelled'):
+                continue
+            self.jobs[job_id]['cancelled'] = True
+            for task in self.states[job_id].values():
+                if task['state'] == 'PENDING':
+                    task.update(state='CANCELLED', exit_code=0, end=time())
+            for proc, (running_job_id, idx) in self.running.items():
+                if running_job_id == job_id:
+                    self._kill(proc)
+            changed.add(job_id)
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _reap_tasks(self, changed):
+        for proc in list(self.running):
+            reaped, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if not reaped:
+                continue
+            proc.returncode = status
+            job_id, idx = self.running.pop(proc)
+            task = self.states[job_id][idx]
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+            task.update(exit_code=exit_code, end=time(), user_time=rusage.ru_utime, sys_time=rusage.ru_stime,
+                        max_rss=rusage.ru_maxrss)
+            if self.jobs[job_id].get('cancelled'):
+                task.update(state='CANCELLED', exit_code=0)
+            else:
+                task['state'] = 'FAILED' if exit_code else 'COMPLETED'
+            changed.add(job_id)
+
+    def _dependency_state(self, job):
+        """'ok' if all the job's dependencies have completed, 'failed' if any has not, otherwise 'waiting'."""
+        for dependency in job['dependencies']:
+            dependency = job_number(dependency)
+            if dependency not in self.states:
+                continue
+            states = set(t['state'] for t in self.states[dependency].values())
+            if states - set(unfinished_states + ('COMPLETED',)):
+                return 'failed'
+            if states.intersection(unfinished_states):
+                return 'waiting'
+        return 'ok'
+
+    def _start_tasks(self, changed):
+        now = time()
+        for job_id, job in self.jobs.items():
+            if len(self.running) >= self.slots:
+                return
+            pending = [i for i in self._indexes(job_id) if self.states[job_id][str(i)]['state'] == 'PENDING']
+            if not pending or now < job['submit_time'] + self.queue_delay:
+                continue
+
+            dependency_state = self._dependency_state(job)
+            if dependency_state == 'failed':  # Slurm would keep it pending with DependencyNeverSatisfied
+                for i in pending:
+                    self.states[job_id][str(i)].update(state='CANCELLED', exit_code=0, end=now)
+                changed.add(job_id)
+                continue
+            elif dependency_state == 'waiting':
+                continue
+
+            running = sum(1 for j, i in self.running.values() if j == job_id)
+            for i in pending:
+                if len(self.running) >= self.slots or (job['max_concurrent'] and running >= job['max_concurrent']):
+                    break
+                task = self.states[job_id][str(i)]
+                task['start'] = now
+                if self.random.random() < self.fail_rate:
+                    task.update(state='NODE_FAIL', exit_code=0, end=now)
+                else:
+                    self.running[self._launch(job_id, job, i)] = (job_id, str(i))
+                    task['state'] = 'RUNNING'
+                    running += 1
+                changed.add(job_id)
+
+    def _launch(self, job_id, job, idx):
+        env = dict(os.environ, SLURM_JOB_ID=job_id, PBS_JOBID=job_id)
+        if job['ntasks'] > 1 or job['array']:
+            env.update(SLURM_ARRAY_TASK_ID=str(idx), PBS_ARRAY_INDEX=str(idx))
+        log_file = job['log_file'] or os.path.join(job['working_dir'], 'fake-%s.out' % job_id)
+        with open(log_file, 'a') as log:
+            # keep the Popen, otherwise subprocess would reap the task if it is garbage collected while running
+            return subprocess.Popen(['bash', job['script']], stdout=log, stderr=subprocess.STDOUT, env=env,
+                                    cwd=job['working_dir'], start_new_session=True)
+
+
+# the shims' side, run in separate processes
+
+
+def parse_script(script):
+    """Read the resource manager directives of a job script."""
+    job = {'name': os.path.basename(script), 'ntasks': 1, 'array': False, 'max_concurrent': None,
+           'dependencies': [], 'log_file': None}
+    with open(script) as f:
+        for line in f:
+            m = re.match(r'#(SBATCH|PBS) +(.*)', line.strip())
+            if not m:
+                continue
+            directive = m.group(2)
+            array = re.match(r'(?:--array=|-J )1-(\d+)(?:%(\d+))?', directive)
+            if array:
+                job.update(ntasks=int(array.group(1)), array=True, max_concurrent=int(array.group(2) or 0) or None)
+            dependency = re.match(r'(?:--dependency=|-W depend=)afterok:(.*)', directive)
+            if dependency:
+                job['dependencies'] = dependency.group(1).split(':')
+            name = re.match(r'(?:--job-name=|-N )"?([^"]*)"?', directive)
+            if name:
+                job['name'] = name.group(1)
+            output = re.match(r'(?:--output=|-o )(.*)', directive)
+            if output:
+                job['log_file'] = output.group(1)
+    return job
+
+
+def submit(state_dir, script, kind):
+    config = read_json(os.path.join(state_dir, 'config.json'))
+    if random.random() < config['submit_fail_rate']:
+        print('Batch job submission failed: Resource temporarily unavailable', file=sys.stderr)
+        return 1
+
+    with open(os.path.join(state_dir, 'job_ids.lock'), 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        lock.seek(0)
+        job_id = str(int(lock.read() or 1000) + 1)
+        lock.seek(0)
+        lock.truncate()
+        lock.write(job_id)
+
+    job = parse_script(script)
+    job.update(script=os.path.abspath(script), working_dir=os.getcwd(), submit_time=time())
+    write_json(os.path.join(state_dir, 'jobs', job_id + '.json'), job)
+    if kind == 'slurm':
+        print('Submitted batch job ' + job_id)
+    else:
+        print('%s%s.%s' % (job_id, '[]' if job['array'] else '', server))
+    return 0
+
+
+def load_jobs(state_dir, job_ids):
+    """:return: the job and the state of each of its tasks, for each of the job ids known"""
+    jobs = []
+    for job_id in job_ids:
+        job_id = job_number(job_id)
+        job = read_json(os.path.join(state_dir, 'jobs', job_id + '.json'))
+        if job is None:
+            continue
+        default_states = dict((str(i), {'state': 'PENDING'}) for i in range(1, job['ntasks'] + 1))
+        states = read_json(os.path.join(state_dir, 'states', job_id + '.json'), default_states)
+        jobs.append((job_id, job, sorted(states.items(), key=lambda s: int(s[0]))))
+    return jobs
+
+
+def parse_args(args, flags_with_values):
+    """Split command line arguments into options and positional arguments, e.g. '-nXP -j 1,2 -o A,B'."""
+    opts = {}
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('-'):
+            name, _, value = arg.lstrip('-').partition('=')
+            if name in flags_with_values:
+                opts[name] = value or args.pop(0)
+            else:
+                for flag in (name if not arg.startswith('--') else [name]):
+                    opts[flag] = True
+        else:
+            positional.append(arg)
+    return opts, positional
+
+
+def squeue(state_dir, args):
+    opts, _ = parse_args(args, ('j', 'o'))
+    fmt = opts.get('o', '%i|%T')
+    for job_id, job, states in load_jobs(state_dir, opts.get('j', '').split(',')):
+        for idx, task in states:
+            if task['state'] in unfinished_states:
+                task_id = '%s_%s' % (job_id, idx) if job['array'] else job_id
+                fields = {'F': job_id, 'i': task_id, 'T': task['state'], 'j': job['name']}
+                print(re.sub(r'%(\w)', lambda m: fields.get(m.group(1), ''), fmt))
+    return 0
+
+
+def sacct(state_dir, args):
+    opts, _ = parse_args(args, ('j', 'o'))
+    fields = opts.get('o', 'JobID,State,ExitCode').split(',')
+    for job_id, job, states in load_jobs(state_dir, opts.get('j', '').split(',')):
+        for idx, task in states:
+            task_id = '%s_%s' % (job_id, idx) if job['array'] else job_id
+            elapsed = (task.get('end') or time()) - task['start'] if task.get('start') else 0
+            values = {
+                'JobID': task_id, 'JobName': job['name'], 'State': task['state'],
+                'ExitCode': '%s:0' % (task.get('exit_code') or 0), 'ElapsedRaw': str(int(elapsed)),
+                'UserCPU': '%02d:%06.3f' % divmod(task.get('user_time') or 0, 60),
+                'SystemCPU': '%02d:%06.3f' % divmod(task.get('sys_time') or 0, 60), 'MaxRSS': ''
+            }
+            print('|'.join(values[f] for f in fields))
+            if not opts.get('X') and 'max_rss' in task:  # memory is reported for the batch step
+                values.update(JobID=task_id + '.batch', MaxRSS='%sK' % task['max_rss'])
+                print('|'.join(values[f] for f in fields))
+    return 0
+
+
+def qstat(state_dir, args):
+    opts, job_ids = parse_args(args, ())
+    jobs = load_jobs(state_dir, job_ids)
+    if opts.get('f'):
+        for job_id, job, states in jobs:
+            if job['array']:
+                print('Job Id: %s[].%s\n    Job_Name = %s\n' % (job_id, server, job['name']))
+            for idx, task in states:
+                task_id = '%s[%s].%s' % (job_id, idx, server) if job['array'] else '%s.%s' % (job_id, server)
+                elapsed = (task.get('end') or time()) - task['start'] if task.get('start') else 0
+                lines = ['Job Id: ' + task_id, '    Job_Name = ' + job['name'],
+                         '    resources_used.walltime = ' + format_duration(elapsed)]
+                if 'max_rss' in task:
+                    lines.append('    resources_used.cput = ' + format_duration(task['user_time'] + task['sys_time']))
+                    lines.append('    resources_used.mem = %skb' % task['max_rss'])
+                if task.get('exit_code') is not None:
+                    lines.append('    Exit_status = %s' % task['exit_code'])
+                print('\n'.join(lines) + '\n')
+        return 0
+
+    print('Job id            Name             User              Time Use S Queue')
+    print('----------------  ---------------- ----------------  -------- - -----')
+    for job_id, job, states in jobs:
+        task_states = [task['state'] for idx, task in states]
+        name = job['name'][:15]
+        if job['array']:
+            if any(s == 'RUNNING' for s in task_states):
+                status = 'B'
+            elif all(s == 'PENDING' for s in task_states):
+                status = 'Q'
+            else:
+                status = 'F' if all(s not in unfinished_states for s in task_states) else 'B'
+            print('%s[].%s %s a_user 0 %s fake_queue' % (job_id, server, name, status))
+            if opts.get('t'):
+                for idx, task in states:
+                    print('%s[%s].%s %s a_user 0 %s fake_queue' % (job_id, idx, server, name,
+                                                                    pbs_states.get(task['state'], 'X')))
+        else:
+            print('%s.%s %s a_user 0 %s fake_queue' % (job_id, server, name, pbs_states.get(task_states[0], 'F')))
+    return 0
+
+
+def cancel(state_dir, args):
+    for job_id in args:
+        if os.path.isfile(os.path.join(state_dir, 'jobs', job_number(job_id) + '.json')):
+            open(os.path.join(state_dir, 'cancel', job_number(job_id)), 'w').close()
+    return 0
+
+
+def main(argv):
+    shim, state_dir, args = argv[0], argv[1], argv[2:]
+    with open(os.path.join(state_dir, 'calls.log'), 'a') as f:
+        f.write(shim + '\n')
+
+    if shim in ('sbatch', 'qsub'):
+        return submit(state_dir, args[-1], 'slurm' if shim == 'sbatch' else 'pbs')
+    elif shim == 'squeue':
+        return squeue(state_dir, args)
+    elif shim == 'sacct':
+        return sacct(state_dir, args)
+    elif shim == 'qstat':
+        return qstat(state_dir, args)
+    elif shim in ('scancel', 'qdel'):
+        return cancel(state_dir, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
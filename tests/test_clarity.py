@@ -1,7 +1,17 @@
 import os
+import base64
+import hashlib
+import sys
+import shutil
+import pytest
+import threading
+import requests
+import subprocess
 from unittest.mock import patch, Mock
 from egcg_core import clarity
+from egcg_core.exceptions import EGCGError, LimsCommunicationError
 from tests import TestEGCG
+from tests.fake_lims import FakeLims
 
 clarity._lims = Mock()
 clarity.app_logger = Mock()
@@ -163,17 +173,105 @@ def test_get_sample_gender(mocked_lims):
     mocked_lims.assert_called_with('a_sample_id')
 
 
-@patched_lims('get_file_contents', 'some test content')
+def fake_download(content, headers=None):
+    if headers is None:
+        headers = {'Content-Length': str(len(content)),
+                   'Content-MD5': base64.b64encode(hashlib.md5(content).digest()).decode()}
+    return Mock(headers=headers, iter_content=Mock(return_value=[content[:4], content[4:]]))
+
+
+@patched_lims('get_uri', 'a_file_uri')
+@patched_lims('download', fake_download(b'some test content'))
 @patched_clarity('get_sample', Mock(udf={'Genotyping results file id': 1337}))
-def test_get_genotype_information_from_lims(mocked_get_sample, mocked_file_contents):
+def test_get_genotype_information_from_lims(mocked_get_sample, mocked_download, mocked_get_uri):
     genotype_vcf = os.path.join(TestEGCG.assets_path, 'a_genotype.vcf')
     assert clarity.get_sample_genotype('a_sample_name', genotype_vcf) == genotype_vcf
     mocked_get_sample.assert_called_with('a_sample_name')
-    mocked_file_contents.assert_called_with(id=1337)
+    mocked_get_uri.assert_called_with('files', 1337, 'download')
+    assert mocked_download.call_args[0] == ('a_file_uri',)
+    assert open(genotype_vcf).read() == 'some test content'
+    assert not os.path.isfile(genotype_vcf + '.part')
+
+    # identical file already present
+    mocked_download.return_value.iter_content.reset_mock()
+    assert clarity.get_sample_genotype('a_sample_name', genotype_vcf) == genotype_vcf
+    mocked_download.return_value.iter_content.assert_not_called()
+
+    # file of the same size, but different content
+    with open(genotype_vcf, 'w') as f:
+        f.write('some test CONTENT')
+    assert clarity.get_sample_genotype('a_sample_name', genotype_vcf) == genotype_vcf
+    mocked_download.return_value.iter_content.assert_called_once()
     assert open(genotype_vcf).read() == 'some test content'
     os.remove(genotype_vcf)
 
 
+@patched_lims('get_uri', 'a_file_uri')
+@patched_lims('download', fake_download(b'some test content', {'Content-Length': '17'}))
+def test_download_file_no_checksum(mocked_download, mocked_get_uri):
+    genotype_vcf = os.path.join(TestEGCG.assets_path, 'a_genotype.vcf')
+    with open(genotype_vcf, 'w') as f:
+        f.write('some test CONTENT')
+    assert clarity._download_file(1337, genotype_vcf) == genotype_vcf  # cannot tell if identical, so downloaded
+    assert open(genotype_vcf).read() == 'some test content'
+    os.remove(genotype_vcf)
+
+
+@patched_lims('get_uri', 'a_file_uri')
+@patched_lims('download', fake_download(b'some test content', {'ETag': '"%s"' % hashlib.md5(b'other').hexdigest()}))
+def test_download_file_corrupt(mocked_download, mocked_get_uri):
+    genotype_vcf = os.path.join(TestEGCG.assets_path, 'a_genotype.vcf')
+    with pytest.raises(EGCGError):
+        clarity._download_file(1337, genotype_vcf)
+    assert not os.path.isfile(genotype_vcf)
+    assert not os.path.isfile(genotype_vcf + '.part')
+
+
+@patched_lims('get_uri', 'a_file_uri')
+@patched_lims('download', Mock(headers={}, iter_content=Mock(side_effect=requests.ConnectionError('reset'))))
+def test_download_file_interrupted(mocked_download, mocked_get_uri):
+    genotype_vcf = os.path.join(TestEGCG.assets_path, 'a_genotype.vcf')
+    with pytest.raises(requests.ConnectionError):
+        clarity._download_file(1337, genotype_vcf)
+    assert not os.path.isfile(genotype_vcf + '.part')
+    mocked_download.return_value.close.assert_called_once()
+
+
+@patched_lims('get_uri', 'a_file_uri')
+@patched_lims('download', fake_download(b'some test content', {'Content-Length': '1337'}))
+def test_download_file_incomplete(mocked_download, mocked_get_uri):
+    genotype_vcf = os.path.join(TestEGCG.assets_path, 'a_genotype.vcf')
+    with pytest.raises(EGCGError):
+        clarity._download_file(1337, genotype_vcf)
+    assert not os.path.isfile(genotype_vcf)
+    assert not os.path.isfile(genotype_vcf + '.part')
+
+
+@patched_clarity('_download_file', side_effect=lambda file_id, output_file: output_file)
+@patched_clarity(
+    'get_list_of_samples',
+    [
+        FakeEntity('this', udf={'Genotyping results file id': 1337}),
+        FakeEntity('that:01', udf={'Genotyping results file id': 1338}),
+        FakeEntity('other', udf={})
+    ]
+)
+def test_get_sample_genotypes(mocked_get_samples, mocked_download):
+    obs = clarity.get_sample_genotypes(
+        {'this': 'this.vcf', 'that_01': 'that.vcf', 'other': 'other.vcf', 'missing': 'missing.vcf'}
+    )
+    assert obs == {'this': 'this.vcf', 'that_01': 'that.vcf', 'other': None, 'missing': None}
+    mocked_get_samples.assert_called_once_with(['this', 'that_01', 'other', 'missing'])
+    mocked_download.assert_any_call(1337, 'this.vcf')
+    mocked_download.assert_any_call(1338, 'that.vcf')
+    assert mocked_download.call_count == 2
+
+    # a failed download only loses its own sample's result
+    mocked_download.side_effect = lambda file_id, output_file: output_file if file_id == 1337 else 1 / 0
+    obs = clarity.get_sample_genotypes({'this': 'this.vcf', 'that_01': 'that.vcf'})
+    assert obs == {'this': 'this.vcf', 'that_01': None}
+
+
 @patched_clarity('get_sample', Mock(udf={'Yield for Quoted Coverage (Gb)': 3}))
 def test_get_expected_yield_for_sample(mocked_get_sample):
     assert clarity.get_expected_yield_for_sample('a_sample_id') == 3000000000
@@ -187,14 +285,43 @@ def test_get_run(mocked_lims):
 
 
 @patched_lims('route_artifacts')
-@patched_clarity('get_sample', side_effect=[Mock(artifact='this'), Mock(artifact='that')])
+@patched_clarity(
+    'get_list_of_samples',
+    [
+        FakeEntity('this', artifact='this_art'),
+        FakeEntity('that:01', artifact='that_art'),
+        FakeEntity('other', artifact='other_art')
+    ]
+)
 @patched_lims('get_uri', 'a_workflow_uri')
-def test_route_samples_to_delivery_workflow(mocked_get_uri, mocked_get_sample, mocked_route):
-    clarity.route_samples_to_delivery_workflow(['a_sample_id', 'another_sample_id'])
+def test_route_samples_to_delivery_workflow(mocked_get_uri, mocked_get_samples, mocked_route):
+    report = clarity.route_samples_to_delivery_workflow(['this', 'that_01', 'missing', 'other'])
     mocked_get_uri.assert_called_with('configuration', 'workflows', '401')
-    mocked_get_sample.assert_any_call('a_sample_id')
-    mocked_get_sample.assert_any_call('another_sample_id')
-    mocked_route.assert_called_with(['this', 'that'], workflow_uri='a_workflow_uri')
+    mocked_get_samples.assert_called_once_with(['this', 'that_01', 'missing', 'other'])
+    mocked_route.assert_called_once_with(['this_art', 'that_art', 'other_art'], workflow_uri='a_workflow_uri')
+    assert report == {'routed': ['this', 'that_01', 'other'], 'unresolved': ['missing'], 'failed': []}
+
+
+@patched_lims('route_artifacts', side_effect=[requests.exceptions.HTTPError('an error'), None] * 2)
+@patched_clarity(
+    'get_list_of_samples',
+    [
+        FakeEntity('this', artifact='this_art'),
+        FakeEntity('that', artifact='that_art'),
+        FakeEntity('other', artifact='other_art')
+    ]
+)
+@patched_lims('get_uri', 'a_workflow_uri')
+def test_route_samples_to_delivery_workflow_chunked(mocked_get_uri, mocked_get_samples, mocked_route):
+    with pytest.raises(requests.exceptions.HTTPError):
+        clarity.route_samples_to_delivery_workflow(['this', 'that', 'other'], chunk_size=2)
+    assert mocked_route.call_count == 2  # all chunks are tried before raising
+
+    report = clarity.route_samples_to_delivery_workflow(['this', 'that', 'other'], chunk_size=2,
+                                                        raise_on_failure=False)
+    mocked_route.assert_any_call(['this_art', 'that_art'], workflow_uri='a_workflow_uri')
+    mocked_route.assert_any_call(['other_art'], workflow_uri='a_workflow_uri')
+    assert report == {'routed': ['other'], 'unresolved': [], 'failed': ['this', 'that']}
 
 
 @patched_clarity('get_samples', [Mock(artifact=Mock(location=(FakeEntity('a_plate'), 'a_well')))])
@@ -276,3 +403,152 @@ def test_get_sample_release_date(mocked_get_procs, mocked_get_sample):
     clarity.app_logger.warning.assert_called_with(
         '%s Processes found for sample %s: Return latest one', 2, 'a_sample_name2'
     )
+
+
+class TestConnection(TestEGCG):
+    def setUp(self):
+        self.original_lims = clarity._lims
+        clarity._lims = None
+        clarity.lims_stats.reset()
+        self.cfg = patched('cfg.content', new={'clarity': {'baseuri': 'http://a_lims', 'username': 'a_user',
+                                                           'password': 'a_password', 'pool_maxsize': 4}})
+        self.cfg.start()
+
+    def tearDown(self):
+        self.cfg.stop()
+        clarity._lims = self.original_lims
+        clarity.lims_stats.reset()
+
+    def test_connection(self):
+        lims = clarity.connection()
+        assert isinstance(lims, clarity.InstrumentedLims)
+        assert lims.adapter._pool_maxsize == 4
+        assert lims.request_session.get_adapter('https://a_lims') is lims.adapter
+        assert clarity.connection() is lims
+
+    def test_connection_threaded(self):
+        connections = []
+        threads = [threading.Thread(target=lambda: connections.append(clarity.connection())) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(id(c) for c in connections)) == 1
+
+    def test_other_config(self):
+        clarity.cfg.content['clarity']['route_chunk_size'] = 50  # not a connection argument
+        assert isinstance(clarity.connection(), clarity.InstrumentedLims)
+
+    def test_per_thread_connection(self):
+        clarity.cfg.content['clarity']['per_thread_connection'] = True
+        connections = [clarity.connection()]
+        t = threading.Thread(target=lambda: connections.append(clarity.connection()))
+        t.start()
+        t.join()
+        assert connections[0] is clarity.connection()
+        assert connections[0] is not connections[1]
+        assert clarity._lims is None
+
+    def test_download(self):
+        clarity.cfg.content['clarity']['timeout'] = 30
+        lims = clarity.connection()
+        with patch.object(lims.request_session, 'get', return_value='a_response') as mocked_get:
+            assert lims.download('http://a_lims/api/v2/files/1337/download') == 'a_response'
+        mocked_get.assert_called_with('http://a_lims/api/v2/files/1337/download', auth=('a_user', 'a_password'),
+                                      timeout=30, stream=True)
+        assert clarity.lims_stats.report()['files']['requests'] == 1
+
+        default_lims = clarity.InstrumentedLims('http://a_lims', 'a_user', 'a_password')
+        assert default_lims.adapter._pool_maxsize == 100
+        assert default_lims.timeout == 16
+
+    def test_endpoint_type(self):
+        lims = clarity.connection()
+        assert lims.endpoint_type('http://a_lims/api/v2/samples?name=this') == 'samples'
+        assert lims.endpoint_type('http://a_lims/api/v2/artifacts/batch/retrieve') == 'artifacts/batch'
+        assert lims.endpoint_type('http://a_lims/api/v2') == 'root'
+
+    def test_stats(self):
+        lims = clarity.connection()
+        ptime = patched('time', side_effect=[1, 3, 4, 5])
+        with patch('genologics.lims.Lims.get', return_value='a_response'), ptime:
+            assert lims.get('http://a_lims/api/v2/samples') == 'a_response'
+            lims.get('http://a_lims/api/v2/samples/a_sample')
+        assert clarity.lims_stats.report() == {'samples': {'requests': 2, 'total_time': 3, 'mean_time': 1.5}}
+
+
+class TestLimsRequests(TestEGCG):
+    """Track the number of Lims requests made by the clarity helpers against an offline FakeLims."""
+    def setUp(self):
+        self.lims = FakeLims()
+        self.sample_names = self.lims.add_project('a_project', 250)
+        self.lims.reset()
+        self.patched_lims = patched('_lims', new=self.lims)
+        self.patched_lims.start()
+
+    def tearDown(self):
+        self.patched_lims.stop()
+
+    def test_get_list_of_samples(self):
+        samples = clarity.get_list_of_samples(self.sample_names)
+        assert sorted(s.name for s in samples) == self.sample_names
+        assert self.lims.requests == {'samples': 3, 'samples/batch': 3}
+
+    def test_route_samples_to_delivery_workflow(self):
+        report = clarity.route_samples_to_delivery_workflow(self.sample_names + ['missing'])
+        assert report['routed'] == self.sample_names
+        assert report['unresolved'] == ['missing']
+        assert len(self.lims.routed) == 250
+        assert self.lims.requests == {'samples': 5, 'samples/batch': 3, 'route': 3}
+
+    def test_get_sample_genotypes(self):
+        output_dir = os.path.join(TestEGCG.assets_path, 'genotypes')
+        os.makedirs(output_dir, exist_ok=True)
+        genotypes = clarity.get_sample_genotypes(
+            dict((s, os.path.join(output_dir, s + '.vcf')) for s in self.sample_names)
+        )
+        assert sorted(genotypes) == self.sample_names
+        assert self.lims.requests == {'samples': 3, 'samples/batch': 3, 'files': 250}
+        shutil.rmtree(output_dir)
+
+    def test_get_plate_id_and_well(self):
+        assert clarity.get_plate_id_and_well(self.sample_names[100]) == ('a_project_P002', 'E:1')
+        assert self.lims.requests == {'samples': 2, 'artifacts': 1, 'containers': 1}
+
+    def test_export_project_snapshot(self):
+        snapshot_file = os.path.join(TestEGCG.assets_path, 'a_snapshot.sqlite')
+        assert clarity.export_project_snapshot('a_project', snapshot_file) == 250
+        assert self.lims.requests == {
+            'samples': 1, 'samples/batch': 1, 'artifacts/batch': 2, 'containers/batch': 1,
+            'containertypes': 1, 'processes': 6
+        }
+
+        self.lims.reset()
+        clarity.use_snapshot(snapshot_file)
+        try:
+            sample_name = self.sample_names[100]
+            assert clarity.get_plate_id_and_well(sample_name) == ('a_project_P002', 'E:1')
+            assert clarity.get_user_sample_name(sample_name) == 'user_' + sample_name
+            assert clarity.get_sample_gender(sample_name) == 'Female'
+            assert clarity.get_expected_yield_for_sample(sample_name) == 120000000000
+            assert clarity.get_sample_release_date(sample_name) == '2017-06-01'
+            assert list(clarity.find_run_elements_from_sample(sample_name)) == [
+                ('a_project_RUN1', str(lane)) for lane in range(1, 8)
+            ]
+            assert clarity.find_project_name_from_sample(sample_name) == 'a_project'
+            assert clarity.get_sample_names_from_project('a_project') == self.sample_names
+            assert len(clarity.get_samples_arrived_with(sample_name)) == 96
+            assert len(clarity.get_list_of_samples(self.sample_names)) == 250
+            assert clarity.get_sample(sample_name + '_01') is None
+            with pytest.raises(LimsCommunicationError):
+                clarity.get_run('a_project_RUN1')
+            assert self.lims.nrequests == 0
+        finally:
+            clarity.use_snapshot(None)
+            os.remove(snapshot_file)
+
+
+def test_import_without_sqlite():
+    # LimsSnapshot is only needed for offline mode, so the module should import without sqlite3
+    cmd = "import sys; sys.modules['sqlite3'] = None; import egcg_core.clarity"
+    assert subprocess.call([sys.executable, '-c', cmd]) == 0
@@ -0,0 +1,152 @@
+import os
+import shutil
+import pytest
+from time import sleep
+from unittest.mock import patch
+from tests import TestEGCG
+from tests.fake_scheduler import FakeScheduler
+from egcg_core.executor import CommandCache, CachedExecutor, local_execute, cluster_execute, execute
+from egcg_core.executor.cluster_executor import JobStatusPoller, running_executors
+from egcg_core.executor.command_cache import caches, get_cache, per_command
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+
+
+def test_per_command():
+    assert per_command(None, 2) == [[], []]
+    assert per_command(['a', 'b'], 2) == [['a', 'b'], ['a', 'b']]
+    assert per_command([['a'], ('b', 'c')], 2) == [['a'], ['b', 'c']]
+    with pytest.raises(EGCGError):
+        per_command([['a'], ['b']], 3)
+
+
+class TestCommandCache(TestEGCG):
+    working_dir = os.path.join(TestEGCG.assets_path, 'a_cached_run')
+
+    def setUp(self):
+        os.makedirs(self.working_dir, exist_ok=True)
+        self.index_file = self.path('cache.sqlite')
+        self.config = patch.dict(cfg.content['executor'], command_cache=self.index_file, join_min_interval=0.05,
+                                 join_interval=0.1, status_max_age=0.01)
+        self.config.start()
+        self.cache = get_cache()
+        with open(self.path('input.txt'), 'w') as f:
+            f.write('some input\n')
+
+    def tearDown(self):
+        self.config.stop()
+        for c in caches.values():
+            c.close()
+        caches.clear()
+        JobStatusPoller.pollers.clear()
+        running_executors.clear()
+        shutil.rmtree(self.working_dir)
+
+    def path(self, f):
+        return os.path.join(self.working_dir, f)
+
+    def test_key(self):
+        key = self.cache.key('cat $SOME_VAR', [self.path('input.txt')])
+        assert self.cache.key('cat $SOME_VAR', [self.path('input.txt')]) == key
+        assert self.cache.key('cat $SOME_VAR', [self.path('input.txt')], working_dir=self.working_dir) != key
+        assert self.cache.key('cat $SOME_VAR', [self.path('input.txt')], extra={'shell': True}) != key
+        assert self.cache.key('cat $OTHER_VAR', [self.path('input.txt')]) != key
+
+        with patch.dict(os.environ, SOME_VAR='a value'):
+            assert self.cache.key('cat $SOME_VAR', [self.path('input.txt')]) != key
+        with patch.dict(os.environ, UNRELATED_VAR='a value'):
+            assert self.cache.key('cat $SOME_VAR', [self.path('input.txt')]) == key
+
+        hashing_cache = CommandCache(self.path('other_cache.sqlite'), hash_inputs=True)
+        hashed_key = hashing_cache.key('cat', [self.path('input.txt')])
+        os.utime(self.path('input.txt'), ns=(1000000000, 1000000000))
+        assert self.cache.key('cat $SOME_VAR', [self.path('input.txt')]) != key
+        assert hashing_cache.key('cat', [self.path('input.txt')]) == hashed_key
+        with open(self.path('input.txt'), 'w') as f:
+            f.write('other input\n')
+        assert hashing_cache.key('cat', [self.path('input.txt')]) != hashed_key
+        hashing_cache.close()
+
+    def test_record(self):
+        key = self.cache.key('a_cmd')
+        assert not self.cache.is_cached(key)
+        assert not self.cache.record(key, 'a_cmd', [self.path('output.txt')])  # output missing
+        assert not self.cache.is_cached(key)
+
+        shutil.copy(self.path('input.txt'), self.path('output.txt'))
+        assert self.cache.record(key, 'a_cmd', [self.path('output.txt')])
+        assert self.cache.is_cached(key)
+        assert CommandCache(self.index_file).is_cached(key)
+
+        with open(self.path('output.txt'), 'a') as f:
+            f.write('more output\n')
+        assert not self.cache.is_cached(key)
+
+        self.cache.record(key, 'a_cmd')
+        assert self.cache.is_cached(key)
+        self.cache.invalidate(key)
+        assert not self.cache.is_cached(key)
+
+    def test_local_execute(self):
+        cmds = ['cp %s %s' % (self.path('input.txt'), self.path('output1.txt')), 'ls a_non_existent_file']
+        outputs = [[self.path('output1.txt')], [self.path('output2.txt')]]
+        e = local_execute(*cmds, cache=True, inputs=[self.path('input.txt')], outputs=outputs, cpus=[1, 2])
+        assert isinstance(e, CachedExecutor)
+        assert e.to_run == [0, 1]
+        assert e.join() == 2
+        assert len(e.usages) == 2
+
+        e = local_execute(*cmds, cache=True, inputs=[self.path('input.txt')], outputs=outputs, cpus=[1, 2])
+        assert e.to_run == [1]  # only the failed command runs again
+        assert e.executor.cmd == cmds[1]
+        assert e.join() == 2
+
+        e = execute(cmds[0], env='local', cache=True, inputs=[self.path('input.txt')], outputs=outputs[0])
+        assert e.executor is None
+        assert e.join() == 0
+        assert e.usages == []
+
+        os.remove(self.path('output1.txt'))
+        e = execute(cmds[0], env='local', cache=True, inputs=[self.path('input.txt')], outputs=outputs[0])
+        assert e.to_run == [0]
+        assert e.join() == 0
+
+    def test_cluster_execute(self):
+        cmds = ['cp %s %s' % (self.path('input.txt'), self.path('output%s.txt' % i)) for i in (1, 2)] + ['exit 3']
+        with FakeScheduler('slurm') as scheduler:
+            e = cluster_execute(*cmds, job_name='a_job', working_dir=self.working_dir, cache=True,
+                                inputs=[self.path('input.txt')], cmd_costs=[1, 2, 3])
+            assert e.join() == 3
+            assert e.job_id
+            e = cluster_execute(*cmds, job_name='a_job', working_dir=self.working_dir, cache=True,
+                                inputs=[self.path('input.txt')], cmd_costs=[1, 2, 3])
+            assert e.to_run == [2]
+            assert e.cmds == tuple(cmds)
+            assert e.executor.cmds == ('exit 3',)
+            assert e.executor.writer.cluster_config['cmd_costs'] == [3]
+            while e.poll() is None:
+                sleep(0.05)
+            assert e.exit_status == 3
+            assert scheduler.calls['sbatch'] == 2
+
+            e = cluster_execute(*cmds[:2], job_name='a_job', working_dir=self.working_dir, cache=True,
+                                inputs=[self.path('input.txt')])
+            assert e.poll() == 0
+            assert scheduler.calls['sbatch'] == 2
+
+    def test_cancelled_cluster_task(self):
+        # cancelled Slurm tasks have the exit code 0 in sacct, but are not recorded as successes
+        outputs = [[self.path('output1.txt')], [self.path('output2.txt')]]
+        for o in outputs:
+            open(o[0], 'w').close()  # e.g. left over from an interrupted run
+        with FakeScheduler('slurm', queue_delay=60):
+            e = cluster_execute('true', 'true', job_name='a_job', working_dir=self.working_dir, cache=True,
+                                outputs=outputs)
+            e.cancel_job()
+            assert e.join() == 9
+        assert [u.exit_status for u in e.usages] == [9, 9]
+        assert not any(self.cache.is_cached(k) for k in e.keys)
+
+    def test_no_cache(self):
+        with patch.dict(cfg.content['executor'], command_cache=None), pytest.raises(EGCGError):
+            local_execute('ls', cache=True)
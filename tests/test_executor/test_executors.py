@@ -1,17 +1,74 @@
 import os
+import signal
 import pytest
 import shutil
+import threading
 import subprocess
+from time import time
 from unittest.mock import patch, Mock
 from tests import TestEGCG
-from egcg_core.executor import Executor, StreamExecutor, ArrayExecutor, PBSExecutor, SlurmExecutor
-from egcg_core.executor.cluster_executor import ClusterExecutor, running_executors, stop_running_jobs
+from tests.fake_scheduler import FakeScheduler
+from egcg_core.executor import Executor, StreamExecutor, ArrayExecutor, PBSExecutor, SlurmExecutor, JobGraph, \
+    cluster_execute
+from egcg_core.executor.executor import OutputStream
+from egcg_core.executor.cluster_executor import ClusterExecutor, JobStatusPoller, running_executors, \
+    stop_running_jobs, stop_jobs_on_signal
+from egcg_core.executor.submission_queue import SubmissionQueue, TokenBucket, backoff
+from egcg_core.config import cfg
 from egcg_core.exceptions import EGCGError
 
 get_stdout = 'egcg_core.executor.cluster_executor.ClusterExecutor._get_stdout'
 sleep = 'egcg_core.executor.cluster_executor.sleep'
 
 
+class TestOutputStream(TestEGCG):
+    def test_read(self):
+        read_fd, write_fd = os.pipe()
+        lines = []
+        stream = OutputStream(os.fdopen(read_fd, 'rb'), lines.append, prefix='> ')
+        os.write(write_fd, b'this\nth')
+        assert stream.read()
+        assert lines == ['> this']
+        os.write(write_fd, b'at\n\nother')
+        assert stream.read()
+        assert lines == ['> this', '> that']
+        os.close(write_fd)
+        assert not stream.read()
+        assert lines == ['> this', '> that', '> other']
+        assert stream.stream.closed
+
+    def test_progress_bar_and_long_lines(self):
+        read_fd, write_fd = os.pipe()
+        lines = []
+        stream = OutputStream(os.fdopen(read_fd, 'rb'), lines.append)
+        stream.max_line_length = 4
+        os.write(write_fd, b'10%\r20%\rthisthatother')
+        assert stream.read()
+        assert lines == ['10%', '20%', 'this', 'that', 'othe']
+        assert stream.partial == b'r'
+
+    def test_sample_every(self):
+        read_fd, write_fd = os.pipe()
+        lines = []
+        stream = OutputStream(os.fdopen(read_fd, 'rb'), lines.append, sample_every=3)
+        os.write(write_fd, ''.join('line %s\n' % i for i in range(7)).encode())
+        os.close(write_fd)
+        while stream.read():
+            pass
+        assert lines == ['line 0', 'line 3', 'line 6', '7 lines of output, 3 logged']
+
+    @patch('egcg_core.executor.executor.time', side_effect=[1, 1.1, 1.2, 1.3, 2.5])
+    def test_max_line_rate(self, mocked_time):
+        read_fd, write_fd = os.pipe()
+        lines = []
+        stream = OutputStream(os.fdopen(read_fd, 'rb'), lines.append, max_line_rate=2)
+        os.write(write_fd, b'this\nthat\nother\nanother\nmore\n')
+        os.close(write_fd)
+        while stream.read():
+            pass
+        assert lines == ['this', 'that', '2 lines not logged', 'more', '5 lines of output, 3 logged']
+
+
 class TestExecutor(TestEGCG):
     def test_cmd(self):
         e = Executor('ls ' + os.path.join(self.assets_path, '..'))
@@ -30,6 +87,49 @@ class TestExecutor(TestEGCG):
         proc = e._process()
         assert proc is e.proc and isinstance(e.proc, subprocess.Popen)
 
+    def test_process_group(self):
+        # the command gets its own process group, but stays in this session to keep the controlling terminal
+        e = Executor('sleep 10')
+        proc = e._process()
+        assert os.getpgid(proc.pid) == proc.pid
+        assert os.getsid(proc.pid) == os.getsid(0)
+        e.kill()
+        assert e._wait() == -9
+
+    def test_capture_to_file(self):
+        log_file = os.path.join(self.assets_path, 'a_cmd.log')
+        e = Executor('seq 1 1000', capture='file', log_file=log_file, tail_lines=3)
+        e.info = Mock()
+        assert e.join() == 0
+        assert open(log_file).read() == ''.join('%s\n' % i for i in range(1, 1001))
+        assert list(e.stdout_tail) == ['998', '999', '1000']
+        e.info.assert_called_once_with('Executing: seq 1 1000')
+        os.remove(log_file)
+
+    def test_capture_discard(self):
+        e = Executor('bash -c "seq 1 5; echo an_error >&2; exit 3"', capture='discard', tail_lines=2)
+        e.error = Mock()
+        assert e.join() == 3
+        assert list(e.stdout_tail) == ['4', '5']
+        assert list(e.stderr_tail) == ['an_error']
+        e.error.assert_any_call('%s: %s', 'stdout', '5')
+        e.error.assert_called_with('%s: %s', 'stderr', 'an_error')
+
+    def test_capture_config(self):
+        with pytest.raises(EGCGError):
+            Executor('ls', capture='a_mode')
+        with pytest.raises(EGCGError):
+            Executor('ls', capture='file')
+
+    def test_timeout(self):
+        start = time()
+        e = Executor('sleep 10', timeout=0.2)
+        assert e.join() == 124
+        assert e.exit_reason == 'timeout'
+        assert Executor('sleep 10', capture='discard', timeout=0.2).join() == 124
+        assert Executor('sleep 0.1', timeout=5).join() == 0
+        assert time() - start < 5
+
 
 class TestStreamExecutor(TestExecutor):
     def test_cmd(self):
@@ -42,6 +142,44 @@ class TestStreamExecutor(TestExecutor):
         e.start()
         assert e.join() == 13  # same exit status as the running script
 
+    def test_chatty_cmd(self):
+        e = StreamExecutor('seq 1 10000', max_line_rate=5)
+        e.info = Mock()
+        e.start()
+        assert e.join() == 0
+        assert e.info.call_count < 20
+        assert e.info.call_args[0][0].startswith('10000 lines of output, ')
+
+    def test_timeout(self):
+        start = time()
+        # SIGTERM is ignored, so SIGKILL is needed after the grace period
+        e = StreamExecutor('bash -c "trap \'\' TERM; sleep 10"', timeout=0.2, kill_grace=0.2)
+        e.start()
+        assert e.join() == 124
+        assert e.proc.returncode == -9
+
+        # the whole process group is terminated, including the backgrounded sleep holding stdout open
+        e = StreamExecutor('bash -c "sleep 10 & sleep 10" | cat', timeout=0.2)
+        e.start()
+        assert e.join() == 124
+        assert time() - start < 5
+
+    def test_kill(self):
+        e = StreamExecutor('sleep 10')
+        e.start()
+        while e.proc is None:
+            threading.Event().wait(0.01)
+        e.kill()
+        assert e.join() == -9
+
+    def test_usage_recorded_on_exit(self):
+        e = StreamExecutor('sleep 0.2')
+        e.start()
+        assert e.join(timeout=0.01) is None  # still running
+        threading.Event().wait(1)
+        assert e.join() == 0
+        assert e.usage.wall_time < 0.8  # timed when the command finished, not when joined
+
     def test_dodgy_cmd(self):
         with pytest.raises(EGCGError) as err:
             e = StreamExecutor('dodgy_cmd')
@@ -71,6 +209,87 @@ class TestArrayExecutor(TestExecutor):
         assert 'Commands failed' in str(err)
         e.error.assert_called_with('EGCGError: self.proc command failed: non_existent_cmd')
 
+    def test_max_parallel(self):
+        e = ArrayExecutor(['sleep 0.2', 'sleep 0.2', 'sleep 0.2', 'ls'], stream=True, max_parallel=2)
+        running = []
+        can_start = e._can_start
+
+        def patched_can_start(idx, _running):
+            running.append(len(_running))
+            return can_start(idx, _running)
+
+        e._can_start = patched_can_start
+        e.start()
+        assert e.join() == 0
+        assert e.exit_statuses == [0, 0, 0, 0]
+        assert max(running) == 2
+
+    def test_exit_statuses_in_order(self):
+        e = ArrayExecutor(['bash -c "sleep 0.2; exit 1"', 'bash -c "exit 2"', 'ls'], stream=True, max_parallel=3)
+        e.start()
+        assert e.join() == 3
+        assert e.exit_statuses == [1, 2, 0]
+
+    def test_constant_thread_count(self):
+        nthreads = []
+        e = ArrayExecutor(['bash -c "sleep 0.2; echo this$i"'] * 50, stream=True, max_parallel=50)
+        for s in e.executors:
+            s.info = lambda msg: nthreads.append(threading.active_count())
+        e.start()
+        assert e.join() == 0
+        assert len(nthreads) == 100  # 'Executing: ...' and 'this' for each command
+        assert max(nthreads) <= threading.active_count() + 1
+
+    def test_prefixed_output(self):
+        e = ArrayExecutor(['echo this', 'bash -c "echo that >&2"'], stream=True, max_parallel=2)
+        for s in e.executors:
+            s.info = Mock()
+            s.error = Mock()
+        e.start()
+        assert e.join() == 0
+        e.executors[0].info.assert_called_with('[1] this')
+        e.executors[1].error.assert_called_with('[2] that')
+
+    def test_can_start(self):
+        e = ArrayExecutor(['this', 'that', 'other'], stream=True, max_parallel=4, cpus=[2, 2, 8], mem=[4, 2, 1],
+                          max_mem=5)
+        assert e._can_start(0, set())
+        assert not e._can_start(1, {0})  # not enough memory
+        assert not e._can_start(1, {2})  # not enough slots
+        assert e._can_start(2, set())  # too big, but can run alone
+
+    def test_timeouts(self):
+        start = time()
+        e = ArrayExecutor(['sleep 0.1', 'sleep 10', 'sleep 10', 'sleep 0.1'], stream=True, max_parallel=2, timeout=0.5)
+        e.start()
+        e.join()
+        assert e.exit_statuses == [0, 124, 124, 0]
+
+        e = ArrayExecutor(['sleep 10', 'sleep 0.1', 'sleep 10'], stream=True, max_parallel=1, total_timeout=0.3)
+        e.start()
+        e.join()
+        assert e.exit_statuses == [124, 124, 124]
+
+        e = ArrayExecutor(['sleep 10', 'sleep 0.1'], stream=False, total_timeout=0.3)
+        e.start()
+        e.join()
+        assert e.exit_statuses == [124, 124]
+        assert time() - start < 5
+
+    def test_fail_fast(self):
+        start = time()
+        e = ArrayExecutor(['sleep 10', 'false', 'sleep 10', 'sleep 10'], stream=True, max_parallel=3, fail_fast=True)
+        e.start()
+        e.join()
+        assert e.exit_statuses == [143, 1, 143, 143]
+        assert e.executors[3].proc is None  # never started
+
+        e = ArrayExecutor(['true', 'false', 'true'], stream=False, fail_fast=True)
+        e.start()
+        e.join()
+        assert e.exit_statuses == [0, 1, 143]
+        assert time() - start < 5
+
 
 class TestClusterExecutor(TestEGCG):
     ppath = 'egcg_core.executor.cluster_executor.ClusterExecutor'
@@ -86,6 +305,8 @@ class TestClusterExecutor(TestEGCG):
 
     def tearDown(self):
         shutil.rmtree(os.path.join(self.assets_path, 'a_run_id'))
+        JobStatusPoller.pollers.clear()
+        running_executors.clear()
 
     def test_get_stdout(self):
         popen = 'egcg_core.executor.executor.subprocess.Popen'
@@ -94,9 +315,18 @@ class TestClusterExecutor(TestEGCG):
             p.assert_called_with(['ls', '-d', self.assets_path], stdout=-1, stderr=-1)
 
     def test_run_and_retry(self):
-        with patch(get_stdout, side_effect=[None, None, self.assets_path]) as p, patch(sleep):
+        with patch(get_stdout, side_effect=[None, None, self.assets_path]) as p, patch(sleep) as mocked_sleep:
             assert self.executor._run_and_retry('ls -d ' + self.assets_path).endswith('tests/assets')
             assert p.call_count == 3
+        waits = [c[0][0] for c in mocked_sleep.call_args_list]
+        assert len(waits) == 2
+        assert 0.5 <= waits[0] <= 1 and 1 <= waits[1] <= 2
+
+        limiter = Mock()
+        with patch(get_stdout, return_value=None) as p, patch(sleep) as mocked_sleep:
+            assert self.executor._run_and_retry('ls', limiter=limiter) is None
+            assert p.call_count == limiter.acquire.call_count == 3
+            assert mocked_sleep.call_count == 2  # not after the last attempt
 
     def test_dodgy_cmd(self):
         with pytest.raises(EGCGError) as err, patch(get_stdout, return_value=None), patch(sleep):
@@ -104,6 +334,18 @@ class TestClusterExecutor(TestEGCG):
             self.executor.start()
             assert str(err) == 'Job submission failed'
 
+    def test_submission_retries(self):
+        with patch(get_stdout, return_value=None) as p, patch(sleep) as mocked_sleep, pytest.raises(EGCGError):
+            self.executor._submit_job()
+        assert p.call_count == 5
+        assert sum(c[0][0] for c in mocked_sleep.call_args_list) >= 15  # at least the previous 2 * 5s
+
+        with patch.dict(cfg.content['executor'], submit_retries=2, submit_retry_backoff=10), \
+                patch(get_stdout, return_value=None) as p, patch(sleep) as mocked_sleep, pytest.raises(EGCGError):
+            self.executor._submit_job()
+        assert p.call_count == 2
+        assert 5 <= mocked_sleep.call_args[0][0] <= 10
+
     def test_join(self):
         job_finished = self.ppath + '._job_finished'
         exit_code = self.ppath + '._job_exit_code'
@@ -111,10 +353,140 @@ class TestClusterExecutor(TestEGCG):
         with patch(job_finished, return_value=True), patch(exit_code, return_value=0), patch(sleep):
             assert self.executor.join() == 0
 
+    def test_poll_finished(self):
+        job_finished = self.ppath + '._job_finished'
+        exit_code = self.ppath + '._job_exit_code'
+        finish = self.ppath + '._finish'
+        with patch(job_finished, side_effect=[False, True]) as mocked_job_finished, \
+                patch(exit_code, return_value=3), patch(finish) as mocked_finish:
+            assert self.executor.poll() is None
+            assert [self.executor.poll() for i in range(3)] == [3, 3, 3]
+            assert self.executor.join() == 3
+        assert mocked_job_finished.call_count == 2  # not queried again once finished
+        mocked_finish.assert_called_once_with(3)
+
+    def test_join_backoff(self):
+        job_finished = self.ppath + '._job_finished'
+        exit_code = self.ppath + '._job_exit_code'
+        with patch(job_finished, side_effect=[False] * 5 + [True]), patch(exit_code, return_value=3), \
+                patch(sleep) as mocked_sleep:
+            assert self.executor.join() == 3
+        assert [c[0][0] for c in mocked_sleep.call_args_list] == [5, 10, 20, 30, 30, 30]
+
+    def test_join_exit_status_files(self):
+        self.executor.use_exit_status_files = True
+        self.executor.cmds = ['a_cmd', 'another_cmd']
+        self.executor.write_script()
+        lines = self.executor.writer.lines
+        assert lines[lines.index('cd ' + os.path.join(self.assets_path, 'a_run_id')) + 2].startswith('trap ')
+
+        exit_status_files = self.executor._exit_status_files()
+        assert exit_status_files == [os.path.join(self.assets_path, 'a_run_id', 'test_job.exit' + i) for i in '12']
+        for f, exit_status in zip(exit_status_files, ('0', '2')):
+            with open(f, 'w') as open_file:
+                open_file.write(exit_status + '\n')
+
+        job_finished = self.ppath + '._job_finished'
+        with patch(job_finished, return_value=False) as mocked_job_finished, patch(sleep) as mocked_sleep:
+            assert self.executor.join() == 2
+        assert mocked_sleep.call_count == 1
+        mocked_job_finished.assert_not_called()
+
+        # exit status files from a previous run of the job are removed
+        e = self.executor.__class__(
+            'a_cmd', 'another_cmd', job_name='test_job', working_dir=os.path.join(self.assets_path, 'a_run_id')
+        )
+        e.use_exit_status_files = True
+        e.write_script()
+        assert not any(os.path.isfile(f) for f in exit_status_files)
+
+    def test_status_files(self):
+        self.executor.use_status_files = True
+        self.executor.use_exit_status_files = True
+        self.executor.cmds = ['echo this', 'sleep 0.1; exit 3']
+        self.executor.write_script()
+
+        # run the job array's tasks as the resource manager would
+        env = dict(os.environ)
+        for task in ('1', '2'):
+            env[self.executor.writer.array_index] = task
+            subprocess.call(['bash', self.executor.writer.script_name], env=env)
+
+        statuses = self.executor.task_statuses()
+        assert [[(s['label'], s['exit_status']) for s in statuses[t]] for t in (1, 2)] == [
+            [('prelim1', 1), ('cmd1', 0)],  # 'source bashrc' fails in the test environment
+            [('prelim1', 1), ('cmd2', 3)]
+        ]
+
+        self.executor.job_id = '1337'
+        job_finished = self.ppath + '._job_finished'
+        usage = self.ppath + '._resource_usage'
+        with patch(job_finished) as mocked_job_finished, patch(usage) as mocked_usage, patch(sleep):
+            assert self.executor.join() == 3
+        mocked_job_finished.assert_not_called()
+        mocked_usage.assert_not_called()
+        assert [(u.cmd, u.job_id, u.exit_status) for u in self.executor.usages] == [
+            ('echo this', self.executor._task_id(1), 0), ('sleep 0.1; exit 3', self.executor._task_id(2), 3)
+        ]
+        assert self.executor.usages[1].wall_time >= 0.1
+
+        # with a task's status file missing, usage comes from the resource manager
+        os.remove(self.executor._status_files()[1])
+        with patch(usage, return_value=['a_usage']):
+            self.executor._collect_usage()
+        assert self.executor.usages == ['a_usage']
+
+    def _fake_attempts(self, task_statuses):
+        """Make submitted jobs write the given exit status for each of their array tasks, by job name."""
+        job_ids = iter(range(1337, 1347))
+
+        def fake_submit(executor):
+            executor.job_id = str(next(job_ids))
+            for f, exit_status in zip(executor._exit_status_files(), task_statuses[executor.job_name]):
+                with open(f, 'w') as open_file:
+                    open_file.write(str(exit_status))
+
+        return patch(self.ppath + '._submit_job', new=fake_submit)
+
+    def test_retries(self):
+        working_dir = os.path.join(self.assets_path, 'a_run_id')
+        task_statuses = {'test_job': [0, 1, 2], 'test_job_retry1': [0, 1], 'test_job_retry2': [0]}
+        with patch.dict(cfg.content['executor'], exit_status_files=True), self._fake_attempts(task_statuses), \
+                patch(get_stdout, return_value=''), patch(sleep):
+            e = self.executor.__class__('a_cmd', 'b_cmd', 'c_cmd', job_name='test_job', working_dir=working_dir,
+                                        walltime='3', retries=2, retry_mem_factor=2, retry_walltime_factor=1.5)
+            e.start()
+            assert e.join() == 0
+
+            assert e.attempts == 2
+            assert e.task_exit_statuses == {1: 0, 2: 0, 3: 0}
+            assert e.retry_executor.cmds == ('c_cmd',)
+            assert e.retried_tasks == [3]
+            assert e.retry_executor.writer.cluster_config['mem'] == 8
+            assert e.retry_executor.writer.cluster_config['walltime'] == 7
+
+            # retries run out, so the last attempt's exit status is kept for the tasks still failing
+            task_statuses['test_job_retry2'] = [3]
+            e = self.executor.__class__('a_cmd', 'b_cmd', 'c_cmd', job_name='test_job', working_dir=working_dir,
+                                        retries=2)
+            e.start()
+            exit_status = None
+            while exit_status is None:
+                exit_status = e.poll()
+            assert exit_status == 3
+            assert e.task_exit_statuses == {1: 0, 2: 0, 3: 3}
+            assert e.retry_executor.writer.cluster_config['mem'] == 2
+
+            # no retries by default
+            e = self.executor.__class__('a_cmd', 'b_cmd', 'c_cmd', job_name='test_job', working_dir=working_dir)
+            e.start()
+            assert e.join() == 3
+            assert e.retry_executor is None
+
     def test_job_cancellation(self):
         with patch(self.ppath + '._submit_job'), patch(self.ppath + '._job_finished', return_value=True),\
              patch(self.ppath + '.write_script'), patch(self.ppath + '._job_exit_code', return_value=9),\
-             patch(self.ppath + '.cancel_job'), patch(sleep):
+             patch(self.ppath + '.cancel_job'), patch(get_stdout, return_value=''), patch(sleep):
 
             self.executor.job_id = 'test_job'
             self.executor.start()
@@ -122,6 +494,30 @@ class TestClusterExecutor(TestEGCG):
             stop_running_jobs()
             assert running_executors == {}
 
+    def test_stop_running_jobs(self):
+        exit_statuses = {'1337': 0, '1338': 3}
+
+        def fake_join(executor):
+            running_executors.pop(executor.job_id)
+            if executor.job_id in exit_statuses:
+                return exit_statuses[executor.job_id]
+            threading.Event().wait(5)  # still finishing after the deadline
+
+        executors = []
+        for job_id in ('1337', '1338', '1339'):
+            e = self.executor.__class__(self.script, job_name='test_job',
+                                        working_dir=os.path.join(self.assets_path, 'a_run_id'))
+            e.job_id = job_id
+            running_executors[job_id] = e
+            executors.append(e)
+
+        with patch(self.ppath + '.join', new=fake_join), patch(self.ppath + '._job_finished', return_value=False), \
+                patch(self.ppath + '._cancel_job'), patch(get_stdout, return_value=''):
+            start = time()
+            assert stop_running_jobs(timeout=0.2) == {'1337': 0, '1338': 3, '1339': None}
+            assert time() - start < 1
+        assert all(e.cancelled for e in executors)
+
 
 class TestPBSExecutor(TestClusterExecutor):
     ppath = 'egcg_core.executor.cluster_executor.PBSExecutor'
@@ -134,17 +530,78 @@ class TestPBSExecutor(TestClusterExecutor):
             working_dir=os.path.join(self.assets_path, 'a_run_id')
         )
 
+    def test_cancel_jobs(self):
+        working_dir = os.path.join(self.assets_path, 'a_run_id')
+        executors = [PBSExecutor(self.script, job_name='test_job', working_dir=working_dir) for _ in range(2)]
+        executors[0].job_id = '1337[].server'
+        executors[1].job_id = '1338.server'
+        with patch(get_stdout, return_value='') as p:
+            PBSExecutor.cancel_jobs(executors)
+        p.assert_called_once_with('qdel 1337[].server 1338.server')
+
+    def test_task_id(self):
+        self.executor.job_id = '1337[].server'
+        self.executor.cmds = ['a_cmd', 'another_cmd']
+        self.executor.write_script()
+        assert self.executor._task_id(2) == '1337[2].server'
+
     def test_qstat(self):
         fake_report = ('Job id            Name             User              Time Use S Queue\n'
                        '----------------  ---------------- ----------------  -------- - -------\n'
                        '1337[].server     a_job_name       a_user            0        B a_queue\n'
                        '1338.server       another_job_name another_user      00:00:00 R a_queue\n')
+        self.executor.job_id = '1337[].server'
         with patch(get_stdout, return_value=fake_report) as p:
             assert self.executor._qstat() == [
-                '1337[].server     a_job_name       a_user            0        B a_queue',
-                '1338.server       another_job_name another_user      00:00:00 R a_queue'
+                '1337[].server     a_job_name       a_user            0        B a_queue'
             ]
-            p.assert_called_with('qstat -xt None')
+            p.assert_called_with('qstat -xt 1337[].server')
+
+    def test_batched_qstat(self):
+        fake_report = ('Job id            Name             User              Time Use S Queue\n'
+                       '----------------  ---------------- ----------------  -------- - -------\n'
+                       '1337[].server     a_job_name       a_user            0        B a_queue\n'
+                       '1337[1].server    a_job_name       a_user            00:00:00 F a_queue\n'
+                       '1337[2].server    a_job_name       a_user            00:00:00 R a_queue\n'
+                       '1338.a_long_serv* another_job_name another_user      00:00:00 F a_queue\n')
+        executors = []
+        for job_id in ('1337[].server', '1338.a_long_server_name', '1339.server'):
+            e = PBSExecutor(self.script, job_name='test_job', working_dir=os.path.join(self.assets_path, 'a_run_id'))
+            e.job_id = job_id
+            running_executors[job_id] = e
+            executors.append(e)
+
+        with patch(get_stdout, return_value=fake_report) as p:
+            assert [e._job_statuses() for e in executors] == [{'B', 'F', 'R'}, {'F'}, set()]
+            assert [e._job_finished() for e in executors] == [False, True, False]  # no record of 1339 yet
+            p.assert_called_once_with('qstat -xt 1337[].server 1338.a_long_server_name 1339.server')
+
+    def test_qstat_failure(self):
+        fake_report = ('Job id            Name             User              Time Use S Queue\n'
+                       '----------------  ---------------- ----------------  -------- - -------\n'
+                       '1337.server       a_job_name       a_user            0        R a_queue\n')
+        with patch.dict(cfg.content['executor'], status_max_age=0.05, max_missing_polls=3):
+            executors = []
+            for job_id in ('1337.server', '1338.server'):
+                e = PBSExecutor(self.script, job_name='test_job', working_dir=os.path.join(self.assets_path,
+                                                                                           'a_run_id'))
+                e.job_id = job_id
+                running_executors[job_id] = e
+                executors.append(e)
+
+            with patch(get_stdout, return_value=fake_report):
+                assert [e._job_finished() for e in executors] == [False, False]
+
+            # qstat failing does not make jobs look finished: the last report is kept, and jobs without one are
+            # only given up on after max_missing_polls
+            with patch(get_stdout, return_value=None) as p, patch(sleep):
+                for i in range(2):
+                    threading.Event().wait(0.1)
+                    assert executors[0]._job_statuses() == {'R'}
+                    assert [e._job_finished() for e in executors] == [False, i == 1]
+                assert p.call_count == 6  # 3 attempts for each of 2 queries
+            assert executors[1].lost
+            assert executors[1]._finished_exit_code() == 9
 
     def test_job_status(self):
         qstat = 'egcg_core.executor.cluster_executor.PBSExecutor._qstat'
@@ -159,6 +616,30 @@ class TestPBSExecutor(TestClusterExecutor):
         with patch(job_statuses, return_value={'F', 'F', 'M', 'X'}):
             assert self.executor._job_finished()
 
+    def test_resource_usage(self):
+        self.executor.cmds = ['a_cmd', 'another_cmd']
+        self.executor.job_id = '1337[].server'
+        fake_report = (
+            'Job Id: 1337[].server\n    Job_Name = test_job\n    array_state_count = Queued:0 Running:0\n\n'
+            'Job Id: 1337[1].server\n    Job_Name = test_job\n    resources_used.cput = 00:02:00\n'
+            '    resources_used.mem = 2048kb\n    resources_used.walltime = 00:01:30\n    Exit_status = 0\n\n'
+            'Job Id: 1337[2].server\n    Job_Name = test_job\n    resources_used.cput = 01:00:00\n'
+            '    resources_used.mem = 1gb\n    resources_used.walltime = 02:00:00\n    Exit_status = 1\n'
+        )
+        with patch(get_stdout, return_value=fake_report) as p:
+            usages = self.executor._resource_usage()
+            p.assert_called_with('qstat -xf -t 1337[].server')
+
+        assert [u.to_dict() for u in usages] == [
+            {'cmd': 'a_cmd', 'job_name': 'test_job', 'job_id': '1337[1].server', 'exit_status': 0, 'wall_time': 90,
+             'user_time': 120, 'sys_time': None, 'max_rss': 2048},
+            {'cmd': 'another_cmd', 'job_name': 'test_job', 'job_id': '1337[2].server', 'exit_status': 1,
+             'wall_time': 7200, 'user_time': 3600, 'sys_time': None, 'max_rss': 1048576}
+        ]
+
+        with patch(get_stdout, return_value=fake_report):
+            assert self.executor._accounting_exit_statuses() == {1: 0, 2: 1}
+
 
 class TestSlurmExecutor(TestClusterExecutor):
     ppath = 'egcg_core.executor.cluster_executor.SlurmExecutor'
@@ -172,14 +653,60 @@ class TestSlurmExecutor(TestClusterExecutor):
         )
 
     def test_sacct(self):
-        with patch(get_stdout, return_value=' COMPLETED  0:0 \n COMPLETED  0:0\n FAILED 1:0') as p:
-            assert self.executor._sacct('State,ExitCode') == {'COMPLETED  0:0', 'FAILED 1:0'}
-            p.assert_called_with('sacct -nX -j None -o State,ExitCode')
+        self.executor.job_id = '1337'
+        fake_sacct = '1337_1|COMPLETED|0:0\n1337_2|COMPLETED|0:0\n1337_3|FAILED|1:0\n1337_4|CANCELLED by 1000|0:15'
+        with patch(get_stdout, side_effect=[None, None, None, fake_sacct]) as p, patch(sleep):
+            assert self.executor._sacct('State,ExitCode') == {'COMPLETED 0:0', 'FAILED 1:0', 'CANCELLED 0:15'}
+            assert self.executor._sacct('State') == {'COMPLETED', 'FAILED', 'CANCELLED'}
+            p.assert_called_with('sacct -nXP -j 1337 -o JobID,State,ExitCode')
+            assert p.call_count == 4  # squeue failed 3 times, then sacct
 
     def test_squeue(self):
-        with patch(get_stdout, return_value='RUNNING\nRUNNING\nRUNNING') as p:
-            assert self.executor._squeue() == {'RUNNING'}
-            p.assert_called_with('squeue -h -j None -o %T')
+        self.executor.job_id = '1337'
+        with patch(get_stdout, return_value='1337|RUNNING\n1337|RUNNING\n1337|PENDING') as p:
+            assert self.executor._squeue() == {'RUNNING', 'PENDING'}
+            p.assert_called_once_with('squeue -h -j 1337 -o %F|%T')
+
+    def test_batched_queries(self):
+        executors = []
+        for job_id in ('1337', '1338', '1339'):
+            e = SlurmExecutor(self.script, job_name='test_job', working_dir=os.path.join(self.assets_path, 'a_run_id'))
+            e.job_id = job_id
+            running_executors[job_id] = e
+            executors.append(e)
+
+        fake_squeue = '1337|RUNNING\n1337|PENDING'
+        fake_sacct = '1338_1|COMPLETED|0:0\n1338_2|FAILED|2:0\n'  # 1339 not in sacct yet
+        with patch(get_stdout, side_effect=[fake_squeue, fake_sacct]) as p:
+            assert [e._job_finished() for e in executors] == [False, True, False]
+            assert executors[1]._job_exit_code() == 2
+            assert [c[0][0] for c in p.call_args_list] == [
+                'squeue -h -j 1337,1338,1339 -o %F|%T', 'sacct -nXP -j 1338,1339 -o JobID,State,ExitCode'
+            ]
+
+        later = patch('egcg_core.executor.cluster_executor.time', return_value=time() + 10)
+        with patch(get_stdout, return_value='') as p, later:
+            executors[0]._job_finished()  # reports are out of date, so all jobs are queried again
+            assert p.call_count == 2
+
+    def test_job_never_recorded(self):
+        # a job in neither squeue nor sacct is not pending forever, but lost after max_missing_polls
+        with patch.dict(cfg.content['executor'], max_missing_polls=3):
+            e = SlurmExecutor(self.script, job_name='test_job', working_dir=os.path.join(self.assets_path, 'a_run_id'))
+            e.job_id = '1337'
+            with patch(get_stdout, return_value=''), patch(sleep):
+                assert e.join() == 9
+            assert e.lost and e.missing_polls == 3
+
+        # sacct failing keeps the last report
+        e = SlurmExecutor(self.script, job_name='test_job', working_dir=os.path.join(self.assets_path, 'a_run_id'))
+        e.job_id = '1338'
+        with patch(get_stdout, side_effect=['', '1338|RUNNING|0:0']):
+            assert e._job_statuses() == {'RUNNING'}
+        later = patch('egcg_core.executor.cluster_executor.time', return_value=time() + 10)
+        with patch(get_stdout, side_effect=['', None, None, None]), patch(sleep), later:
+            assert e._job_statuses() == {'RUNNING'}
+            assert not e._job_finished()
 
     def test_job_finished(self):
         sacct = 'egcg_core.executor.cluster_executor.SlurmExecutor._sacct'
@@ -193,5 +720,246 @@ class TestSlurmExecutor(TestClusterExecutor):
         sacct = 'egcg_core.executor.cluster_executor.SlurmExecutor._sacct'
         with patch(sacct, return_value=['CANCELLED 0:0']):
             assert self.executor._job_exit_code() == 9
+        with patch(sacct, return_value=['NODE_FAIL 0:0', 'COMPLETED 0:0']):
+            assert self.executor._job_exit_code() == 9
         with patch(sacct, return_value=['COMPLETED 0:x']):
             assert self.executor._job_exit_code() == 0
+
+    def test_cancel_jobs(self):
+        working_dir = os.path.join(self.assets_path, 'a_run_id')
+        executors = [SlurmExecutor(self.script, job_name='test_job', working_dir=working_dir) for _ in range(2)]
+        executors[0].job_id = '1337'
+        executors[1].job_id = '1338'
+        with patch(get_stdout, return_value='') as p:
+            SlurmExecutor.cancel_jobs(executors)
+        p.assert_called_once_with('scancel 1337 1338')
+        assert all(e.cancelled for e in executors)
+
+        # if cancelling all jobs at once fails, they are cancelled one by one
+        with patch(get_stdout, return_value=None), patch(self.ppath + '._job_finished', side_effect=[True, False]), \
+                patch(self.ppath + '._cancel_job') as mocked_cancel:
+            SlurmExecutor.cancel_jobs(executors)
+        assert mocked_cancel.call_count == 1
+
+    def test_accounting_exit_statuses(self):
+        self.executor.job_id = '1337'
+        self.executor.cmds = ['a_cmd', 'another_cmd', 'a_third_cmd']
+        self.executor.write_script()
+        fake_sacct = '1337_1|COMPLETED|0:0\n1337_2|PREEMPTED|0:0\n1337_3|FAILED|2:0'
+        with patch(get_stdout, side_effect=['', fake_sacct]):
+            assert self.executor._task_exit_statuses() == {1: 0, 2: 9, 3: 2}
+
+    def test_resource_usage(self):
+        self.executor.job_id = '1337'
+        fake_report = (
+            '1337|65|01:05.500|00:01.500||0:0|COMPLETED\n'
+            '1337.batch|65|01:05.500|00:01.500|2048K|0:0|COMPLETED\n'
+            '1337.extern|65|00:00:00|00:00:00|1024K|0:0|COMPLETED\n'
+        )
+        with patch(get_stdout, return_value=fake_report) as p:
+            usages = self.executor._resource_usage()
+            p.assert_called_with('sacct -nP -j 1337 -o JobID,ElapsedRaw,UserCPU,SystemCPU,MaxRSS,ExitCode,State')
+
+        assert [u.to_dict() for u in usages] == [
+            {'cmd': self.script, 'job_name': 'test_job', 'job_id': '1337', 'exit_status': 0, 'wall_time': 65,
+             'user_time': 65.5, 'sys_time': 1.5, 'max_rss': 2048}
+        ]
+
+        self.executor.cmds = ['a_cmd', 'another_cmd', 'a_third_cmd']
+        fake_report = ('1337_1|10|00:05|00:01||0:0|COMPLETED\n1337_1.batch|10|00:05|00:01|1G|0:0|COMPLETED\n'
+                       '1337_2|20|00:09|00:01||2:0|FAILED\n1337_3|0|00:00|00:00||0:0|CANCELLED by 1000')
+        with patch(get_stdout, return_value=fake_report):
+            usages = self.executor._resource_usage()
+        assert [(u.cmd, u.job_id, u.exit_status, u.max_rss) for u in usages] == [
+            ('a_cmd', '1337_1', 0, 1048576), ('another_cmd', '1337_2', 2, None), ('a_third_cmd', '1337_3', 9, None)
+        ]
+
+    def test_join_records_usage(self):
+        usage = self.ppath + '._resource_usage'
+        finished = patch(self.ppath + '._job_finished', return_value=True)
+        exit_code = patch(self.ppath + '._job_exit_code', return_value=0)
+        ledger = patch.dict(cfg.content['executor'], usage_ledger='a_ledger.jsonl')
+        with finished, exit_code, ledger, patch(sleep), patch(usage, return_value=['a_usage']) as mocked_usage, \
+                patch('egcg_core.executor.cluster_executor.record_usage') as record:
+            assert self.executor.join() == 0
+            record.assert_called_with(['a_usage'])
+            assert self.executor.usages == ['a_usage']
+            mocked_usage.assert_called_once()
+
+        self.setUp()  # a new executor, as a finished one's exit status is not queried again
+        with finished, exit_code, ledger, patch(sleep), \
+                patch(usage, side_effect=AttributeError('no sacct output')):
+            assert self.executor.join() == 0  # accounting failures do not fail the job
+            assert self.executor.usages == []
+
+    def test_usage_read_on_request(self):
+        usage = self.ppath + '._resource_usage'
+        with patch(self.ppath + '._job_finished', return_value=True), \
+                patch(self.ppath + '._job_exit_code', return_value=0), patch(sleep), \
+                patch(usage, return_value=['a_usage']) as mocked_usage:
+            assert self.executor.join() == 0
+            mocked_usage.assert_not_called()  # no usage_ledger, and usages not read yet
+            assert self.executor.usages == ['a_usage']
+            assert self.executor.usages == ['a_usage']
+            mocked_usage.assert_called_once()
+
+
+def test_stop_jobs_on_signal():
+    previous_handler = signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    try:
+        with patch('egcg_core.executor.cluster_executor.stop_running_jobs') as mocked_stop:
+            stop_jobs_on_signal(signal.SIGUSR1, timeout=10)
+            with pytest.raises(SystemExit) as e:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                threading.Event().wait(1)  # let the handler run
+        assert e.value.code == 128 + signal.SIGUSR1
+        mocked_stop.assert_called_with(10)
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+
+class TestFakeScheduler(TestEGCG):
+    """Run PBSExecutor and SlurmExecutor end to end against the local FakeScheduler."""
+    working_dir = os.path.join(TestEGCG.assets_path, 'a_fake_run')
+
+    def setUp(self):
+        os.makedirs(self.working_dir, exist_ok=True)
+        self.fast_polling = patch.dict(cfg.content['executor'], join_min_interval=0.05, join_interval=0.1,
+                                       status_max_age=0.01)
+        self.fast_polling.start()
+
+    def tearDown(self):
+        self.fast_polling.stop()
+        shutil.rmtree(self.working_dir)
+        JobStatusPoller.pollers.clear()
+        running_executors.clear()
+        SubmissionQueue.current = None
+
+    def test_slurm(self):
+        with FakeScheduler('slurm', slots=2) as scheduler:
+            e = cluster_execute('echo this', 'exit 3', 'true', job_name='a_job', working_dir=self.working_dir)
+            assert isinstance(e, SlurmExecutor)
+            assert e.join() == 3
+            assert [(u.job_id, u.exit_status) for u in e.usages] == [(e.job_id + '_' + i, s) for i, s in
+                                                                     (('1', 0), ('2', 3), ('3', 0))]
+            assert all(u.max_rss for u in e.usages)
+            assert scheduler.calls['sbatch'] == 1
+        assert open(os.path.join(self.working_dir, 'a_job.log1')).read() == 'this\n'
+
+    def test_pbs(self):
+        with FakeScheduler('pbs') as scheduler, patch.dict(cfg.content['executor'], exit_status_files=True):
+            e = cluster_execute('true', 'exit 2', job_name='a_job', working_dir=self.working_dir)
+            assert isinstance(e, PBSExecutor)
+            assert e.job_id.endswith('[].fakeserver')
+            assert e.join() == 2
+            assert [u.exit_status for u in e.usages] == [0, 2]
+            assert scheduler.calls['qsub'] == 1
+
+    def test_usage_queries(self):
+        with FakeScheduler('slurm', slots=10) as scheduler:
+            executors = [cluster_execute('exit %s' % (i % 2), job_name='a_job%s' % i, working_dir=self.working_dir)
+                         for i in range(10)]
+            assert [e.join() for e in executors] == [i % 2 for i in range(10)]
+            status_queries = scheduler.calls['sacct']
+            assert [[u.exit_status for u in e.usages] for e in executors] == [[i % 2] for i in range(10)]
+            assert scheduler.calls['sacct'] == status_queries + 1  # one accounting query for all finished jobs
+
+    def test_node_failures(self):
+        with FakeScheduler('slurm', fail_rate=0.5, seed=1):
+            e = cluster_execute(*['true'] * 4, job_name='a_job', working_dir=self.working_dir, retries=3)
+            assert e.join() == 0
+            assert e.attempts > 0
+            assert all(s == 0 for s in e.task_exit_statuses.values())
+
+    def test_cancellation(self):
+        with FakeScheduler('slurm', queue_delay=60) as scheduler:
+            executors = [cluster_execute('true', job_name='a_job%s' % i, working_dir=self.working_dir)
+                         for i in range(5)]
+            assert stop_running_jobs() == dict((e.job_id, 9) for e in executors)  # cancelled
+            assert running_executors == {}
+            assert scheduler.calls['scancel'] == 1
+
+    def test_submission_failure(self):
+        with FakeScheduler('slurm', submit_fail_rate=1), patch(sleep), pytest.raises(EGCGError):
+            cluster_execute('true', job_name='a_job', working_dir=self.working_dir)
+
+    def test_job_graph(self):
+        with FakeScheduler('pbs', slots=1):
+            graph = JobGraph()
+            graph.add_job('a', 'true', working_dir=self.working_dir)
+            graph.add_job('b', 'true', depends_on=['a'], working_dir=self.working_dir)
+            graph.interval = 0.05
+            graph.start()
+            assert graph.join() == 0
+            assert graph.states == {'a': 'finished', 'b': 'finished'}
+
+    def test_job_graph_retries(self):
+        # b is held until a's failed first attempt has been retried, rather than depending on it forever
+        marker = os.path.join(self.working_dir, 'attempted')
+        with FakeScheduler('slurm') as scheduler:
+            graph = JobGraph()
+            graph.add_job('a', '[ -f %s ] || { touch %s; exit 1; }' % (marker, marker), retries=1,
+                          working_dir=self.working_dir)
+            graph.add_job('b', 'echo this', depends_on=['a'], working_dir=self.working_dir)
+            graph.interval = 0.05
+            graph.start()
+            assert graph.states == {'a': 'submitted', 'b': 'pending'}
+            assert graph.join() == 0
+            assert graph.states == {'a': 'finished', 'b': 'finished'}
+            assert graph.executors['a'].attempts == 1
+            assert graph.executors['b'].writer.cluster_config['dependencies'] == []
+            assert scheduler.calls['sbatch'] == 3
+        assert open(os.path.join(self.working_dir, 'b.log')).read().endswith('this\n')
+
+    def test_batching(self):
+        def run(i, **config):
+            e = cluster_execute('sh -c "echo a_job%s; exit %s"' % (i, i % 3), job_name='a_job%s' % i,
+                                working_dir=self.working_dir, **config)
+            executors[i] = e
+            exit_statuses[i] = e.join()
+
+        for kind, exit_status_files in (('slurm', False), ('pbs', True)):
+            executors = {}
+            exit_statuses = {}
+            SubmissionQueue.current = None
+            config = patch.dict(cfg.content['executor'], batch_window=0.5, exit_status_files=exit_status_files)
+            with FakeScheduler(kind, slots=8) as scheduler, config:
+                threads = [threading.Thread(target=run, args=(i,)) for i in range(6)]
+                threads.append(threading.Thread(target=run, args=(6,), kwargs={'mem': 4}))  # not compatible
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+                assert exit_statuses == dict((i, i % 3) for i in range(7))
+                assert scheduler.calls[cfg['executor']['qsub'].split('/')[-1]] == 2
+                batch = executors[0].batch
+                assert [executors[i].batch for i in range(6)] == [batch] * 6
+                assert sorted(executors[i].batch_index for i in range(6)) == [1, 2, 3, 4, 5, 6]
+                assert executors[0].job_id == batch._task_id(executors[0].batch_index)
+                assert executors[6].batch is None
+                if kind == 'slurm':
+                    assert [(u.exit_status, u.job_name) for u in executors[2].usages] == [(2, 'a_job2')]
+                assert executors[2].poll() == 2
+                for i in range(6):  # each command's output is in its own job's log, not the batch's
+                    assert open(os.path.join(self.working_dir, 'a_job%s.log' % i)).read() == 'a_job%s\n' % i
+
+
+def test_backoff():
+    with patch.dict(cfg.content['executor'], retry_backoff=2, retry_max_wait=5):
+        assert 1 <= backoff(1) <= 2
+        assert 2 <= backoff(2) <= 4
+        assert 2.5 <= backoff(5) <= 5
+        assert 1.5 <= backoff(1, base=3) <= 3
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, burst=2)
+    start = time()
+    for _ in range(6):
+        bucket.acquire()
+    assert 0.07 <= time() - start < 0.5  # 2 at once, then 1 every 20ms
+
+    with patch('egcg_core.executor.submission_queue.sleep') as mocked_sleep:
+        SubmissionQueue(rate=0.01).limiter.acquire()
+        assert mocked_sleep.call_count == 0
@@ -0,0 +1,148 @@
+import os
+import shutil
+import pytest
+from itertools import count
+from unittest.mock import patch
+from tests import TestEGCG
+from egcg_core.executor import JobGraph, SlurmExecutor
+from egcg_core.executor.cluster_executor import running_executors
+from egcg_core.exceptions import EGCGError
+
+ppath = 'egcg_core.executor.cluster_executor.SlurmExecutor.'
+
+
+class TestJobGraph(TestEGCG):
+    working_dir = os.path.join(TestEGCG.assets_path, 'a_job_graph')
+
+    def setUp(self):
+        os.makedirs(self.working_dir, exist_ok=True)
+        self.graph = JobGraph('slurm')
+        self.graph.add_job('a', 'a_cmd', working_dir=self.working_dir)
+        self.graph.add_job('b', 'b_cmd', 'another_b_cmd', depends_on=['a'], working_dir=self.working_dir)
+        self.graph.add_job('c', 'c_cmd', depends_on=['a'], working_dir=self.working_dir)
+        self.graph.add_job('d', 'd_cmd', depends_on=['b', 'c'], working_dir=self.working_dir)
+        self.graph.add_job('e', 'e_cmd', working_dir=self.working_dir)
+
+        job_ids = count(1001)
+
+        def fake_submit(executor):
+            executor.job_id = str(next(job_ids))
+
+        self.cancelled = []
+        self.patches = [patch(ppath + '_submit_job', new=fake_submit),
+                        patch(ppath + '_cancel_job', new=lambda executor: self.cancelled.append(executor.job_id)),
+                        patch('egcg_core.executor.job_graph.sleep')]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        running_executors.clear()
+        shutil.rmtree(self.working_dir)
+
+    def test_add_job(self):
+        with pytest.raises(EGCGError):
+            self.graph.add_job('a', 'a_cmd', working_dir=self.working_dir)
+        with pytest.raises(EGCGError):
+            self.graph.add_job('f', 'f_cmd', depends_on=['a', 'non_existent'], working_dir=self.working_dir)
+        with pytest.raises(EGCGError):
+            JobGraph('local')
+
+        assert self.graph.dependants('a') == ['b', 'c', 'd']
+        assert self.graph.dependants('c') == ['d']
+        assert self.graph.dependants('e') == []
+
+    def test_start(self):
+        self.graph.start()
+        assert self.graph.states == dict.fromkeys('abcde', 'submitted')
+        assert [self.graph.executors[j].job_id for j in 'abcde'] == ['1001', '1002', '1003', '1004', '1005']
+
+        headers = {}
+        for j in 'abcde':
+            e = self.graph.executors[j]
+            assert isinstance(e, SlurmExecutor)
+            assert e.job_name == j
+            headers[j] = [l for l in open(e.writer.script_name).read().split('\n') if 'dependency' in l]
+
+        assert headers == {
+            'a': [],
+            'b': ['#SBATCH --dependency=afterok:1001'],
+            'c': ['#SBATCH --dependency=afterok:1001'],
+            'd': ['#SBATCH --dependency=afterok:1002:1003'],
+            'e': []
+        }
+
+    def test_retried_dependency(self):
+        graph = JobGraph('slurm')
+        graph.add_job('a', 'a_cmd', retries=2, working_dir=self.working_dir)
+        graph.add_job('b', 'b_cmd', depends_on=['a'], working_dir=self.working_dir)
+        graph.add_job('c', 'c_cmd', depends_on=['b'], retries=0, working_dir=self.working_dir)
+        graph.start()
+        assert graph.states == {'a': 'submitted', 'b': 'pending', 'c': 'pending'}
+
+        polls = {'1001': [None, 0], '1002': [None, 0], '1003': [0]}
+
+        def fake_poll(executor):
+            return polls[executor.job_id].pop(0)
+
+        with patch(ppath + 'poll', new=fake_poll):
+            assert graph.join() == 0
+        assert graph.states == dict.fromkeys('abc', 'finished')
+        headers = [[l for l in open(graph.executors[j].writer.script_name) if 'dependency' in l] for j in 'bc']
+        assert headers == [[], ['#SBATCH --dependency=afterok:1002\n']]  # b is only submitted once a succeeded
+
+    def test_join(self):
+        self.graph.start()
+        polls = {'1001': [None, 0], '1002': [None, None, 0], '1003': [None, 0], '1004': [None, None, 0], '1005': [0]}
+
+        def fake_poll(executor):
+            return polls[executor.job_id].pop(0)
+
+        with patch(ppath + 'poll', new=fake_poll):
+            assert self.graph.join() == 0
+        assert self.graph.states == dict.fromkeys('abcde', 'finished')
+        assert self.graph.exit_statuses == dict.fromkeys('abcde', 0)
+
+    def test_failed_branch(self):
+        self.graph.start()
+        polls = {'1001': [0], '1002': [None, 0], '1003': [None, 3], '1004': [None], '1005': [None, None, 0]}
+
+        def fake_poll(executor):
+            return polls[executor.job_id].pop(0)
+
+        with patch(ppath + 'poll', new=fake_poll), \
+                patch('egcg_core.executor.cluster_executor.get_registry') as mocked_registry:
+            assert self.graph.join() == 3
+        assert self.cancelled == ['1004']
+        assert '1004' not in running_executors
+        mocked_registry.return_value.update.assert_called_once_with('1004', 'cancelled', None)
+
+        assert self.graph.states == {
+            'a': 'finished', 'b': 'finished', 'c': 'failed', 'd': 'cancelled', 'e': 'finished'
+        }
+
+    def test_failed_submission(self):
+        submit = self.patches[0]
+        submit.stop()
+        job_ids = iter(['1001', None, '1003', '1004'])
+
+        def fake_submit(executor):
+            executor.job_id = next(job_ids)
+            if executor.job_id is None:
+                raise EGCGError('Job submission failed')
+
+        self.patches[0] = patch(ppath + '_submit_job', new=fake_submit)
+        self.patches[0].start()
+
+        self.graph.start()
+        assert self.graph.states == {
+            'a': 'submitted', 'b': 'failed', 'c': 'submitted', 'd': 'cancelled', 'e': 'submitted'
+        }
+        assert 'd' not in self.graph.executors
+
+        self.graph.cancel()
+        assert self.cancelled == ['1001', '1003', '1004']
+        assert self.graph.states == {
+            'a': 'cancelled', 'b': 'failed', 'c': 'cancelled', 'd': 'cancelled', 'e': 'cancelled'
+        }
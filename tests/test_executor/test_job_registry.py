@@ -0,0 +1,95 @@
+import os
+import sys
+import shutil
+import subprocess
+import pytest
+from unittest.mock import patch
+from tests import TestEGCG
+from tests.fake_scheduler import FakeScheduler
+from egcg_core.executor import SlurmExecutor, JobRegistry, cluster_execute, reattach
+from egcg_core.executor.cluster_executor import JobStatusPoller, running_executors
+from egcg_core.executor.job_registry import get_registry, registries
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+
+
+class TestJobRegistry(TestEGCG):
+    working_dir = os.path.join(TestEGCG.assets_path, 'a_registry_run')
+
+    def setUp(self):
+        os.makedirs(self.working_dir, exist_ok=True)
+        self.db_file = os.path.join(self.working_dir, 'jobs.sqlite')
+        self.config = patch.dict(cfg.content['executor'], job_registry=self.db_file, join_min_interval=0.05,
+                                 join_interval=0.1, status_max_age=0.01)
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        for r in registries.values():
+            r.close()
+        registries.clear()
+        JobStatusPoller.pollers.clear()
+        running_executors.clear()
+        shutil.rmtree(self.working_dir)
+
+    def restart(self):
+        """Forget everything held in memory about the submitted jobs, as if the process had restarted."""
+        for r in registries.values():
+            r.close()
+        registries.clear()
+        JobStatusPoller.pollers.clear()
+        running_executors.clear()
+
+    def test_registry(self):
+        r = JobRegistry(self.db_file)
+        assert get_registry() is not r
+        assert get_registry() is get_registry(self.db_file)
+        with patch.dict(cfg.content['executor'], job_registry=None):
+            assert get_registry() is None
+
+        r.add('1', 'SlurmExecutor', 'a_job', 'a_job.slurm', ('this', 'that'), None, {'mem': 2}, [['this'], ['that']])
+        r.add('2', 'PBSExecutor', 'another_job', 'another_job.pbs', ['other'], ['a_prelim'], {}, [['other']])
+        r.update('1', 'finished', 3)
+        assert r.get('1')['cmds'] == ['this', 'that']
+        assert r.get('1')['config'] == {'mem': 2}
+        assert (r.get('1')['state'], r.get('1')['exit_status']) == ('finished', 3)
+        assert r.get('3') is None
+        assert [j['job_id'] for j in r.jobs()] == ['1', '2']
+        assert [j['job_id'] for j in r.jobs('running')] == ['2']
+        assert JobRegistry(self.db_file).get('2')['prelim_cmds'] == ['a_prelim']
+        r.close()
+
+    def test_reattach(self):
+        with FakeScheduler('slurm', queue_delay=0.5):
+            finished = cluster_execute('true', job_name='a_finished_job', working_dir=self.working_dir)
+            assert finished.join() == 0
+            e = cluster_execute('echo this', 'exit 3', job_name='a_job', working_dir=self.working_dir, mem=4,
+                                retries=1, retry_mem_factor=2)
+            assert get_registry().get(finished.job_id)['state'] == 'finished'
+            assert get_registry().get(e.job_id)['state'] == 'running'
+
+            self.restart()
+            executors = reattach()
+            assert [(type(r), r.job_id, r.cmds, r.writer.array_tasks) for r in executors] == [
+                (SlurmExecutor, e.job_id, e.cmds, [['echo this'], ['exit 3']])
+            ]
+            r = executors[0]
+            assert running_executors == {e.job_id: r}
+            assert (r.retries, r.retry_mem_factor, r.writer.cluster_config['mem']) == (1, 2, 4)
+
+            assert r.join() == 3  # retried once, still failing
+            assert r.attempts == 1
+            assert get_registry().get(e.job_id)['state'] == 'finished'
+            assert get_registry().get(e.job_id)['exit_status'] == 3
+            assert reattach() == []
+
+        assert open(os.path.join(self.working_dir, 'a_job.log1')).read() == 'this\n'
+
+    def test_no_registry(self):
+        with patch.dict(cfg.content['executor'], job_registry=None), pytest.raises(EGCGError):
+            reattach()
+
+
+def test_import_without_sqlite():
+    cmd = "import sys; sys.modules['sqlite3'] = None; from egcg_core.executor import execute"
+    assert subprocess.call([sys.executable, '-c', cmd]) == 0
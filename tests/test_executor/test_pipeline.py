@@ -0,0 +1,101 @@
+import os
+import pytest
+import subprocess
+from tests import TestEGCG
+from egcg_core.executor import Executor, StreamExecutor
+from egcg_core.executor.pipeline import Pipeline, parse_command
+from egcg_core.exceptions import EGCGError
+
+
+def test_parse_command():
+    assert parse_command('ls -lh') == ([['ls', '-lh']], None, None, False)
+    assert parse_command('samtools view x.bam | gzip > y.gz') == (
+        [['samtools', 'view', 'x.bam'], ['gzip']], None, 'y.gz', False
+    )
+    assert parse_command('sort < in.txt | uniq -c >> out.txt') == (
+        [['sort'], ['uniq', '-c']], 'in.txt', 'out.txt', True
+    )
+    assert parse_command('grep "a|b" in.txt | wc -l') == ([['grep', 'a|b', 'in.txt'], ['wc', '-l']], None, None, False)
+    assert parse_command("echo 'a > b' \\| c") == ([['echo', 'a > b', '|', 'c']], None, None, False)
+    assert parse_command("echo '$HOME' \\*.txt | cat") == ([['echo', '$HOME', '*.txt'], ['cat']], None, None, False)
+
+
+@pytest.mark.parametrize(
+    'cmd',
+    ['a && b', 'a; b', 'diff <(a) <(b)', 'a &', 'a 2> err', 'a | ', '| b', 'a > ', 'a > out | b', 'a | b < in',
+     'echo $HOME | cat', 'echo "$HOME"', 'ls *.txt | wc -l', 'ls ~/a', 'echo `a`', 'echo a{1,2}', 'a # b',
+     'A=1 b | c']
+)
+def test_parse_unsupported(cmd):
+    with pytest.raises(EGCGError):
+        parse_command(cmd)
+
+
+class TestPipeline(TestEGCG):
+    def setUp(self):
+        self.out_file = os.path.join(self.assets_path, 'pipeline_out.txt')
+
+    def tearDown(self):
+        if os.path.isfile(self.out_file):
+            os.remove(self.out_file)
+
+    def test_communicate(self):
+        p = Pipeline([['seq', '1', '10'], ['grep', '1'], ['wc', '-l']])
+        out, err = p.communicate()
+        assert out.strip() == b'2'
+        assert p.returncode == 0
+        assert p.returncodes == [0, 0, 0]
+
+    def test_redirection(self):
+        stages, stdin_file, stdout_file, append = parse_command('seq 1 5 > ' + self.out_file)
+        p = Pipeline(stages, stdin_file, stdout_file, append)
+        assert p.communicate() == (b'', b'')
+        p = Pipeline([['tac']], self.out_file, self.out_file + '.tac')
+        p.communicate()
+        assert open(self.out_file + '.tac').read() == '5\n4\n3\n2\n1\n'
+        os.remove(self.out_file + '.tac')
+
+    def test_pipefail(self):
+        p = Pipeline([['bash', '-c', 'echo an_error >&2; exit 3'], ['cat'], ['true']])
+        out, err = p.communicate()
+        assert err == b'an_error\n'
+        assert p.returncodes == [3, 0, 0]
+        assert p.returncode == 3
+
+    def test_sigpipe(self):
+        # the first stage is stopped by SIGPIPE once head exits, rather than running forever
+        p = Pipeline([['yes'], ['head', '-n', '3']])
+        assert p.communicate()[0] == b'y\ny\ny\n'
+        assert p.wait(timeout=5) == -13
+
+    def test_executor(self):
+        e = Executor('seq 1 10 | wc -l > ' + self.out_file)
+        assert e.join() == 0
+        assert isinstance(e.proc, Pipeline)
+        assert e.stage_exit_statuses == [0, 0]
+        assert open(self.out_file).read().strip() == '10'
+
+    def test_stream_executor(self):
+        e = StreamExecutor('bash -c "exit 2" | cat')
+        e.start()
+        assert e.join() == 2
+        assert e.stage_exit_statuses == [2, 0]
+
+    def test_shell(self):
+        e = Executor('cat <(echo this) > %s && false' % self.out_file)  # falls back to Bash
+        assert e.join() == 1
+        assert isinstance(e.proc, subprocess.Popen)
+        assert open(self.out_file).read() == 'this\n'
+
+        e = Executor('echo "unbalanced')
+        assert e.join() == 2
+
+        # expansions mean the same in a pipeline as with '&&', as both run with Bash
+        for cmd in ('echo $HOME ~ | cat > %s', 'true && echo $HOME ~ > %s'):
+            e = Executor(cmd % self.out_file)
+            assert e.join() == 0
+            assert open(self.out_file).read() == '%s %s\n' % (os.environ['HOME'], os.path.expanduser('~'))
+
+        e = Executor('cat <(echo this) > %s && false' % self.out_file, shell=True)
+        assert e.join() == 1
+        assert open(self.out_file).read() == 'this\n'
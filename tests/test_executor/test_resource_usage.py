@@ -0,0 +1,86 @@
+import os
+import json
+from unittest.mock import patch
+from tests import TestEGCG
+from egcg_core.config import cfg
+from egcg_core.executor import Executor, StreamExecutor, ArrayExecutor
+from egcg_core.executor.resource_usage import ResourceUsage, parse_duration, parse_memory, record_usage, \
+    read_ledger, suggest_resources
+
+# allocates ~50Mb and busies the CPU for a moment
+# peaks well above the test process' own memory, which a forked command's max_rss includes up to its exec
+hungry_cmd = 'python3 -c "x = bytearray(256 * 1024 ** 2); sum(range(3000000))"'
+
+
+def test_parse_duration():
+    assert parse_duration('') is None
+    assert parse_duration('65') == 65
+    assert parse_duration('03:04.5') == 184.5
+    assert parse_duration('02:03:04') == 7384
+    assert parse_duration('1-02:03:04') == 93784
+
+
+def test_parse_memory():
+    assert parse_memory('') is None
+    assert parse_memory('2048K') == 2048
+    assert parse_memory('1.5G') == 1572864
+    assert parse_memory('123456kb') == 123456
+    assert parse_memory('10M') == 10240
+    assert parse_memory('2048') == 2
+
+
+class TestResourceUsage(TestEGCG):
+    def setUp(self):
+        self.ledger = os.path.join(self.assets_path, 'usage_ledger.jsonl')
+
+    def tearDown(self):
+        if os.path.isfile(self.ledger):
+            os.remove(self.ledger)
+
+    def test_executor(self):
+        e = Executor(hungry_cmd)
+        assert e.join() == 0
+        assert e.usages == [e.usage]
+        assert e.usage.cmd == hungry_cmd
+        assert e.usage.exit_status == 0
+        assert e.usage.max_rss > 50 * 1024
+        assert e.usage.user_time > 0
+        assert e.usage.wall_time >= e.usage.user_time
+
+    def test_pipeline(self):
+        e = StreamExecutor('bash -c "exit 3" | ' + hungry_cmd)
+        e.start()
+        assert e.join() == 3
+        assert e.usage.exit_status == 3
+        assert e.usage.max_rss > 50 * 1024
+
+    def test_array_executor(self):
+        e = ArrayExecutor([hungry_cmd, 'true', 'false'], stream=True)
+        e.start()
+        e.join()
+        assert [u.exit_status for u in e.usages] == [0, 0, 1]
+        assert e.usages[0].max_rss > e.usages[1].max_rss
+
+    def test_ledger(self):
+        with patch.dict(cfg.content['executor'], usage_ledger=self.ledger):
+            Executor(hungry_cmd).join()
+            Executor('true').join()
+
+        entries = [json.loads(l) for l in open(self.ledger)]
+        assert [e['cmd'] for e in entries] == [hungry_cmd, 'true']
+        assert sorted(entries[0]) == sorted(ResourceUsage.fields + ('timestamp',))
+        assert read_ledger(self.ledger)[0].max_rss == entries[0]['max_rss']
+
+    def test_suggest_resources(self):
+        record_usage(
+            [
+                ResourceUsage('a_cmd', 0, 7000, 13000, 1000, 5 * 1024 ** 2, job_name='a_job'),
+                ResourceUsage('a_cmd', 0, 3000, 2000, 1000, 9 * 1024 ** 2, job_name='a_job'),
+                ResourceUsage('a_cmd', 1, 9000, 1000, 1000, 20 * 1024 ** 2, job_name='a_job'),  # failed
+                ResourceUsage('a_cmd', 0, 99000, 99000, 0, 99 * 1024 ** 2, job_name='another_job')
+            ],
+            self.ledger
+        )
+        assert suggest_resources('a_job', self.ledger) == {'cpus': 3, 'mem': 11, 'walltime': 3}
+        assert suggest_resources('a_job', self.ledger, headroom=1) == {'cpus': 2, 'mem': 9, 'walltime': 2}
+        assert suggest_resources('a_new_job', self.ledger) is None
@@ -1,15 +1,32 @@
-from os import makedirs
+from os import makedirs, environ
 from os.path import join
 import shutil
+import pytest
+import subprocess
 from egcg_core.executor import script_writers
 from tests import TestEGCG
 
 working_dir = join(TestEGCG.assets_path, 'test_script_writer_wd')
 
 
+def test_pack_commands():
+    assert script_writers.pack_commands(7, 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert script_writers.pack_commands(2, 3) == [[0], [1]]
+    assert script_writers.pack_commands(5, 1) == [[0, 1, 2, 3, 4]]
+
+    costs = [1, 8, 2, 5, 4, 3, 1]
+    groups = script_writers.pack_commands(7, 3, costs)
+    assert groups == [[1], [0, 2, 3], [4, 5, 6]]
+    assert [sum(costs[i] for i in g) for g in groups] == [8, 8, 8]
+
+    with pytest.raises(script_writers.EGCGError):
+        script_writers.pack_commands(3, 2, [1, 2])
+
+
 class TestScriptWriter(TestEGCG):
     writer_cls = script_writers.ScriptWriter
     array_index = 'JOB_INDEX'
+    exp_dependency_header = '# dependencies: afterok:1337:1338'
     exp_header = [
             '#!/bin/bash\n',
             '# job name: a_job_name',
@@ -76,15 +93,132 @@ class TestScriptWriter(TestEGCG):
             'esac'
         ]
 
+    def test_log_files(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', log_files=['a.log', 'b.log', 'c.log'])
+        w.add_job_array('this', 'that', 'other')
+        assert w.lines[1:4] == ['1) this > a.log 2>&1\n;;', '2) that > b.log 2>&1\n;;', '3) other > c.log 2>&1\n;;']
+
     def test_save(self):
         self.script_writer.add_line('a_line')
         self.script_writer.save()
         assert 'a_line\n' in open(self.script_writer.script_name, 'r').readlines()
 
+    def test_add_exit_status_trap(self):
+        self.script_writer.add_exit_status_trap()
+        exit_status_file = join(working_dir, 'a_job_name.exit${%s}' % self.array_index)
+        assert self.script_writer.lines == [
+            'trap \'echo $? > "{f}.tmp"; mv "{f}.tmp" "{f}"\' EXIT'.format(f=exit_status_file)
+        ]
+
     def test_trim_field(self):
         s = script_writers.PBSWriter('a_job_name_too_long_for_pbs', 'a_working_dir', 'a_job_queue')
         assert s.cluster_config['job_name'] == 'a_job_name_too_'
 
+    def test_max_concurrent(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=1, mem=2, max_concurrent=5)
+        w.add_job_array('this', 'that', 'other')
+        w.add_header()
+        assert self.exp_header[7].replace('1-3', '1-3%5') in w.lines
+
+    def test_packed_job_array(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=2, mem=2, pack_tasks=2)
+        w.add_job_array('this', 'that', 'other')
+        assert w.array_tasks == [['this', 'that'], ['other']]
+        log = join(working_dir, 'a_job_name.log')
+        assert w.lines == [
+            script_writers.run_packed_function,
+            'case $%s in' % self.array_index,
+            "1) run_packed 2 'this > %s1 2>&1' 'that > %s2 2>&1'\n;;" % (log, log),
+            '2) other > %s3 2>&1\n;;' % log,
+            '*) echo "Unexpected %s: $%s"' % (self.array_index, self.array_index),
+            'esac'
+        ]
+        w.add_header()
+        assert self.exp_header[7].replace('1-3', '1-2') in w.lines
+
+    def test_run_packed(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=2, mem=2, pack_tasks=2,
+                            cmd_costs=[1, 1, 3, 1])
+        w.add_job_array('echo this', 'exit 3', 'echo "$SOME_VAR"', 'sleep 0.1 && false')
+        w.save()
+        assert w.array_tasks == [['echo "$SOME_VAR"'], ['echo this', 'exit 3', 'sleep 0.1 && false']]
+
+        env = dict(environ, SOME_VAR='a value')
+        for task, exp_status, exp_stderr in ((1, 0, b''), (2, 1, b'run_packed: 2 of 3 commands failed\n')):
+            env[self.array_index] = str(task)
+            p = subprocess.run(['bash', w.script_name], env=env, stderr=subprocess.PIPE)
+            assert p.returncode == exp_status  # last non-zero exit status
+            assert p.stderr == exp_stderr
+
+        assert open(w.log_file + '1').read() == 'this\n'
+        assert open(w.log_file + '3').read() == 'a value\n'
+
+        # 256 failed commands do not make the task look successful
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=8, mem=2, pack_tasks=1)
+        w.add_job_array(*['false'] * 256)
+        w.save()
+        env[self.array_index] = '1'
+        p = subprocess.run(['bash', w.script_name], env=env, stderr=subprocess.PIPE)
+        assert p.returncode == 1
+        assert p.stderr == b'run_packed: 256 of 256 commands failed\n'
+
+    def test_status_recording(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=2, mem=2, pack_tasks=2)
+        w.add_status_recording()
+        w.register_cmds('export SOME_VAR="a value"', 'false', parallel=False)
+        w.add_job_array('echo "$SOME_VAR"', 'exit 3', 'sleep 0.1')
+        w.save()
+        assert w.lines[0] == 'EGCG_STATUS_FILE="%s${%s}"' % (w.status_file, self.array_index)
+        assert w.lines[2:4] == [
+            "record_status prelim1 'export SOME_VAR=\"a value\"'", 'record_status prelim2 false'
+        ]
+
+        env = dict(environ)
+        for task, exp_status in ((1, 3), (2, 0)):
+            env[self.array_index] = str(task)
+            assert subprocess.call(['bash', w.script_name], env=env) == exp_status
+        assert open(w.log_file + '1').read() == 'a value\n'
+
+        statuses = {}
+        for task in (1, 2):
+            for line in open(w.status_file + str(task)):
+                label, exit_status, start, end, max_rss = line.split()
+                assert float(end) >= float(start)
+                assert max_rss == '-' or max_rss.isdigit()
+                statuses[(task, label)] = int(exit_status)
+        assert statuses == {
+            (1, 'prelim1'): 0, (1, 'prelim2'): 1, (1, 'cmd1'): 0, (1, 'cmd2'): 3,
+            (2, 'prelim1'): 0, (2, 'prelim2'): 1, (2, 'cmd3'): 0
+        }
+
+    def test_cmd_file(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=2, mem=2, cmd_file=True)
+        cmds = ['echo "task %s: ünïcödé"' % i for i in range(1, 10001)] + ['exit 3']
+        w.add_job_array(*cmds)
+        w.add_header()
+        w.save()
+        assert self.exp_header[7].replace('1-3', '1-10001') in w.lines
+        assert len(w.lines) == len(self.exp_header) + 2  # the commands are not in the script
+        assert open(w.offsets_file).readline() == '0000000000000000000\n'
+
+        env = dict(environ)
+        for task, exp_status in ((1, 0), (9999, 0), (10001, 3)):
+            env[self.array_index] = str(task)
+            assert subprocess.call(['bash', w.script_name], env=env) == exp_status
+        assert open(w.log_file + '1').read() == 'task 1: ünïcödé\n'
+        assert open(w.log_file + '9999').read() == 'task 9999: ünïcödé\n'
+
+        with pytest.raises(script_writers.EGCGError):
+            w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cmd_file=True)
+            w.add_job_array('this', 'that\nother')
+
+    def test_dependency_header(self):
+        w = self.writer_cls('a_job_name', working_dir, 'a_job_queue', cpus=1, mem=2, dependencies=['1337', '1338'])
+        w.add_header()
+        assert self.exp_dependency_header in w.lines
+        self.script_writer.add_header()
+        assert self.exp_dependency_header not in self.script_writer.lines
+
     def test(self):
         self.script_writer.log_commands = False
         self.script_writer.register_cmds('some', 'preliminary', 'cmds', parallel=False)
@@ -99,6 +233,7 @@ class TestScriptWriter(TestEGCG):
 class TestPBSWriter(TestScriptWriter):
     writer_cls = script_writers.PBSWriter
     array_index = 'PBS_ARRAY_INDEX'
+    exp_dependency_header = '#PBS -W depend=afterok:1337:1338'
     exp_header = [
         '#!/bin/bash\n',
         '#PBS -N a_job_name',
@@ -116,6 +251,7 @@ class TestPBSWriter(TestScriptWriter):
 class TestSlurmWriter(TestScriptWriter):
     writer_cls = script_writers.SlurmWriter
     array_index = 'SLURM_ARRAY_TASK_ID'
+    exp_dependency_header = '#SBATCH --dependency=afterok:1337:1338'
     exp_header = [
         '#!/bin/bash\n',
         '#SBATCH --job-name="a_job_name"',
@@ -0,0 +1,113 @@
+import os
+import shutil
+import pytest
+from unittest.mock import patch
+from tests import TestEGCG
+from tests.fake_scheduler import FakeScheduler
+from egcg_core.executor import WorkerPool, PoolExecutor, execute, stop_running_jobs, worker
+from egcg_core.executor.cluster_executor import JobStatusPoller, running_executors
+from egcg_core.config import cfg
+from egcg_core.exceptions import EGCGError
+
+
+class TestWorkerPool(TestEGCG):
+    working_dir = os.path.join(TestEGCG.assets_path, 'a_pool_run')
+    pool_dir = os.path.join(working_dir, 'pool')
+
+    def setUp(self):
+        os.makedirs(self.working_dir, exist_ok=True)
+        self.config = patch.dict(cfg.content['executor'], join_min_interval=0.05, join_interval=0.1,
+                                 status_max_age=0.01)
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        WorkerPool.pools.clear()
+        JobStatusPoller.pollers.clear()
+        running_executors.clear()
+        shutil.rmtree(self.working_dir)
+
+    def test_worker(self):
+        pool = WorkerPool(self.pool_dir)
+        tasks = {
+            'task1': {'cmd': 'echo "this"\nexit 3', 'working_dir': self.working_dir,
+                      'log_file': os.path.join(self.working_dir, 'task1.log')},
+            'task2': {'cmd': 'sleep 10', 'working_dir': self.working_dir},
+            'task3': {'cmd': 'pwd > a_file', 'working_dir': self.working_dir}
+        }
+        for name, task in tasks.items():
+            worker.write_json(self.pool_dir, 'pending', name, task)
+        open(pool.path('cancel', 'task2'), 'w').close()
+
+        assert worker.Worker(self.pool_dir, slots=2, idle_timeout=0.2, poll_interval=0.02).run() == 3
+        assert sorted(os.listdir(pool.path('done'))) == ['task1', 'task2', 'task3']
+        assert os.listdir(pool.path('pending')) == os.listdir(pool.path('running')) == []
+        results = dict((n, worker.read_json(self.pool_dir, 'done', n)) for n in tasks)
+        assert [results[n]['exit_status'] for n in ('task1', 'task2', 'task3')] == [3, 9, 0]
+        assert results['task2']['end'] - results['task2']['start'] < 5
+        assert results['task1']['max_rss'] > 0
+        assert open(os.path.join(self.working_dir, 'task1.log')).read() == 'this\n'
+        assert open(os.path.join(self.working_dir, 'a_file')).read() == self.working_dir + '\n'
+
+        worker.write_json(self.pool_dir, 'pending', 'task4', {'cmd': 'true'})
+        open(pool.path('stop'), 'w').close()
+        assert worker.Worker(self.pool_dir, idle_timeout=10, poll_interval=0.02).run() == 0
+
+    def test_requeued_task(self):
+        # a task requeued as lost while its worker is still running it is killed and not reported by this worker
+        pool = WorkerPool(self.pool_dir)
+        worker.write_json(self.pool_dir, 'pending', 'task1', {'cmd': 'sleep 10', 'working_dir': self.working_dir})
+        w = worker.Worker(self.pool_dir)
+        w.start_task(*w.claim())
+        proc = w.running['task1'][0]
+        os.rename(pool.path('running', 'task1'), pool.path('pending', 'task1'))
+
+        w.check_task('task1')
+        assert w.running == {}
+        assert proc.returncode == -9
+        assert os.listdir(pool.path('pending')) == ['task1']
+        assert os.listdir(pool.path('done')) == []
+        assert w.nb_tasks == 0
+
+    def test_requeue_lost_tasks(self):
+        pool = WorkerPool(self.pool_dir, lost_timeout=30)
+        for name in ('task1', 'task2'):
+            worker.write_json(self.pool_dir, 'running', name, {'cmd': 'true'})
+        os.utime(pool.path('running', 'task1'), (0, 0))
+        with patch.object(pool, 'check_workers') as mocked_check_workers:
+            pool.requeue_lost_tasks(['task1', 'task2', 'task3'])
+        assert os.listdir(pool.path('pending')) == ['task1']
+        assert os.listdir(pool.path('running')) == ['task2']
+        assert mocked_check_workers.call_count == 1
+
+    def test_get(self):
+        with pytest.raises(EGCGError):
+            WorkerPool.get()
+        with patch.dict(cfg.content['executor'], worker_pool={'pool_dir': self.pool_dir, 'workers': 2, 'mem': 4}):
+            pool = WorkerPool.get()
+            assert WorkerPool.get() is pool
+            assert (pool.workers, pool.slots, pool.cluster_config) == (2, 1, {'mem': 4})
+        with pytest.raises(EGCGError):
+            WorkerPool(self.pool_dir, env='local')
+
+    def test_execute(self):
+        pool_config = {'pool_dir': self.pool_dir, 'env': 'slurm', 'workers': 2, 'cpus': 2, 'idle_timeout': 5,
+                       'poll_interval': 0.05}
+        with FakeScheduler('slurm') as scheduler, \
+                patch.dict(cfg.content['executor'], job_execution='pool', worker_pool=pool_config):
+            e = execute(*['exit %s' % (i % 2) for i in range(20)], job_name='a_job', working_dir=self.working_dir)
+            assert isinstance(e, PoolExecutor)
+            assert e.join() == 10
+            assert [u.exit_status for u in e.usages] == [i % 2 for i in range(20)]
+            assert e.job_id not in running_executors
+
+            e = execute('echo "$SOME_VAR"', job_name='another_job', working_dir=self.working_dir,
+                        prelim_cmds=['export SOME_VAR="a value"'])
+            assert e.join() == 0
+            assert open(os.path.join(self.working_dir, 'another_job.log1')).read() == 'a value\n'
+            assert scheduler.calls['sbatch'] == 1  # the same workers ran both
+
+            e = execute('sleep 10', 'sleep 10', 'sleep 10', 'sleep 10', 'sleep 10', working_dir=self.working_dir)
+            assert stop_running_jobs(timeout=10) == {e.job_id: 45, WorkerPool.get().executor.job_id: 9}
+
+            assert os.listdir(WorkerPool.get().path('done')) == []